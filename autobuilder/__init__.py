@@ -1,8 +1,20 @@
 from .abconfig import AutobuilderConfig, Repo
+from .planner import BuildPlanner
+from .priority import BuildPrioritizer
 from .workers.config import EC2Params, AutobuilderWorker, AutobuilderEC2Worker
+from .workers.fleet import EC2Fleet
+from .workers.warmpool import WarmPool
+from .workers.storage import StorageProfile
+from .workers.regions import RegionSpec
+from .workers.prewarm import PrewarmController
+from .workers.profiles import BuildProfiles, InstanceTypeSelector
+from .workers.timeline import TimelineReporter
 from .distros.config import Distro, TargetImageSet, TargetImage, SdkImage, Buildtype
 from .layers.config import Layer
 from .factory.distro import DistroImage
+from .factory.base import LogReduction, SourceFanout
 from .github.handler import AutobuilderGithubEventHandler
 from .aws_secretsprovider.aws_secrets import AWSSecretsManagerProvider
+from .workers.spotnotice import SpotNoticeHandler
 from .message_utils import AutobuilderMessageFormatter, AutobuilderMessageTemplate
+from .digest import DigestMailNotifier, DigestMessageFormatter
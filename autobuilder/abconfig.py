@@ -3,6 +3,8 @@ Autobuilder configuration module
 """
 from twisted.internet import defer
 from buildbot.plugins import changes, schedulers, worker
+from autobuilder.planner import BuildPlanner
+from autobuilder.priority import BuildPrioritizer
 from autobuilder.workers.config import AutobuilderEC2Worker
 from autobuilder.workers.ec2 import MyEC2LatentWorker
 
@@ -26,7 +28,7 @@ class AutobuilderForceScheduler(schedulers.ForceScheduler):
 
 
 class AutobuilderConfig(object):
-    def __init__(self, name, workers, repos, distros, layers):
+    def __init__(self, name, workers, repos, distros, layers, planner=None, prioritizer=None):
         if name in ABCFG_DICT:
             raise RuntimeError('Autobuilder config {} already exists'.format(name))
         self.name = name
@@ -44,6 +46,8 @@ class AutobuilderConfig(object):
         for d in self.distros:
             d.abconfig = self.name
         self.codebasemap = {self.repos[r].uri: r for r in self.repos}
+        self.planner = planner or BuildPlanner()
+        self.prioritizer = prioritizer or BuildPrioritizer()
         ABCFG_DICT[name] = self
         self._builders = None
         self._schedulers = None
@@ -92,6 +96,10 @@ class AutobuilderConfig(object):
                 self._builders += d.builders(self)
         return self._builders
 
+    @property
+    def prioritize_builders(self):
+        return self.prioritizer.prioritize_builders
+
     @property
     def all_builder_names(self):
         return sorted([b.name for b in self.builders])
@@ -1,30 +1,192 @@
 import json
+import threading
+import time
+
 import boto3.session
 from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
+from botocore.client import ClientError
 from buildbot import config
 from buildbot.secrets.providers.base import SecretProviderBase
+from twisted.internet import defer, threads
+from twisted.python import log
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+
+# Maximum number of secrets in one BatchGetSecretValue call
+BATCH_SIZE = 20
 
 
 class AWSSecretsManagerProvider(SecretProviderBase):
+    """
+    Secrets provider for AWS Secrets Manager. Secrets are referenced as
+    name/key, where name is a secret holding a JSON object and key is one
+    of its fields.
+
+    Parsed secrets are cached for the refresh interval of the underlying
+    SecretCache, so interpolating several keys of the same secret parses
+    it only once. The secrets listed in prefetch are retrieved in batches
+    when the provider is configured. The hits and misses counters count
+    lookups served from, and missing, the parsed-secret cache.
+
+    Secrets Manager is called from a thread pool of the provider's own, of
+    up to pool_size threads (so that long-running EC2 worker threads
+    cannot hold it up), and get() returns a Deferred. A cached secret that
+    has expired less than max_stale seconds ago is returned at once while
+    it is refreshed in the background. Calls taking longer than timeout
+    seconds fail the lookup (or, for a background refresh, leave the
+    cached value in place). endpoint_url points the client at another
+    endpoint, such as a local fake Secrets Manager for testing.
+    """
     name = "SecretInAWS"
 
     def __init__(self, *args, **kwargs):
         self.secrets = None
+        self._parsed = {}
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.timeouts = 0
         super().__init__(*args, **kwargs)
 
-    def checkConfig(self, region=None):
+    def checkConfig(self, region=None, prefetch=None, endpoint_url=None, timeout=10, max_stale=300, pool_size=4):
         if not isinstance(region, str):
             config.error("region parameter is {} instead of string".format(type(region)))
+        if prefetch is not None and (isinstance(prefetch, str) or
+                                     not all(isinstance(name, str) for name in prefetch)):
+            config.error("prefetch parameter must be a list of secret names")
+        if timeout <= 0:
+            config.error("timeout parameter must be positive")
+        if max_stale < 0:
+            config.error("max_stale parameter must not be negative")
+        if pool_size < 1:
+            config.error("pool_size parameter must be at least 1")
 
-    def reconfigService(self, region=None):
-        client = boto3.session.Session().client(service_name="secretsmanager", region_name=region)
-        self.secrets = SecretCache(config=SecretCacheConfig(), client=client)
+    @defer.inlineCallbacks
+    def reconfigService(self, region=None, prefetch=None, endpoint_url=None, timeout=10, max_stale=300,
+                        pool_size=4):
+        self.client = boto3.session.Session().client(service_name="secretsmanager", region_name=region,
+                                                     endpoint_url=endpoint_url)
+        self.cache_config = SecretCacheConfig()
+        self.secrets = SecretCache(config=self.cache_config, client=self.client)
+        self.timeout = timeout
+        self.max_stale = max_stale
+        if self._pool is None:
+            self._pool = ThreadPool(minthreads=0, maxthreads=pool_size, name='AWSSecretsManagerProvider')
+            self._pool.start()
+        else:
+            self._pool.adjustPoolsize(maxthreads=pool_size)
+        with self._lock:
+            self._parsed = {}
+        if prefetch:
+            try:
+                yield self._in_thread(self.prefetch, prefetch)
+            except Exception as e:
+                log.msg('AWSSecretsManagerProvider: prefetch failed: {}'.format(e))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield super().stopService()
+        if self._pool is not None:
+            pool = self._pool
+            self._pool = None
+            yield threads.deferToThread(pool.stop)
+
+    def _in_thread(self, f, *args):
+        d = threads.deferToThreadPool(self.master.reactor, self._pool, f, *args)
+        d.addTimeout(self.timeout, self.master.reactor)
+        return d
+
+    def prefetch(self, names):
+        """
+        Retrieves and caches the named secrets using batched requests.
+        Called in a thread.
+        """
+        names = list(dict.fromkeys(names))
+        fetched = time.time()
+        for i in range(0, len(names), BATCH_SIZE):
+            try:
+                result = self.client.batch_get_secret_value(SecretIdList=names[i:i + BATCH_SIZE])
+            except ClientError as e:
+                log.msg('AWSSecretsManagerProvider: prefetch failed: {}'.format(e))
+                continue
+            for secret in result.get('SecretValues', []):
+                self._store(secret['Name'], secret.get('SecretString'), fetched)
+                if secret['ARN'] in names:
+                    self._store(secret['ARN'], secret.get('SecretString'), fetched)
+            for error in result.get('Errors', []):
+                log.msg('AWSSecretsManagerProvider: could not prefetch {}: {}'.format(
+                    error.get('SecretId'), error.get('Message')))
+
+    def _store(self, name, secret_string, fetched):
+        try:
+            parsed = json.loads(secret_string)
+        except (TypeError, ValueError):
+            log.msg('AWSSecretsManagerProvider: secret {} is not a JSON object'.format(name))
+            return None
+        with self._lock:
+            self._parsed[name] = (fetched, parsed)
+        return parsed
+
+    def _fetch(self, name):
+        fetched = time.time()
+        s_dict = json.loads(self.secrets.get_secret_string(name))
+        with self._lock:
+            self._parsed[name] = (fetched, s_dict)
+        return s_dict
+
+    def _refresh(self, name):
+        """
+        Returns a Deferred firing with the freshly retrieved secret, sharing
+        any retrieval of the same secret that is already in progress.
+        """
+        waiter = defer.Deferred()
+        if name not in self._inflight:
+            self._inflight[name] = []
+            d = self._in_thread(self._fetch, name)
+
+            def done(result):
+                if isinstance(result, Failure) and result.check(defer.TimeoutError):
+                    self.timeouts += 1
+                    log.msg('AWSSecretsManagerProvider: retrieving {} timed out after {}s'.format(
+                        name, self.timeout))
+                for w in self._inflight.pop(name):
+                    if isinstance(result, Failure):
+                        w.errback(result)
+                    else:
+                        w.callback(result)
+            d.addBoth(done)
+        self._inflight[name].append(waiter)
+        return waiter
+
+    def _secret_dict(self, name):
+        with self._lock:
+            entry = self._parsed.get(name)
+        if entry is not None:
+            age = time.time() - entry[0]
+            if age < self.cache_config.secret_refresh_interval:
+                self.hits += 1
+                return defer.succeed(entry[1])
+            if age < self.cache_config.secret_refresh_interval + self.max_stale:
+                self.hits += 1
+                self.stale_hits += 1
+                d = self._refresh(name)
+                d.addErrback(log.err, 'AWSSecretsManagerProvider: refreshing ' + name)
+                return defer.succeed(entry[1])
+        self.misses += 1
+        return self._refresh(name)
 
     def get(self, entry):
         name, key = entry.split('/', maxsplit=1)
-        s_ent = self.secrets.get_secret_string(name)
-        s_dict = json.loads(s_ent)
-        try:
-            return s_dict[key]
-        except KeyError as e:
-            raise KeyError("Could not find key {} for AWS Secrets Manager secret {}: {}".format(key, name, e)) from e
+        d = self._secret_dict(name)
+
+        def lookup(s_dict):
+            try:
+                return s_dict[key]
+            except KeyError as e:
+                raise KeyError("Could not find key {} for AWS Secrets Manager secret {}: {}".format(
+                    key, name, e)) from e
+        d.addCallback(lookup)
+        return d
@@ -0,0 +1,92 @@
+import collections
+import threading
+
+from twisted.internet import defer
+from twisted.python import log
+
+# Buildset properties that must match for requests to be collapsed: the
+# build type and the properties it sets (see distros.config.Buildtype)
+BUILDTYPE_PROPERTIES = ('buildtype', 'current_symlink', 'pullrequest', 'keep_going',
+                        'noartifacts', 'buildtype_extraconf')
+# Number of collapsing decisions remembered
+COLLAPSED_HISTORY = 500
+
+
+class CollapsedRequests(object):
+    """
+    Remembers, for the most recent build requests that others were
+    collapsed into, which requests were collapsed into them.
+    """
+    def __init__(self, size=COLLAPSED_HISTORY):
+        self._lock = threading.Lock()
+        self._collapsed = collections.OrderedDict()
+        self.size = size
+
+    def record(self, brid, collapsed_brid):
+        with self._lock:
+            brids = self._collapsed.setdefault(brid, [])
+            if collapsed_brid not in brids:
+                brids.append(collapsed_brid)
+            self._collapsed.move_to_end(brid)
+            while len(self._collapsed) > self.size:
+                self._collapsed.popitem(last=False)
+
+    def collapsed_into(self, brid):
+        """
+        Returns the IDs of the requests collapsed into the given request.
+        """
+        with self._lock:
+            return list(self._collapsed.get(brid, []))
+
+
+COLLAPSED = CollapsedRequests()
+
+
+def _buildtype_props(props):
+    values = {name: props.get(name, (None, None))[0] for name in BUILDTYPE_PROPERTIES}
+    values['pullrequest'] = bool(values['pullrequest'])
+    return values
+
+
+@defer.inlineCallbacks
+def collapse_requests(master, builder, new_br, old_br):
+    """
+    collapseRequests function for distro and layer builders. An older
+    pending request is collapsed into a newer one when both build the
+    same project, repository and branch, with no patches, and their
+    buildsets have the same build type and build type properties, so
+    that push builds are never collapsed with pull request builds, nor
+    builds of one type with another. Collapsed requests are logged and
+    recorded in COLLAPSED.
+    """
+    if new_br['buildsetid'] == old_br['buildsetid']:
+        return True
+    if new_br['buildrequestid'] < old_br['buildrequestid']:
+        return False
+    new_bs, old_bs = yield defer.gatherResults([master.data.get(('buildsets', str(new_br['buildsetid']))),
+                                                master.data.get(('buildsets', str(old_br['buildsetid'])))],
+                                               consumeErrors=True)
+    if new_bs is None or old_bs is None:
+        return False
+    new_sources = {ss['codebase']: ss for ss in new_bs['sourcestamps']}
+    old_sources = {ss['codebase']: ss for ss in old_bs['sourcestamps']}
+    if set(new_sources) != set(old_sources):
+        return False
+    for codebase, new_ss in new_sources.items():
+        old_ss = old_sources[codebase]
+        for attr in ('project', 'repository', 'branch'):
+            if new_ss[attr] != old_ss[attr]:
+                return False
+        if new_ss['patch'] or old_ss['patch']:
+            return False
+    new_props, old_props = yield defer.gatherResults(
+        [master.data.get(('buildsets', str(new_br['buildsetid']), 'properties')),
+         master.data.get(('buildsets', str(old_br['buildsetid']), 'properties'))],
+        consumeErrors=True)
+    if _buildtype_props(new_props or {}) != _buildtype_props(old_props or {}):
+        return False
+    COLLAPSED.record(new_br['buildrequestid'], old_br['buildrequestid'])
+    log.msg('collapse_requests: {}: request {} (buildset {}) collapsed into request {} (buildset {})'.format(
+        builder.name, old_br['buildrequestid'], old_br['buildsetid'],
+        new_br['buildrequestid'], new_br['buildsetid']))
+    return True
@@ -0,0 +1,156 @@
+import time
+
+from buildbot import config
+from buildbot.process.results import EXCEPTION, FAILURE, Results
+from buildbot.reporters.mail import MailNotifier
+from buildbot.reporters.message import MessageFormatterBase
+from buildbot.reporters.utils import getURLForBuild
+from email.message import Message
+from twisted.internet import defer
+from twisted.python import log
+
+from autobuilder.templating import read_template, string_template
+
+# Results sent right away when send_failures_immediately is set
+IMMEDIATE_RESULTS = (FAILURE, EXCEPTION)
+
+
+class DigestMessageFormatter(MessageFormatterBase):
+    """
+    Message formatter for the generators of a DigestMailNotifier. It
+    renders nothing for the builds that go into a digest, since the
+    notifier only uses their results; failed builds are rendered with
+    failure_formatter, if set, so that they can be sent right away.
+    """
+    def __init__(self, failure_formatter=None):
+        super().__init__(want_properties=False)
+        self.failure_formatter = failure_formatter
+        if failure_formatter is not None:
+            self.want_properties = failure_formatter.want_properties
+            self.want_steps = failure_formatter.want_steps
+            self.want_logs = failure_formatter.want_logs
+            self.want_logs_content = failure_formatter.want_logs_content
+
+    def format_message_for_build(self, master, build, **kwargs):
+        if self.failure_formatter is not None and build['results'] in IMMEDIATE_RESULTS:
+            return self.failure_formatter.format_message_for_build(master, build, **kwargs)
+        return defer.succeed({'body': None, 'type': 'plain', 'subject': None, 'extra_info': None})
+
+    def format_message_for_buildset(self, master, buildset, builds, **kwargs):
+        if self.failure_formatter is not None and buildset['results'] in IMMEDIATE_RESULTS:
+            return self.failure_formatter.format_message_for_buildset(master, buildset, builds, **kwargs)
+        return defer.succeed({'body': None, 'type': 'plain', 'subject': None, 'extra_info': None})
+
+
+class DigestMailNotifier(MailNotifier):
+    """
+    MailNotifier that collects the results its generators report and,
+    once per digest_window seconds, sends one digest message covering all
+    of them to every recipient (interested users, and extraRecipients
+    addresses such as a Distro's or Layer's email address) that would have
+    been sent a message for any of the builds, instead of one message per
+    build. The digest is rendered from digest_template (default_digest.txt)
+    once per window.
+
+    The generators should use a DigestMessageFormatter, so that no message
+    is rendered for the builds that go into a digest. With
+    send_failures_immediately set, failed builds for which the formatter
+    renders a message (see failure_formatter) are still sent as
+    individual messages, as MailNotifier would, and are left out of the
+    digest.
+    """
+    def __init__(self, *args, **kwargs):
+        self._entries = []
+        self._recipients = set()
+        self._flush_call = None
+        super().__init__(*args, **kwargs)
+
+    def checkConfig(self, fromaddr, digest_window=15 * 60, send_failures_immediately=True,
+                    digest_template=None, digest_template_dir=None, **kwargs):
+        super().checkConfig(fromaddr, **kwargs)
+        if digest_window <= 0:
+            config.error("digest_window must be positive")
+        for g in kwargs.get('generators') or []:
+            if not isinstance(getattr(g, 'formatter', None), DigestMessageFormatter):
+                config.error("DigestMailNotifier generators must use a DigestMessageFormatter")
+
+    @defer.inlineCallbacks
+    def reconfigService(self, fromaddr, digest_window=15 * 60, send_failures_immediately=True,
+                        digest_template=None, digest_template_dir=None, **kwargs):
+        yield super().reconfigService(fromaddr, **kwargs)
+        self.digest_window = digest_window
+        self.send_failures_immediately = send_failures_immediately
+        self.digest_template = read_template(digest_template or 'default_digest.txt', digest_template_dir)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        yield self.flush()
+        yield super().stopService()
+
+    @defer.inlineCallbacks
+    def sendMessage(self, reports):
+        results = [report['results'] for report in reports]
+        if self.send_failures_immediately and any(r in IMMEDIATE_RESULTS for r in results) and \
+                all(report['body'] is not None for report in reports):
+            yield super().sendMessage(reports)
+            return
+        worker = next((report['worker'] for report in reports if report.get('worker')), None)
+        users = set()
+        for report in reports:
+            users.update(report.get('users') or [])
+        if worker is None:
+            recipients = yield self.findInterrestedUsersEmails(list(users))
+            # Only the returned addresses (To and CC) are used; each digest is sent to one recipient
+            recipients = self.processRecipients(recipients, Message())
+        else:
+            recipients = list(users)
+        if not recipients:
+            return
+        self._entries += [self._digest_entry(report) for report in reports]
+        self._recipients.update(recipients)
+        if self._flush_call is None:
+            self._flush_call = self.master.reactor.callLater(self.digest_window, self._flush_later)
+
+    def _digest_entry(self, report):
+        builds = []
+        for build in report.get('builds') or []:
+            builds.append({'builder': build['builder']['name'],
+                           'number': build['number'],
+                           'result': Results[build['results']] if build.get('results') is not None else 'unknown',
+                           'url': getURLForBuild(self.master, build['builderid'], build['number'])})
+        return {'subject': report['subject'],
+                'results': report['results'],
+                'result': Results[report['results']] if report['results'] is not None else 'unknown',
+                'builds': builds}
+
+    def _flush_later(self):
+        self._flush_call = None
+        d = self.flush()
+        d.addErrback(log.err, '{}: sending digest failed'.format(self.__class__.__name__))
+
+    @defer.inlineCallbacks
+    def flush(self):
+        """
+        Sends the digests collected so far.
+        """
+        entries, self._entries = self._entries, []
+        recipients, self._recipients = self._recipients, set()
+        if not entries:
+            return
+        started = time.time()
+        failed = sum(1 for e in entries if e['results'] in (FAILURE, EXCEPTION))
+        body = string_template(self.digest_template).render(entries=entries, failed=failed,
+                                                            title=self.master.config.title,
+                                                            window_minutes=max(self.digest_window // 60, 1))
+        subject = '{}: {} build results, {} failed'.format(self.master.config.title, len(entries), failed)
+        m = yield self.createEmail({'body': body, 'subject': subject, 'type': 'plain'},
+                                   self.master.config.title, [e['results'] for e in entries])
+        log.msg('{}: digest of {} results for {} recipients rendered in {:.3f}s'.format(
+            self.__class__.__name__, len(entries), len(recipients), time.time() - started))
+        for recipient in sorted(recipients):
+            del m['To']
+            m['To'] = self.formatAddress(recipient)
+            yield self.sendMail(m, [recipient])
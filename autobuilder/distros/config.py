@@ -3,8 +3,9 @@ from buildbot.plugins import schedulers
 from buildbot.config import BuilderConfig
 
 from autobuilder.abconfig import AutobuilderForceScheduler, AutobuilderConfig
-from autobuilder.factory.distro import DistroImage
+from autobuilder.factory.distro import DistroCheckout, DistroImage
 from autobuilder.factory.base import delete_env_vars
+from autobuilder.collapse import collapse_requests
 from autobuilder.workers.ec2 import nextEC2Worker
 
 
@@ -99,26 +100,7 @@ class TargetImageSet(object):
         self.imagespecs = imagespecs
 
 
-class WeeklySlot(object):
-    def __init__(self, day, hour, minute):
-        self.dayOfWeek = day
-        self.hour = hour
-        self.minute = minute
-
-
 class Distro(object):
-    WEEKLY_SLOTS = [WeeklySlot(d, h, 0) for d in [5, 6] for h in [4, 8, 12, 16, 20]]
-    LAST_USED_WEEKLY = -1
-
-    @classmethod
-    def get_weekly_slot(cls):
-        try:
-            slot = cls.WEEKLY_SLOTS[cls.LAST_USED_WEEKLY + 1]
-            cls.LAST_USED_WEEKLY += 1
-        except IndexError:
-            raise RuntimeError('too many weekly builds scheduled')
-        return slot
-
     def __init__(self, name, reponame, branch, email, path,
                  targets=None,
                  setup_script='./setup-env',
@@ -126,12 +108,15 @@ class Distro(object):
                  artifacts=None,
                  buildtypes=None,
                  weekly_type=None,
+                 nightly_type=None,
                  push_type='__default__',
                  pullrequest_type=None,
                  extra_config=None,
                  extra_env=None,
                  parallel_builders=False,
-                 worker_prefix=None):
+                 source_fanout=None,
+                 worker_prefix=None,
+                 log_reduction=None):
         self.name = name
         self.reponame = reponame
         self.branch = branch
@@ -154,6 +139,9 @@ class Distro(object):
         if weekly_type is not None and weekly_type not in self.btdict.keys():
             raise RuntimeError('Weekly build type for %s set to unknown type: %s' % (self.name, weekly_type))
         self.weekly_type = weekly_type
+        if nightly_type is not None and nightly_type not in self.btdict.keys():
+            raise RuntimeError('Nightly build type for %s set to unknown type: %s' % (self.name, nightly_type))
+        self.nightly_type = nightly_type
         if push_type:
             self.push_type = push_type if push_type != '__default__' else self.default_buildtype
         else:
@@ -171,7 +159,11 @@ class Distro(object):
             self.extra_config = []
         self.extra_env = extra_env
         self.parallel_builders = parallel_builders
+        if source_fanout is not None and not parallel_builders:
+            raise RuntimeError('source_fanout for %s requires parallel_builders' % self.name)
+        self.source_fanout = source_fanout
         self.worker_prefix = worker_prefix
+        self.log_reduction = log_reduction
         self.abconfig = None
         self._builders = None
         self._schedulers = None
@@ -186,6 +178,22 @@ class Distro(object):
                                                                       default=repos[self.reponame].uri),
                                        branch=util.FixedParameter(name='branch', default=self.branch))]
 
+    @property
+    def builder_names(self):
+        if self.parallel_builders:
+            return [self.name + '-' + imgset.name for imgset in self.targets]
+        return [self.name]
+
+    @property
+    def scheduler_builder_names(self):
+        """
+        Names of the builders the distro's schedulers start builds on:
+        the checkout builder, when using a source fan-out.
+        """
+        if self.source_fanout is not None:
+            return [self.name + '-checkout']
+        return self.builder_names
+
     def builders(self, abcfg: AutobuilderConfig):
         if self._builders is None:
             repo = abcfg.repos[self.reponame]
@@ -210,35 +218,51 @@ class Distro(object):
                 self._builders = [BuilderConfig(name=self.name + '-' + imgset.name,
                                                 workernames=workernames,
                                                 nextWorker=nextEC2Worker,
+                                                collapseRequests=collapse_requests,
+                                                nextBuild=abcfg.prioritizer.next_build,
                                                 properties=props,
                                                 factory=DistroImage(repourl=repo.uri,
                                                                     submodules=repo.submodules,
                                                                     branch=self.branch,
                                                                     codebase=self.reponame,
                                                                     imagesets=[imgset],
-                                                                    extra_env=self.extra_env))
+                                                                    extra_env=self.extra_env,
+                                                                    log_reduction=self.log_reduction,
+                                                                    source_fanout=self.source_fanout))
                                   for imgset in self.targets]
+                if self.source_fanout is not None:
+                    self._builders.append(BuilderConfig(name=self.name + '-checkout',
+                                                        workernames=self.source_fanout.workernames,
+                                                        collapseRequests=collapse_requests,
+                                                        nextBuild=abcfg.prioritizer.next_build,
+                                                        properties=props,
+                                                        factory=DistroCheckout(repourl=repo.uri,
+                                                                               source_fanout=self.source_fanout,
+                                                                               scheduler_name=self.name + '-fanout',
+                                                                               submodules=repo.submodules,
+                                                                               branch=self.branch,
+                                                                               codebase=self.reponame)))
             else:
                 self._builders = [BuilderConfig(name=self.name,
                                                 workernames=workernames,
                                                 nextWorker=nextEC2Worker,
+                                                collapseRequests=collapse_requests,
+                                                nextBuild=abcfg.prioritizer.next_build,
                                                 properties=props,
                                                 factory=DistroImage(repourl=repo.uri,
                                                                     submodules=repo.submodules,
                                                                     branch=self.branch,
                                                                     codebase=self.reponame,
                                                                     imagesets=self.targets,
-                                                                    extra_env=self.extra_env))]
+                                                                    extra_env=self.extra_env,
+                                                                    log_reduction=self.log_reduction))]
         return self._builders
 
     def schedulers(self, abcfg: AutobuilderConfig):
         if self._schedulers is None:
             repos = abcfg.repos
             s = []
-            if self.parallel_builders:
-                builder_names = [self.name + '-' + imgset.name for imgset in self.targets]
-            else:
-                builder_names = [self.name]
+            builder_names = self.scheduler_builder_names
             if self.push_type is not None:
                 md_filter = util.ChangeFilter(project=self.name,
                                               branch=self.branch, codebase=self.reponame,
@@ -276,7 +300,7 @@ class Distro(object):
                                                properties=forceprops,
                                                builderNames=builder_names))
             if self.weekly_type is not None:
-                slot = self.get_weekly_slot()
+                slot = abcfg.planner.slot(abcfg, self.name + '-weekly')
                 props = {'buildtype': self.weekly_type}
                 props.update(self.btdict[self.weekly_type].properties)
                 s.append(schedulers.Nightly(name=self.name + '-' + 'weekly',
@@ -287,5 +311,20 @@ class Distro(object):
                                             dayOfWeek=slot.dayOfWeek,
                                             hour=slot.hour,
                                             minute=slot.minute))
+            if self.nightly_type is not None:
+                slot = abcfg.planner.slot(abcfg, self.name + '-nightly')
+                props = {'buildtype': self.nightly_type}
+                props.update(self.btdict[self.nightly_type].properties)
+                s.append(schedulers.Nightly(name=self.name + '-' + 'nightly',
+                                            properties=props,
+                                            codebases=self.codebases(repos),
+                                            createAbsoluteSourceStamps=True,
+                                            builderNames=builder_names,
+                                            hour=slot.hour,
+                                            minute=slot.minute))
+            if self.source_fanout is not None:
+                s.append(schedulers.Triggerable(name=self.name + '-fanout',
+                                                codebases=self.codebases(repos),
+                                                builderNames=self.builder_names))
             self._schedulers = s
         return self._schedulers
@@ -1,7 +1,9 @@
+import fnmatch
 import re
 import time
 
-from buildbot.plugins import util
+from buildbot.plugins import util, steps
+from buildbot.process.results import SKIPPED
 
 ENV_VARS = {'PATH': util.Property('PATH'),
             'ORIGPATH': util.Property('ORIGPATH'),
@@ -56,3 +58,211 @@ def delete_env_vars():
 @util.renderer
 def datestamp(props):
     return str(time.strftime("%Y%m%d"))
+
+
+class LogReduction(object):
+    """
+    Worker-side reduction of bitbake console output.
+
+    The full console log of each bitbake step is written to a file
+    on the worker, compressed, and uploaded to the master afterwards.
+    Only the warning and error lines (up to max_warnings of them), the
+    last tail_lines lines of output, and the last failed_task_lines
+    lines of each failed task's log (for up to max_failed_tasks tasks)
+    are streamed to the master as the step log.
+
+    step_limits maps step-name glob patterns to dicts overriding any
+    of the limits above for matching steps; the first match wins.
+    Patterns are matched against the name of the bitbake step (such
+    as build_pseudo_native), not the name of its log file.
+
+    The compressed logs are stored under masterdir (relative to the
+    master's base directory) as <buildername>/<buildnumber>/<log>.log.zst,
+    where <log> is the step name unless the step passes a separate log
+    name (which it must do when several of a build's steps share a name).
+    If url is set, it should be the base URL at which masterdir is
+    served, and a link to the full log is added to each upload step.
+    """
+    DEFAULT_LIMITS = {'tail_lines': 200,
+                      'max_warnings': 500,
+                      'failed_task_lines': 100,
+                      'max_failed_tasks': 5}
+
+    def __init__(self, tail_lines=200, max_warnings=500, failed_task_lines=100,
+                 max_failed_tasks=5, step_limits=None, masterdir='buildlogs', url=None):
+        self.limits = {'tail_lines': tail_lines,
+                       'max_warnings': max_warnings,
+                       'failed_task_lines': failed_task_lines,
+                       'max_failed_tasks': max_failed_tasks}
+        self.step_limits = step_limits or {}
+        for pattern, limits in self.step_limits.items():
+            unknown = set(limits.keys()) - set(self.DEFAULT_LIMITS.keys())
+            if unknown:
+                raise ValueError('Unknown log reduction limits for {}: {}'.format(pattern, ', '.join(sorted(unknown))))
+        self.masterdir = masterdir
+        self.url = url.rstrip('/') if url else None
+
+    def limits_for(self, stepname):
+        result = dict(self.limits)
+        for pattern, limits in self.step_limits.items():
+            if fnmatch.fnmatchcase(stepname, pattern):
+                result.update(limits)
+                break
+        return result
+
+    @staticmethod
+    def logname(stepname):
+        return re.sub(r'[^A-Za-z0-9_.-]', '_', stepname) + '.log'
+
+    def wrap_command(self, cmd, stepname, logname=None):
+        """
+        Wraps a bitbake command string (which may contain Interpolate
+        placeholders) so the full output goes to a log file on the worker
+        and only the reduced output goes to stdout. The log file is named
+        after logname, or after stepname if logname is not given.
+        """
+        limits = self.limits_for(stepname)
+        logfile = 'buildlogs/' + self.logname(logname or stepname)
+        return ('mkdir -p buildlogs; rm -f {log} {log}.zst; '
+                '{{ {cmd}; }} 2>&1 | tee {log} | '
+                "awk -v max={max_warnings} '/^(WARNING|ERROR):/ {{ if (n < max) {{ print; fflush() }} n++ }} "
+                'END {{ if (n > max) print "... " n - max " more warning/error lines in full log" }}\'; '
+                'rc=${{PIPESTATUS[0]}}; '
+                'echo "---- last {tail_lines} lines of output ----"; tail -n {tail_lines} {log}; '
+                'if [ $rc -ne 0 ]; then '
+                'sed -n "s/^ERROR: Logfile of failure stored in: //p" {log} | sort -u | head -n {max_failed_tasks} | '
+                'while read -r f; do echo "---- last {failed_task_lines} lines of $f ----"; '
+                'tail -n {failed_task_lines} "$f"; done; fi; '
+                'exit $rc').format(log=logfile, cmd=cmd, **limits)
+
+    def upload_steps(self, logname):
+        """
+        Returns the steps that compress the full log and upload it. They
+        always run, so the log is kept even if the bitbake step was
+        interrupted or killed.
+        """
+        logfile = self.logname(logname)
+        dest = '%(prop:buildername)s/%(prop:buildnumber)s/' + logfile + '.zst'
+        compress = steps.ShellCommand(command=['sh', '-c', 'if [ -f "$1" ]; then zstd -q -f --rm "$1"; fi',
+                                               'sh', 'buildlogs/' + logfile],
+                                      workdir=util.Property('BUILDDIR'),
+                                      name='compress_log_{}'.format(logname),
+                                      alwaysRun=True,
+                                      haltOnFailure=False,
+                                      flunkOnFailure=False,
+                                      warnOnFailure=False,
+                                      description="Compressing",
+                                      descriptionSuffix=["full", "log"],
+                                      descriptionDone="Compressed")
+        upload = steps.FileUpload(workersrc='buildlogs/' + logfile + '.zst',
+                                  workdir=util.Property('BUILDDIR'),
+                                  masterdest=util.Interpolate(self.masterdir + '/' + dest),
+                                  url=util.Interpolate(self.url + '/' + dest) if self.url else None,
+                                  urlText='Full log',
+                                  name='upload_log_{}'.format(logname),
+                                  alwaysRun=True,
+                                  haltOnFailure=False,
+                                  flunkOnFailure=False,
+                                  warnOnFailure=False,
+                                  description="Uploading",
+                                  descriptionSuffix=["full", "log"],
+                                  descriptionDone="Uploaded")
+        return [compress, upload]
+
+
+# Properties passed on from a fan-out checkout build to the imageset
+# builds, with their values for builds that do not have them;
+# fanout_scheduler is the scheduler that started the checkout build
+FANOUT_PROPERTIES = {'buildtype': '',
+                     'current_symlink': False,
+                     'pullrequest': False,
+                     'keep_going': False,
+                     'noartifacts': False,
+                     'buildtype_extraconf': '',
+                     'prnumber': 0,
+                     'fanout_scheduler': util.Property('scheduler')}
+
+
+@util.renderer
+def checkout_revision(props):
+    revision = props.getProperty('got_revision')
+    if isinstance(revision, dict):
+        # Keyed by codebase; distros have a single codebase
+        revision = next(iter(revision.values()), None)
+    return revision or 'unknown'
+
+
+class SourceFanout(object):
+    """
+    Single checkout for distros with parallel_builders. The distro's
+    schedulers then start a <distro>-checkout builder, which checks out
+    the repository (with submodules, if set) once, uploads the checked-out
+    tree as a zstd-compressed tarball to the master, and triggers the
+    imageset builders, which unpack the tarball instead of cloning.
+
+    The checkout builder runs on the workers named in workernames, which
+    should be lightweight, always-on workers (such as a LocalWorker on the
+    master) listed in c['workers'], so that the checkout neither starts
+    nor holds an instance from the build worker pool. It does not wait
+    for the imageset builds; instead, each checkout build removes
+    tarballs older than keep_hours, which should be longer than imageset
+    builds wait in the queue.
+
+    Tarballs are stored under masterdir (relative to the master's base
+    directory) as <project>/<revision>-<buildnumber>.tar.zst.
+    """
+    def __init__(self, workernames, masterdir='sources', keep_hours=24):
+        if not workernames:
+            raise RuntimeError('SourceFanout needs at least one worker name')
+        if keep_hours <= 0:
+            raise RuntimeError('SourceFanout keep_hours must be positive')
+        self.workernames = workernames
+        self.masterdir = masterdir
+        self.keep_hours = keep_hours
+
+    def bundle_path(self):
+        return util.Interpolate(self.masterdir + '/%(prop:project)s/%(kw:revision)s-%(prop:buildnumber)s.tar.zst',
+                                revision=checkout_revision)
+
+    def expire_step(self):
+        """
+        Returns the master-side step removing tarballs older than keep_hours.
+        """
+        return steps.MasterShellCommand(command=['sh', '-c', 'mkdir -p "$1" && find "$1" -type f '
+                                                             '-name "*.tar.zst" -mmin +"$2" -delete',
+                                                 'sh', self.masterdir, str(int(self.keep_hours * 60))],
+                                        name='expire-source-bundles',
+                                        haltOnFailure=False,
+                                        flunkOnFailure=False,
+                                        warnOnFailure=True,
+                                        description="Removing",
+                                        descriptionSuffix=["old", "source", "bundles"],
+                                        descriptionDone="Removed")
+
+    def unpack_steps(self):
+        """
+        Returns the steps that replace the checkout in imageset builds
+        triggered by the checkout builder.
+        """
+        def has_bundle(step):
+            return bool(step.build.getProperty('source_bundle'))
+
+        def hide_skipped(results, step):
+            return results == SKIPPED
+        return [steps.RemoveDirectory('build', name='remove-source',
+                                      doStepIf=has_bundle, hideStepIf=hide_skipped,
+                                      description="Removing old source tree",
+                                      descriptionDone="Removed old source tree"),
+                steps.FileDownload(mastersrc=util.Property('source_bundle'), workerdest='source.tar.zst',
+                                   workdir='.', name='download-source',
+                                   doStepIf=has_bundle, hideStepIf=hide_skipped,
+                                   description="Downloading",
+                                   descriptionSuffix=["source"],
+                                   descriptionDone="Downloaded"),
+                steps.ShellCommand(command=['sh', '-c', 'mkdir -p build && tar --zstd -xf source.tar.zst -C build'
+                                                        ' && rm -f source.tar.zst'],
+                                   workdir='.', name='unpack-source',
+                                   doStepIf=has_bundle, hideStepIf=hide_skipped,
+                                   description="Unpacking",
+                                   descriptionSuffix=["source"],
+                                   descriptionDone="Unpacked")]
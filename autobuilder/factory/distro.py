@@ -7,6 +7,7 @@ from buildbot.process.results import SKIPPED
 import autobuilder.abconfig as abconfig
 from autobuilder.factory.base import is_pull_request
 from autobuilder.factory.base import extract_env_vars, merge_env_vars, dict_merge, datestamp
+from autobuilder.factory.base import FANOUT_PROPERTIES
 
 
 def build_tag(props):
@@ -56,28 +57,95 @@ def bitbake_options(props):
         opts += ' -k'
 
 
+def bitbake_command(cmd, stepname, log_reduction, logname=None):
+    if log_reduction is not None:
+        cmd = log_reduction.wrap_command(cmd, stepname, logname)
+    return util.Interpolate(cmd, bitbake_options=bitbake_options)
+
+
+def add_checkout_steps(factory, repourl, submodules, branch, codebase, source_fanout=None):
+    """
+    Adds the distro repository checkout steps to a build factory. With
+    source_fanout, builds triggered by the checkout builder (which have
+    the source_bundle property set) unpack its source tarball instead.
+    """
+    def checkout(pullrequest):
+        def do_step(step):
+            if source_fanout is not None and step.build.getProperty('source_bundle'):
+                return False
+            return bool(is_pull_request(step.build.getProperties())) == pullrequest
+        return do_step
+
+    factory.addStep(steps.GitHub(repourl=repourl, submodules=submodules,
+                                 branch=branch, codebase=codebase,
+                                 name='git-checkout-{}'.format(branch),
+                                 mode=('full' if submodules else 'incremental'),
+                                 method='clobber',
+                                 doStepIf=checkout(False),
+                                 hideStepIf=lambda results, step: results == SKIPPED))
+    factory.addStep(steps.GitHub(repourl=repourl, submodules=submodules,
+                                 branch=branch, codebase=codebase,
+                                 name='git-checkout-pullrequest-ref',
+                                 mode=('full' if submodules else 'incremental'),
+                                 method='clobber',
+                                 doStepIf=checkout(True),
+                                 hideStepIf=lambda results, step: results == SKIPPED))
+    if source_fanout is not None:
+        factory.addSteps(source_fanout.unpack_steps())
+
+
+class DistroCheckout(BuildFactory):
+    """
+    Checkout builder for a distro using a SourceFanout: checks out the
+    repository once, uploads it to the master, and triggers the imageset
+    builders through the given Triggerable scheduler, without waiting
+    for them.
+    """
+    def __init__(self, repourl, source_fanout, scheduler_name, submodules=False, branch='master',
+                 codebase=''):
+        BuildFactory.__init__(self)
+        self.addStep(source_fanout.expire_step())
+        add_checkout_steps(self, repourl, submodules, branch, codebase)
+        self.addStep(steps.SetProperty(name='SetSourceBundle',
+                                       property='source_bundle', value=source_fanout.bundle_path()))
+        self.addStep(steps.ShellCommand(command=['sh', '-c', 'rm -f ../source.tar.zst && '
+                                                             'tar --zstd -cf ../source.tar.zst .'],
+                                        name='pack-source',
+                                        description="Packing",
+                                        descriptionSuffix=["source"],
+                                        descriptionDone="Packed"))
+        self.addStep(steps.FileUpload(workersrc='../source.tar.zst',
+                                      masterdest=util.Property('source_bundle'),
+                                      name='upload-source',
+                                      description="Uploading",
+                                      descriptionSuffix=["source"],
+                                      descriptionDone="Uploaded"))
+        self.addStep(steps.ShellCommand(command=['rm', '-f', '../source.tar.zst'],
+                                        name='remove-packed-source',
+                                        alwaysRun=True,
+                                        haltOnFailure=False,
+                                        flunkOnFailure=False,
+                                        description="Removing",
+                                        descriptionSuffix=["packed", "source"],
+                                        descriptionDone="Removed"))
+        trigger_props = {name: util.Property(name, default=default) for name, default in FANOUT_PROPERTIES.items()}
+        trigger_props['source_bundle'] = util.Property('source_bundle')
+        self.addStep(steps.Trigger(schedulerNames=[scheduler_name],
+                                   waitForFinish=False,
+                                   updateSourceStamp=True,
+                                   set_properties=trigger_props,
+                                   name='trigger-imagesets'))
+
+
 class DistroImage(BuildFactory):
     def __init__(self, repourl, submodules=False, branch='master',
-                 codebase='', imagesets=None, extra_env=None):
+                 codebase='', imagesets=None, extra_env=None, log_reduction=None, source_fanout=None):
         BuildFactory.__init__(self)
         if extra_env is None:
             extra_env = {}
         self.addStep(steps.SetProperty(name='SetDatestamp',
                                        property='datestamp', value=datestamp))
-        self.addStep(steps.GitHub(repourl=repourl, submodules=submodules,
-                               branch=branch, codebase=codebase,
-                               name='git-checkout-{}'.format(branch),
-                               mode=('full' if submodules else 'incremental'),
-                               method='clobber',
-                               doStepIf=lambda step: not is_pull_request(step.build.getProperties()),
-                               hideStepIf=lambda results, step: results == SKIPPED))
-        self.addStep(steps.GitHub(repourl=repourl, submodules=submodules,
-                               branch=branch, codebase=codebase,
-                               name='git-checkout-pullrequest-ref',
-                               mode=('full' if submodules else 'incremental'),
-                               method='clobber',
-                               doStepIf=lambda step: is_pull_request(step.build.getProperties()),
-                               hideStepIf=lambda results, step: results == SKIPPED))
+        add_checkout_steps(self, repourl, submodules, branch, codebase, source_fanout)
         # First, remove duplicates from original PATH (saved in ORIGPATH env var),
         # then strip out the virtualenv bin directory if we're in a virtualenv.
         setup_cmd = 'PATH=`echo -n "$ORIGPATH" | awk -v RS=: -v ORS=: \'!arr[$0]++\'`;' + \
@@ -152,38 +220,47 @@ class DistroImage(BuildFactory):
 
                 tgtenv = merge_env_vars(extra_env)
                 tgtenv["BBMULTICONFIG"] = ' '.join([img.mcname for img in target_images])
-                cmd = util.Interpolate("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s pseudo-native",
-                                       bitbake_options=bitbake_options)
+                logname = 'build_pseudo_native_%s' % imageset.name
+                cmd = bitbake_command("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s pseudo-native",
+                                      'build_pseudo_native', log_reduction, logname)
                 self.addStep(steps.ShellCommand(command=['bash', '-c', cmd], timeout=None,
                                                 env=tgtenv, workdir=util.Property('BUILDDIR'),
                                                 name='build_pseudo_native',
                                                 description="Building",
                                                 descriptionSuffix=["pseudo-native"],
                                                 descriptionDone="Built"))
+                if log_reduction is not None:
+                    self.addSteps(log_reduction.upload_steps(logname))
                 if target_images:
                     tgtenv = merge_env_vars(extra_env)
                     tgtenv["BBMULTICONFIG"] = ' '.join([img.mcname for img in target_images])
                     args = ["mc:{}:{}".format(img.mcname, arg) for img in target_images for arg in img.args]
-                    cmd = util.Interpolate("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s " + ' '.join(args),
-                                           bitbake_options=bitbake_options)
+                    logname = 'build_%s_multiconfig' % imageset.name
+                    cmd = bitbake_command("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s " + ' '.join(args),
+                                          logname, log_reduction)
                     self.addStep(steps.ShellCommand(command=['bash', '-c', cmd], timeout=None,
                                                     env=tgtenv, workdir=util.Property('BUILDDIR'),
-                                                    name='build_%s_multiconfig' % imageset.name,
+                                                    name=logname,
                                                     description="Building",
                                                     descriptionSuffix=[imageset.name, "(multiconfig)"],
                                                     descriptionDone="Built"))
+                    if log_reduction is not None:
+                        self.addSteps(log_reduction.upload_steps(logname))
                 if sdk_images:
                     tgtenv = merge_env_vars(extra_env)
                     tgtenv["BBMULTICONFIG"] = ' '.join([img.mcname for img in sdk_images])
                     args = ["mc:{}:{}".format(img.mcname, arg) for img in sdk_images for arg in img.args]
-                    cmd = util.Interpolate("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s -c populate_sdk " + ' '.join(args),
-                                           bitbake_options=bitbake_options)
+                    logname = 'build_sdk_%s_multiconfig' % imageset.name
+                    cmd = bitbake_command("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s -c populate_sdk " +
+                                          ' '.join(args), logname, log_reduction)
                     self.addStep(steps.ShellCommand(command=['bash', '-c', cmd], timeout=None,
                                                     env=tgtenv, workdir=util.Property('BUILDDIR'),
-                                                    name='build_sdk_%s_multiconfig' % imageset.name,
+                                                    name=logname,
                                                     description="Building",
                                                     descriptionSuffix=["SDK", imageset.name, "(multiconfig)"],
                                                     descriptionDone="Built"))
+                    if log_reduction is not None:
+                        self.addSteps(log_reduction.upload_steps(logname))
             else:
                 for i, img in enumerate(imageset.imagespecs, start=1):
                     tgtenv = merge_env_vars(extra_env)
@@ -195,23 +272,28 @@ class DistroImage(BuildFactory):
                     if img.sdkmachine:
                         tgtenv["SDKMACHINE"] = img.sdkmachine
                     if i == 1:
-                        cmd = util.Interpolate("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s pseudo-native",
-                                               bitbake_options=bitbake_options)
+                        logname = 'build_pseudo_native_%s' % imageset.name
+                        cmd = bitbake_command("%(prop:clean_env_cmd)sbitbake %(kw:bitbake_option)s pseudo-native",
+                                              'build_pseudo_native', log_reduction, logname)
                         self.addStep(steps.ShellCommand(command=['bash', '-c', cmd], timeout=None,
                                                         env=tgtenv, workdir=util.Property('BUILDDIR'),
                                                         name='build_pseudo_native',
                                                         description="Building",
                                                         descriptionSuffix=["pseudo-native"],
                                                         descriptionDone="Built"))
-                    cmd = util.Interpolate("%(prop:clean_env_cmd)s" + bbcmd + " %(kw:bitbake_options)s " +
-                                           ' '.join(img.args),
-                                           bitbake_options=bitbake_options)
+                        if log_reduction is not None:
+                            self.addSteps(log_reduction.upload_steps(logname))
+                    logname = 'build_{}_{}'.format(imageset.name, i)
+                    cmd = bitbake_command("%(prop:clean_env_cmd)s" + bbcmd + " %(kw:bitbake_options)s " +
+                                          ' '.join(img.args), logname, log_reduction)
                     self.addStep(steps.ShellCommand(command=['bash', '-c', cmd], timeout=None,
                                                     env=tgtenv, workdir=util.Property('BUILDDIR'),
-                                                    name='build_{}_{}'.format(imageset.name, i),
+                                                    name=logname,
                                                     description="Building",
                                                     descriptionSuffix=[imageset.name, img.name],
                                                     descriptionDone="Built"))
+                    if log_reduction is not None:
+                        self.addSteps(log_reduction.upload_steps(logname))
 
             self.addStep(steps.ShellCommand(command=store_artifacts_cmd, workdir=util.Property('BUILDDIR'),
                                             name='StoreArtifacts_{}'.format(imageset.name), timeout=None,
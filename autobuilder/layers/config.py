@@ -9,6 +9,7 @@ from autobuilder.abconfig import AutobuilderForceScheduler, AutobuilderConfig
 from autobuilder.github.handler import layer_pr_filter
 from autobuilder.factory.layer import CheckLayer
 from autobuilder.factory.base import delete_env_vars
+from autobuilder.collapse import collapse_requests
 from autobuilder.workers.ec2 import nextEC2Worker
 
 
@@ -85,6 +86,8 @@ class Layer(object):
                 BuilderConfig(name=self.name + '-checklayer',
                               workernames=workernames,
                               nextWorker=nextEC2Worker,
+                              collapseRequests=collapse_requests,
+                              nextBuild=abcfg.prioritizer.next_build,
                               properties=dict(project=self.name, repourl=repo.uri, autobuilder=self.abconfig,
                                               extraconf=self.extra_config or [],
                                               oe_core_branch=self.oe_core_branch or '',
@@ -1,26 +1,111 @@
-import os
+import collections
+import time
 from buildbot.reporters.message import MessageFormatter, get_detected_status_text
 from twisted.internet import defer
 from twisted.python import log
-import jinja2
+from twisted.python.failure import Failure
+from autobuilder.templating import read_template, string_template
+
+# Number of sourcestamp change lookups run at the same time
+LOOKUP_CONCURRENCY = 8
+# Number of buildsets whose changes are remembered
+MEMO_SIZE = 64
+# Changes (and files per change) included in notifications
+MAX_CHANGES = 100
+MAX_FILES = 50
+
+
+class ChangeLookup(object):
+    """
+    Looks up the changes for a buildset's sourcestamps for notification
+    rendering. Lookups for the sourcestamps are made concurrently (at most
+    concurrency at a time), and the result is remembered for the size most
+    recently used buildsets, since every reporter renders every build of a
+    buildset. Lookups for a buildset that are already in progress are
+    shared. At most max_changes changes, each listing at most max_files
+    files, are returned; the number of changes left out is returned with
+    them.
+    """
+    def __init__(self, concurrency=LOOKUP_CONCURRENCY, size=MEMO_SIZE, max_changes=MAX_CHANGES,
+                 max_files=MAX_FILES):
+        self.size = size
+        self.max_changes = max_changes
+        self.max_files = max_files
+        self._sem = defer.DeferredSemaphore(concurrency)
+        self._memo = collections.OrderedDict()
+        self._inflight = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _trim(self, changes):
+        omitted = max(len(changes) - self.max_changes, 0)
+        trimmed = []
+        for change in changes[:self.max_changes]:
+            files = change.get('files') or []
+            if len(files) > self.max_files:
+                change = dict(change)
+                change['files'] = files[:self.max_files] + [
+                    '... and {} more files'.format(len(files) - self.max_files)]
+            trimmed.append(change)
+        return trimmed, omitted
+
+    @defer.inlineCallbacks
+    def _lookup(self, master, ssids):
+        started = time.time()
+        results = yield defer.gatherResults(
+            [self._sem.run(master.data.get, ("sourcestamps", ssid, "changes")) for ssid in ssids],
+            consumeErrors=True)
+        changelist = []
+        for changes in results:
+            changelist += changes or []
+        result = self._trim(changelist)
+        log.msg('ChangeLookup: {} changes for {} sourcestamps in {:.3f}s'.format(
+            len(changelist), len(ssids), time.time() - started))
+        return result
+
+    def lookup(self, master, sslist):
+        """
+        Returns a Deferred firing with (changes, omitted) for the given
+        list of sourcestamp dicts.
+        """
+        key = tuple(ss['ssid'] for ss in sslist)
+        if key in self._memo:
+            self.hits += 1
+            self._memo.move_to_end(key)
+            return defer.succeed(self._memo[key])
+        self.misses += 1
+        waiter = defer.Deferred()
+        if key not in self._inflight:
+            self._inflight[key] = []
+            d = self._lookup(master, key)
+
+            def done(result):
+                if not isinstance(result, Failure):
+                    self._memo[key] = result
+                    while len(self._memo) > self.size:
+                        self._memo.popitem(last=False)
+                for w in self._inflight.pop(key):
+                    if isinstance(result, Failure):
+                        w.errback(result)
+                    else:
+                        w.callback(result)
+            d.addBoth(done)
+        self._inflight[key].append(waiter)
+        return waiter
+
+
+CHANGE_LOOKUP = ChangeLookup()
 
 
 @defer.inlineCallbacks
 def getChangesForSourceStamps(master, sslist):
-    log.msg("getChangesForSourceStamps: sslist=%s" % sslist)
-    changelist = []
-    for ss in sslist:
-        changes = yield master.data.get(("sourcestamps", ss['ssid'], "changes"))
-        changelist += changes
-    defer.returnValue(changelist)
+    changes, _ = yield CHANGE_LOOKUP.lookup(master, sslist)
+    defer.returnValue(changes)
 
 
 class AutobuilderMessageTemplate(object):
     def __init__(self, template_filename, template_dir=None):
-        if template_dir is None:
-            template_dir = os.path.join(os.path.dirname(__file__), "templates")
-        with open(os.path.join(template_dir, template_filename), "r") as f:
-            self.template = f.read()
+        self.template = read_template(template_filename, template_dir)
 
 
 # noinspection PyPep8Naming
@@ -33,6 +118,7 @@ class AutobuilderMessageFormatter(MessageFormatter):
 
     @defer.inlineCallbacks
     def render_message_dict(self, master, context):
+        started = time.time()
         yield self.buildAdditionalContext(master, context)
         context.update(self.context)
         body, subject, extra_info = yield defer.gatherResults(
@@ -51,20 +137,25 @@ class AutobuilderMessageFormatter(MessageFormatter):
         }
         if 'changes' not in context:
             context['changes'] = []
+            context['changes_omitted'] = 0
         if self.summary_template is not None:
-            summary = jinja2.Template(self.summary_template).render(context)
+            summary = string_template(self.summary_template).render(context)
             if msgdict['body'] is None:
                 msgdict['body'] = summary
             else:
                 msgdict['body'] += summary
+        log.msg('{}: rendered message for buildset {} in {:.3f}s'.format(
+            self.__class__.__name__, context['buildset'].get('bsid'), time.time() - started))
         return msgdict
 
     @defer.inlineCallbacks
     def buildAdditionalContext(self, master, context):
         context.update(self.context)
         if context['sourcestamps']:
-            context['changes'] = yield getChangesForSourceStamps(master, context['buildset']['sourcestamps'])
+            context['changes'], context['changes_omitted'] = yield CHANGE_LOOKUP.lookup(
+                master, context['buildset']['sourcestamps'])
         else:
             context['changes'] = []
+            context['changes_omitted'] = 0
         context['buildset_status_detected'] = get_detected_status_text(context['mode'],
                                                                        context['buildset']['results'], None)
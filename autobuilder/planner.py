@@ -0,0 +1,153 @@
+import math
+
+from twisted.python import log
+
+from autobuilder.workers.profiles import load_expected_durations
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+
+class WeeklySlot(object):
+    """
+    Start time of a scheduled build; dayOfWeek (0 is Monday) is None for
+    nightly builds.
+    """
+    def __init__(self, day, hour, minute):
+        self.dayOfWeek = day
+        self.hour = hour
+        self.minute = minute
+
+    def __repr__(self):
+        if self.dayOfWeek is None:
+            return 'daily {:02d}:{:02d}'.format(self.hour, self.minute)
+        return 'day {} {:02d}:{:02d}'.format(self.dayOfWeek, self.hour, self.minute)
+
+
+class PlannedBuild(object):
+    def __init__(self, name, builder_names, duration, nightly):
+        self.name = name
+        self.builder_names = builder_names
+        self.duration = duration
+        self.nightly = nightly
+        self.start = None
+
+
+class BuildPlanner(object):
+    """
+    Chooses start times for the distros' weekly and nightly builds.
+
+    Each scheduled build occupies one worker per builder it triggers, for
+    the expected duration of its longest builder: the median duration
+    recorded by BuildProfiles (read from its saved file at durations_path
+    when the configuration is loaded), or default_duration seconds for
+    builders with no history. Nightly builds are placed first, as they
+    recur every day, then weekly builds, largest (duration times number of
+    builders) first. Each build gets the start time in its window, on a
+    granularity-minute grid, that keeps the peak number of busy workers
+    lowest while still finishing by the end of the window, with ties going
+    to the earliest start.
+
+    The weekly window starts at weekly_start (day of week, 0 being Monday,
+    hour, minute) and lasts weekly_hours; the nightly window starts at
+    nightly_start (hour, minute) each day and lasts nightly_hours. The pool
+    size is workers, or the number of workers in the autobuilder
+    configuration; a warning is logged if the plan needs more, or a build
+    cannot finish within its window.
+
+    The plan depends only on the configuration and the saved durations,
+    so it is the same each time the configuration is loaded with them.
+    """
+    def __init__(self, weekly_start=(5, 0, 0), weekly_hours=48, nightly_start=(0, 0), nightly_hours=8,
+                 workers=None, durations_path=None, default_duration=4 * 3600, granularity=15):
+        if not 0 < weekly_hours <= 7 * 24:
+            raise ValueError('weekly_hours must be between 0 and 168')
+        if not 0 < nightly_hours <= 24:
+            raise ValueError('nightly_hours must be between 0 and 24')
+        if granularity < 1 or MINUTES_PER_DAY % granularity:
+            raise ValueError('granularity must be a positive number of minutes dividing a day')
+        if workers is not None and workers < 1:
+            raise ValueError('workers must be at least 1')
+        day, hour, minute = weekly_start
+        self.weekly_start = day * MINUTES_PER_DAY + hour * 60 + minute
+        self.weekly_minutes = weekly_hours * 60
+        hour, minute = nightly_start
+        self.nightly_start = hour * 60 + minute
+        self.nightly_minutes = nightly_hours * 60
+        self.workers = workers
+        self.durations_path = durations_path
+        self.default_duration = default_duration
+        self.granularity = granularity
+        self._plans = {}
+
+    def _builds(self, abcfg):
+        durations = load_expected_durations(self.durations_path) if self.durations_path else {}
+        builds = []
+        for distro in abcfg.distros:
+            builder_names = distro.builder_names
+            duration = max(durations.get(name, self.default_duration) for name in builder_names)
+            if distro.nightly_type is not None:
+                builds.append(PlannedBuild(distro.name + '-nightly', builder_names, duration, True))
+            if distro.weekly_type is not None:
+                builds.append(PlannedBuild(distro.name + '-weekly', builder_names, duration, False))
+        return builds
+
+    def _occupied(self, build, start):
+        """
+        Returns the grid slots (of the week) the build occupies when
+        started at the given minute.
+        """
+        length = max(int(math.ceil(build.duration / 60 / self.granularity)), 1)
+        first = start // self.granularity
+        slots_per_week = MINUTES_PER_WEEK // self.granularity
+        runs = [first + day * MINUTES_PER_DAY // self.granularity for day in range(7)] if build.nightly else [first]
+        return [(run + i) % slots_per_week for run in runs for i in range(length)]
+
+    def _candidates(self, build):
+        if build.nightly:
+            window_start, window = self.nightly_start, self.nightly_minutes
+        else:
+            window_start, window = self.weekly_start, self.weekly_minutes
+        latest = window - build.duration / 60
+        if latest < 0:
+            log.msg('BuildPlanner: {} ({:.0f}s) cannot finish within its window'.format(
+                build.name, build.duration))
+            latest = 0
+        return [(window_start + offset) % MINUTES_PER_WEEK
+                for offset in range(0, int(latest) + 1, self.granularity)]
+
+    def plan(self, abcfg):
+        """
+        Returns a dict mapping scheduler name (distro name plus -weekly or
+        -nightly) to its WeeklySlot, computing the plan on first use.
+        """
+        if abcfg.name in self._plans:
+            return self._plans[abcfg.name]
+        workers = self.workers or len(abcfg.worker_names)
+        usage = [0] * (MINUTES_PER_WEEK // self.granularity)
+        builds = self._builds(abcfg)
+        builds.sort(key=lambda b: (not b.nightly, -b.duration * len(b.builder_names), b.name))
+        for build in builds:
+            width = len(build.builder_names)
+            best = None
+            for start in self._candidates(build):
+                peak = max(usage[slot] for slot in self._occupied(build, start)) + width
+                if best is None or peak < best[0]:
+                    best = (peak, start)
+            build.start = best[1]
+            for slot in self._occupied(build, build.start):
+                usage[slot] += width
+        peak = max(usage)
+        if peak > workers:
+            log.msg('BuildPlanner: scheduled builds need up to {} workers, {} available'.format(peak, workers))
+        plan = self._plans[abcfg.name] = {}
+        for build in builds:
+            day, minute = divmod(build.start, MINUTES_PER_DAY)
+            slot = WeeklySlot(None if build.nightly else day, minute // 60, minute % 60)
+            plan[build.name] = slot
+            log.msg('BuildPlanner: {} at {} ({:.0f}s, {} builders)'.format(
+                build.name, slot, build.duration, len(build.builder_names)))
+        return plan
+
+    def slot(self, abcfg, name):
+        return self.plan(abcfg)[name]
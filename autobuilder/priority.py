@@ -0,0 +1,146 @@
+import time
+
+from buildbot.data import resultspec
+from twisted.internet import defer
+from twisted.python import log
+
+from autobuilder.utils import timestamp
+
+# Buildset properties used for scoring, cached per buildset
+SCORE_PROPERTIES = ('pullrequest', 'scheduler', 'fanout_scheduler', 'buildtype')
+
+
+class BuildPrioritizer(object):
+    """
+    Orders pending build requests and builders. Each request gets a score,
+    in minutes: the weight for its kind (pull request, forced, push, or
+    scheduled weekly/nightly build), plus the weight for its buildtype in
+    buildtype_weights, if any, plus the request's own priority, plus aging
+    times the minutes it has been waiting, so that low-priority requests
+    are not starved.
+
+    next_build() (used as nextBuild for distro and layer builders) picks
+    a builder's request with the highest score, the oldest first on ties.
+    prioritize_builders() (set c['prioritizeBuilders'] in the master
+    configuration to AutobuilderConfig.prioritize_builders) orders
+    builders by their best pending request, taking builders from each
+    project in turn, so that a project with many builders or requests
+    does not get all free workers first; ties go to the project whose
+    last build started longest ago.
+
+    The buildset properties used for scoring are fetched once per
+    buildset, when the buildset is added (or, for buildsets added before
+    the prioritizer first ran, when first seen), and kept until the
+    buildset completes.
+    """
+    def __init__(self, pullrequest=60, force=30, push=0, scheduled=-60, buildtype_weights=None, aging=1.0):
+        if aging < 0:
+            raise ValueError('aging must not be negative')
+        self.kind_weights = {'pullrequest': pullrequest, 'force': force, 'push': push, 'scheduled': scheduled}
+        self.buildtype_weights = buildtype_weights or {}
+        self.aging = aging
+        self._served = {}
+        self._projects = {}
+        self._bsprops = {}
+        self._master = None
+
+    @staticmethod
+    def kind(props):
+        """
+        Returns the kind of a request, from a function returning the value
+        of a buildset property (or None). For builds triggered by a source
+        fan-out, the kind is that of the checkout build.
+        """
+        if props('pullrequest'):
+            return 'pullrequest'
+        scheduler = props('fanout_scheduler') or props('scheduler') or ''
+        if scheduler.endswith('-force'):
+            return 'force'
+        if scheduler.endswith('-weekly') or scheduler.endswith('-nightly'):
+            return 'scheduled'
+        return 'push'
+
+    def score(self, props, submitted_at, priority=0, now=None):
+        now = now or time.time()
+        waited = max(now - (timestamp(submitted_at) or now), 0) / 60
+        return (self.kind_weights[self.kind(props)] + self.buildtype_weights.get(props('buildtype'), 0) +
+                (priority or 0) + self.aging * waited)
+
+    @staticmethod
+    def _project(builder):
+        return builder.config.properties.get('project', builder.name)
+
+    @defer.inlineCallbacks
+    def _start_consuming(self, master):
+        if self._master is master:
+            return
+        self._master = master
+        self._bsprops = {}
+        yield defer.gatherResults([
+            master.mq.startConsuming(self._buildset_new, ('buildsets', None, 'new')),
+            master.mq.startConsuming(self._buildset_complete, ('buildsets', None, 'complete')),
+            master.mq.startConsuming(self._build_update, ('builds', None, 'update'))], consumeErrors=True)
+
+    @defer.inlineCallbacks
+    def _fetch_bsprops(self, master, bsid):
+        props = yield master.data.get(('buildsets', str(bsid), 'properties'))
+        props = props or {}
+        self._bsprops[bsid] = {name: props[name][0] for name in SCORE_PROPERTIES if name in props}
+        return self._bsprops[bsid]
+
+    def _buildset_new(self, key, buildset):
+        d = self._fetch_bsprops(self._master, buildset['bsid'])
+        d.addErrback(log.err, 'BuildPrioritizer: could not fetch properties of buildset {}'.format(buildset['bsid']))
+
+    def _buildset_complete(self, key, buildset):
+        self._bsprops.pop(buildset['bsid'], None)
+
+    def _build_update(self, key, build):
+        # A build's state string is set to 'building' when it starts its steps
+        if build.get('state_string') == 'building' and build['builderid'] in self._projects:
+            self._served[self._projects[build['builderid']]] = time.time()
+
+    @defer.inlineCallbacks
+    def next_build(self, builder, requests):
+        if not requests:
+            return None
+        yield self._start_consuming(builder.master)
+        builderid = yield builder.getBuilderId()
+        self._projects[builderid] = self._project(builder)
+        now = time.time()
+
+        def key(req):
+            return (-self.score(req.properties.getProperty, req.submittedAt, req.priority, now),
+                    req.submittedAt or 0, req.id)
+        return min(requests, key=key)
+
+    @defer.inlineCallbacks
+    def prioritize_builders(self, master, builders):
+        yield self._start_consuming(master)
+        now = time.time()
+        brdicts = yield master.data.get(('buildrequests',),
+                                        filters=[resultspec.Filter('claimed', 'eq', [False])])
+        missing = sorted({brdict['buildsetid'] for brdict in brdicts} - set(self._bsprops))
+        yield defer.gatherResults([self._fetch_bsprops(master, bsid) for bsid in missing], consumeErrors=True)
+        best = {}
+        for brdict in brdicts:
+            props = self._bsprops.get(brdict['buildsetid'], {})
+            score = self.score(props.get, brdict['submitted_at'], brdict.get('priority'), now)
+            builderid = brdict['builderid']
+            best[builderid] = max(best.get(builderid, score), score)
+
+        builderids = yield defer.gatherResults([builder.getBuilderId() for builder in builders],
+                                               consumeErrors=True)
+        for builderid, builder in zip(builderids, builders):
+            self._projects[builderid] = self._project(builder)
+        scored = [(best.get(builderid, float('-inf')), builder) for builderid, builder in zip(builderids, builders)]
+        scored.sort(key=lambda x: (-x[0], x[1].name))
+        rounds = {}
+        ordered = []
+        for score, builder in scored:
+            project = self._project(builder)
+            turn = rounds.get(project, 0)
+            rounds[project] = turn + 1
+            ordered.append((turn, -score, self._served.get(project, 0), builder.name, builder))
+        ordered.sort(key=lambda x: x[:4])
+        return [x[4] for x in ordered]
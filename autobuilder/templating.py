@@ -0,0 +1,150 @@
+"""
+Shared Jinja environments for the notification and cloud-init userdata
+templates.
+
+Each template directory gets one environment, which keeps compiled
+templates in memory (recompiling a template only when its file changes),
+so that rendering userdata for every worker, or a notification for every
+build, does not recompile the template each time. Templates given as
+strings (such as the notification summary) are compiled once per distinct
+source, keyed by a hash of the source.
+
+Compiled templates can also be kept on disk, so that a restarted master
+does not have to compile them again, by calling enable_bytecode_cache()
+or setting AUTOBUILDER_TEMPLATE_CACHE to a directory. Jinja checks the
+template source's hash before using cached bytecode.
+
+Usage (benchmark):
+    python -m autobuilder.templating [--iterations N]
+"""
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import timeit
+
+import jinja2
+
+DEFAULT_TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
+# Number of compiled string templates kept in memory
+STRING_CACHE_SIZE = 64
+
+_lock = threading.Lock()
+_environments = {}
+_string_templates = {}
+_sources = {}
+_bytecode_cache = None
+
+
+def enable_bytecode_cache(directory):
+    """
+    Keeps compiled templates in the given directory, for all template
+    environments.
+    """
+    global _bytecode_cache
+    os.makedirs(directory, exist_ok=True)
+    with _lock:
+        _bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+        for env in _environments.values():
+            env.bytecode_cache = _bytecode_cache
+
+
+def get_environment(template_dir=None):
+    """
+    Returns the shared environment (with StrictUndefined) for the templates
+    in template_dir, the package's templates directory by default.
+    """
+    template_dir = os.path.abspath(template_dir or DEFAULT_TEMPLATE_DIR)
+    with _lock:
+        env = _environments.get(template_dir)
+        if env is None:
+            env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
+                                     undefined=jinja2.StrictUndefined,
+                                     bytecode_cache=_bytecode_cache)
+            _environments[template_dir] = env
+        return env
+
+
+def render_template(template_file, ctx, template_dir=None):
+    return get_environment(template_dir).get_template(template_file).render(ctx)
+
+
+def read_template(template_file, template_dir=None):
+    """
+    Returns the source of a template file, which is read again only when
+    the file changes.
+    """
+    path = os.path.join(os.path.abspath(template_dir or DEFAULT_TEMPLATE_DIR), template_file)
+    mtime = os.path.getmtime(path)
+    with _lock:
+        entry = _sources.get(path)
+    if entry is None or entry[0] != mtime:
+        with open(path, "r") as f:
+            entry = (mtime, f.read())
+        with _lock:
+            _sources[path] = entry
+    return entry[1]
+
+
+def string_template(source):
+    """
+    Returns the compiled template for the given source. Like
+    jinja2.Template(source), undefined variables render as empty.
+    """
+    key = hashlib.sha256(source.encode('utf-8')).hexdigest()
+    with _lock:
+        template = _string_templates.get(key)
+    if template is None:
+        template = jinja2.Template(source)
+        with _lock:
+            if len(_string_templates) >= STRING_CACHE_SIZE:
+                _string_templates.pop(next(iter(_string_templates)))
+            _string_templates[key] = template
+    return template
+
+
+def _benchmark_contexts():
+    from autobuilder.workers.storage import StorageProfile
+    changes = [{'revlink': 'https://example.com/commit/{}'.format(i), 'author': 'Some Developer',
+                'comments': 'Change {}\n\nDetails.'.format(i),
+                'files': ['recipes/file{}.bb'.format(j) for j in range(10)]} for i in range(20)]
+    userdata = {'workername': 'worker', 'workersecret': 'secret', 'master_ip': '10.0.0.1',
+                'master_hostname': 'master', 'master_fqdn': 'master.example.com',
+                'extra_packages': [], 'extra_cmds': [], 'warm_pool': False, 'image_build': False,
+                'storage': StorageProfile('ebs+nvme', tmpfs_min_memory=128).template_context()}
+    return {'changes': changes, 'changes_omitted': 0}, userdata
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark template rendering')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--template', default='cloud-init-noble.txt', help='userdata template')
+    args = parser.parse_args()
+    summary_ctx, userdata_ctx = _benchmark_contexts()
+    summary = read_template('default_summary.txt')
+
+    def uncached_userdata():
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(DEFAULT_TEMPLATE_DIR),
+                                 undefined=jinja2.StrictUndefined)
+        return env.get_template(args.template).render(userdata_ctx)
+
+    cases = [
+        ('summary, compiled per render', lambda: jinja2.Template(summary).render(summary_ctx)),
+        ('summary, cached', lambda: string_template(summary).render(summary_ctx)),
+        ('{}, new environment'.format(args.template), uncached_userdata),
+        ('{}, shared environment'.format(args.template),
+         lambda: render_template(args.template, userdata_ctx)),
+    ]
+    for name, f in cases:
+        elapsed = timeit.timeit(f, number=args.iterations)
+        print('{:<45} {:8.3f} ms/render'.format(name, elapsed * 1000 / args.iterations))
+    return 0
+
+
+if os.environ.get('AUTOBUILDER_TEMPLATE_CACHE'):
+    enable_bytecode_cache(os.environ['AUTOBUILDER_TEMPLATE_CACHE'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import datetime
+
+
+def timestamp(value):
+    """
+    Converts a time, given as a datetime (as the data API returns them) or
+    already as seconds since the epoch, to seconds since the epoch.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    return value
@@ -0,0 +1,114 @@
+"""
+Tooling for baking worker AMIs.
+
+The cloud-init templates do most of their work (package installation,
+user creation, buildworker-setup installation) on every worker boot.
+Rendering a template with image_build set produces an image-build recipe:
+userdata that does only that static work, then cleans up cloud-init state
+and powers the instance off. bake_ami() runs the recipe on a base AMI and
+creates a new AMI from the result, which workers can then use via
+EC2Params(baked_ami=...) together with the slim cloud-init-fastboot.txt
+template.
+
+Usage:
+    python -m autobuilder.workers.ami render [--template FILE] [--output FILE]
+    python -m autobuilder.workers.ami bake --region R --base-ami AMI --subnet S ...
+"""
+import argparse
+import sys
+import time
+
+import boto3
+from twisted.python import log
+
+from autobuilder.templating import render_template
+
+
+def render_image_recipe(template_file='cloud-init-noble.txt', template_dir=None, extra_packages=None):
+    ctx = {'image_build': True,
+           'warm_pool': False,
+           'extra_packages': extra_packages or [],
+           'extra_cmds': []}
+    return render_template(template_file, ctx, template_dir)
+
+
+def bake_ami(session, base_ami, instance_type, subnet_id, secgroup_ids, name,
+             template_file='cloud-init-noble.txt', template_dir=None, extra_packages=None,
+             instance_profile_name=None, keypair=None, timeout=60 * 60):
+    """
+    Launches an instance of base_ami with the image-build recipe as its
+    userdata, waits for the recipe to finish and power the instance off,
+    and creates an AMI from it. Returns the new AMI's ID.
+    """
+    ec2 = session.resource('ec2')
+    userdata = render_image_recipe(template_file, template_dir, extra_packages)
+    launch_opts = dict(
+        ImageId=base_ami, InstanceType=instance_type, KeyName=keypair,
+        MinCount=1, MaxCount=1, UserData=userdata,
+        InstanceInitiatedShutdownBehavior='stop',
+        NetworkInterfaces=[{'AssociatePublicIpAddress': True,
+                            'DeviceIndex': 0,
+                            'Groups': secgroup_ids,
+                            'SubnetId': subnet_id}],
+        IamInstanceProfile={'Name': instance_profile_name} if instance_profile_name else None,
+        TagSpecifications=[{'ResourceType': 'instance',
+                            'Tags': [{'Key': 'Name', 'Value': name + '-bake'}]}]
+    )
+    started = time.time()
+    instance = ec2.create_instances(**{k: v for k, v in launch_opts.items() if v is not None})[0]
+    log.msg('bake_ami: launched {} from {} using {}'.format(instance.id, base_ami, template_file))
+    try:
+        instance.wait_until_running()
+        instance.wait_until_stopped(WaiterConfig={'Delay': 15, 'MaxAttempts': max(timeout // 15, 1)})
+        log.msg('bake_ami: image build on {} finished after {:.0f}s'.format(instance.id, time.time() - started))
+        image = instance.create_image(Name=name, Description='Autobuilder worker image from {} ({})'.format(
+            base_ami, template_file))
+        ec2.meta.client.get_waiter('image_available').wait(ImageIds=[image.id],
+                                                           WaiterConfig={'Delay': 15, 'MaxAttempts': 240})
+        log.msg('bake_ami: created {} after {:.0f}s'.format(image.id, time.time() - started))
+        return image.id
+    finally:
+        instance.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render or bake autobuilder worker images')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    render = subparsers.add_parser('render', help='render the image-build recipe')
+    bake = subparsers.add_parser('bake', help='bake an AMI using the image-build recipe')
+    for p in (render, bake):
+        p.add_argument('--template', default='cloud-init-noble.txt', help='cloud-init template file name')
+        p.add_argument('--template-dir', default=None, help='directory containing the template')
+        p.add_argument('--extra-package', action='append', default=[], help='additional package to install')
+    render.add_argument('--output', default=None, help='output file (default stdout)')
+    bake.add_argument('--region', required=True)
+    bake.add_argument('--base-ami', required=True)
+    bake.add_argument('--instance-type', default='m5.large')
+    bake.add_argument('--subnet', required=True)
+    bake.add_argument('--secgroup', action='append', required=True)
+    bake.add_argument('--name', required=True, help='name for the new AMI')
+    bake.add_argument('--instance-profile', default=None)
+    bake.add_argument('--keypair', default=None)
+    args = parser.parse_args()
+
+    if args.command == 'render':
+        recipe = render_image_recipe(args.template, args.template_dir, args.extra_package)
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(recipe)
+        else:
+            sys.stdout.write(recipe)
+        return 0
+
+    log.startLogging(sys.stderr)
+    ami = bake_ami(boto3.Session(region_name=args.region), args.base_ami, args.instance_type,
+                   args.subnet, args.secgroup, args.name,
+                   template_file=args.template, template_dir=args.template_dir,
+                   extra_packages=args.extra_package, instance_profile_name=args.instance_profile,
+                   keypair=args.keypair)
+    print(ami)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import boto3
+from botocore.client import ClientError
+from twisted.python import log
+
+_lock = threading.Lock()
+SESSIONS = {}
+CLIENTS = {}
+
+
+def get_session(region, identifier=None, secret_identifier=None):
+    """
+    Returns the boto3 session shared by all workers using the given region
+    and credentials, creating it on first use.
+    """
+    key = (region, identifier, secret_identifier)
+    with _lock:
+        session = SESSIONS.get(key)
+        if session is None:
+            session = boto3.Session(region_name=region,
+                                    aws_access_key_id=identifier,
+                                    aws_secret_access_key=secret_identifier)
+            if region not in session.get_available_regions('ec2'):
+                raise ValueError('The specified region does not exist: ' + region)
+            SESSIONS[key] = session
+        return session
+
+
+def get_client(session, service_name='ec2'):
+    """
+    Returns a client for the service shared by all users of the session.
+    Clients (unlike resources) are thread-safe, so one per session is enough.
+    """
+    key = (id(session), service_name)
+    with _lock:
+        client = CLIENTS.get(key)
+        if client is None:
+            client = session.client(service_name)
+            CLIENTS[key] = client
+        return client
+
+
+class MetadataCache(object):
+    """
+    Cache of slowly-changing EC2 metadata looked up when workers are
+    configured: key pair existence, subnet availability zones, the AMI
+    chosen by owner/location filters, and elastic IP allocation IDs.
+    Entries expire after ttl seconds, so a reconfig after that picks up
+    changes, while constructing many workers in one reconfig makes one
+    API call per distinct resource (one in total for the subnets of a
+    worker).
+    """
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def _put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+        return value
+
+    def invalidate(self, kind=None):
+        with self._lock:
+            if kind is None:
+                self._entries.clear()
+            else:
+                for key in [k for k in self._entries if k[0] == kind]:
+                    del self._entries[key]
+
+    def ensure_keypair(self, client, name):
+        """
+        Makes sure the named key pair exists, creating it if needed.
+        """
+        key = ('keypair', client.meta.region_name, name)
+        found, _ = self._get(key)
+        if found:
+            return
+        try:
+            client.describe_key_pairs(KeyNames=[name])
+        except ClientError as e:
+            if 'InvalidKeyPair.NotFound' not in str(e):
+                if 'AuthFailure' in str(e):
+                    log.msg('POSSIBLE CAUSES OF ERROR:\n'
+                            '  Did you supply your AWS credentials?\n'
+                            '  Did you sign up for EC2?\n'
+                            '  Did you put a credit card number in your AWS '
+                            'account?\n'
+                            'Please doublecheck before reporting a problem.\n')
+                raise
+            # We discard the key material; the key pair is never used to log in
+            client.create_key_pair(KeyName=name)
+        self._put(key, True)
+
+    def subnet_zones(self, client, subnet_ids):
+        """
+        Returns a dict mapping each subnet ID to its availability zone.
+        """
+        region = client.meta.region_name
+        result = {}
+        missing = []
+        for subnet_id in subnet_ids:
+            found, zone = self._get(('subnet', region, subnet_id))
+            if found:
+                result[subnet_id] = zone
+            else:
+                missing.append(subnet_id)
+        if missing:
+            for subnet in client.describe_subnets(SubnetIds=missing)['Subnets']:
+                result[subnet['SubnetId']] = self._put(('subnet', region, subnet['SubnetId']),
+                                                       subnet['AvailabilityZone'])
+        return result
+
+    def image_id(self, client, owners, location_regex, choose):
+        """
+        Returns the ID of the image chosen by choose() for the given owners and
+        location regex, calling choose() only on a cache miss.
+        """
+        key = ('image', client.meta.region_name, tuple(owners or ()),
+               location_regex.pattern if location_regex is not None else None)
+        found, image_id = self._get(key)
+        if found:
+            return image_id
+        return self._put(key, choose())
+
+    def elastic_ip_allocation(self, client, public_ip):
+        """
+        Returns the allocation ID of the elastic IP address, or None if the
+        address does not exist.
+        """
+        key = ('eip', client.meta.region_name, public_ip)
+        found, allocation_id = self._get(key)
+        if found:
+            return allocation_id
+        addresses = client.describe_addresses(PublicIps=[public_ip])['Addresses']
+        if not addresses:
+            return None
+        return self._put(key, addresses[0]['AllocationId'])
+
+
+METADATA = MetadataCache()
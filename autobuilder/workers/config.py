@@ -1,11 +1,13 @@
+import base64
 import os
 import socket
 import string
 from random import SystemRandom
 
-import jinja2
 from buildbot.plugins import worker
+from autobuilder.templating import get_environment
 from autobuilder.workers.ec2 import MyEC2LatentWorker
+from autobuilder.workers.storage import StorageProfile, get_storage_profile
 
 RNG = SystemRandom()
 default_svp = {'name': '/dev/xvdf', 'size': 200,
@@ -31,7 +33,12 @@ class EC2Params(object):
                  instance_profile_name=None, spot_instance=False,
                  max_spot_price=None, price_multiplier=None,
                  instance_types=None, build_wait_timeout=None,
-                 subnets=None, missing_timeout=None):
+                 subnets=None, missing_timeout=None,
+                 spot_parallel_requests=None, fleet=None,
+                 spot_price_estimator='mean', warm_pool=None,
+                 baked_ami=None, type_selector=None, state_poll_interval=None,
+                 spot_notice_url=None, sstate_push_cmd=None, sstate_push_timeout=90,
+                 storage_profile=None, regions=None):
         self.instance_type = instance_type
         self.instance_types = instance_types
         self.ami = ami
@@ -51,9 +58,15 @@ class EC2Params(object):
         else:
             self.build_wait_timeout = 0 if spot_instance else 300
         if scratchvol:
+            if storage_profile is not None:
+                raise ValueError('Specify only one of scratchvol, storage_profile')
             self.scratchvolparams = scratchvol_params or default_svp
         else:
             self.scratchvolparams = None
+        if storage_profile is not None:
+            self.storage = get_storage_profile(storage_profile)
+        else:
+            self.storage = StorageProfile.from_scratchvol(self.scratchvolparams)
         self.instance_profile_name = instance_profile_name
         self.spot_instance = spot_instance
         if self.spot_instance:
@@ -76,16 +89,55 @@ class EC2Params(object):
                 self.subnet = None
             elif not subnets:
                 raise ValueError('Missing subnets for spot instance worker config')
+            if spot_parallel_requests is not None and spot_parallel_requests < 1:
+                raise ValueError('spot_parallel_requests must be at least 1')
+        elif fleet is not None:
+            if instance_type and instance_types:
+                raise ValueError('Specify only one of instance_type, instance_types for fleet workers')
+            if not instance_type and not instance_types:
+                raise ValueError('Missing instance_type or instance_types for fleet worker config')
+            if subnet and subnets:
+                raise ValueError('Specify only one of subnet, subnets for fleet workers')
         else:
             if instance_types:
-                raise ValueError('instance_types only valid for spot instance worker configs')
+                raise ValueError('instance_types only valid for spot instance or fleet worker configs')
             if subnets:
-                raise ValueError('subnets only valid for spot instance worker configs')
+                raise ValueError('subnets only valid for spot instance or fleet worker configs')
             if not instance_type:
                 raise ValueError('Invalid instance_type')
+        if spot_parallel_requests and not spot_instance:
+            raise ValueError('spot_parallel_requests only valid for spot instance worker configs')
+        if warm_pool is not None and spot_instance:
+            raise ValueError('warm_pool only valid for on-demand worker configs')
+        if type_selector is not None and not spot_instance and fleet is None:
+            raise ValueError('type_selector only valid for spot instance or fleet worker configs')
+        if sstate_push_cmd and not (spot_instance and spot_notice_url):
+            raise ValueError('sstate_push_cmd requires spot_instance and spot_notice_url')
+        if regions:
+            if elastic_ip:
+                raise ValueError('elastic_ip not valid with spillover regions')
+            for spec in regions:
+                if not spot_instance and fleet is None and len(spec.subnets) != 1:
+                    raise ValueError('Region {}: specify a single subnet for on-demand workers'.format(spec.region))
+                if spec.instance_types and not spot_instance and fleet is None:
+                    raise ValueError('Region {}: instance_types only valid for spot instance or fleet '
+                                     'worker configs'.format(spec.region))
+                if not (spec.baked_ami if baked_ami else spec.ami):
+                    raise ValueError('Region {}: missing {}'.format(spec.region, 'baked_ami' if baked_ami else 'ami'))
 
         self.max_spot_price = max_spot_price
         self.price_multiplier = price_multiplier
+        self.spot_parallel_requests = spot_parallel_requests
+        self.fleet = fleet
+        self.spot_price_estimator = spot_price_estimator
+        self.warm_pool = warm_pool
+        self.baked_ami = baked_ami
+        self.type_selector = type_selector
+        self.state_poll_interval = state_poll_interval
+        self.spot_notice_url = spot_notice_url
+        self.sstate_push_cmd = sstate_push_cmd
+        self.sstate_push_timeout = sstate_push_timeout
+        self.regions = regions
 
 
 class AutobuilderEC2Worker(MyEC2LatentWorker):
@@ -95,7 +147,7 @@ class AutobuilderEC2Worker(MyEC2LatentWorker):
 
     def __init__(self, name, password, ec2params, conftext=None, max_builds=1,
                  userdata_template_dir=None, userdata_template_file='cloud-init.txt',
-                 userdata_dict=None):
+                 userdata_dict=None, fastboot_template_file='cloud-init-fastboot.txt'):
         if not password:
             password = ''.join(RNG.choice(string.ascii_letters + string.digits) for _ in range(16))
         if conftext:
@@ -113,38 +165,44 @@ class AutobuilderEC2Worker(MyEC2LatentWorker):
                 ec2tags = tagscopy
         else:
             ec2tags = {'Name': name}
-        ec2_dev_mapping = None
-        svp = ec2params.scratchvolparams
-        if svp:
-            ebs = {
-                'VolumeType': svp['type'],
-                'VolumeSize': svp['size'],
-                'DeleteOnTermination': True
-            }
-            if 'encrypted' in svp:
-                ebs['Encrypted'] = svp['encrypted']
-            if svp['type'] == 'io1':
-                if svp['iops']:
-                    ebs['Iops'] = svp['iops']
-                else:
-                    ebs['Iops'] = 1000
-            ec2_dev_mapping = [
-                {'DeviceName': svp['name'], 'Ebs': ebs}
-            ]
+        storage = ec2params.storage
+        ec2_dev_mapping = storage.block_device_map()
+        conftext += storage.extraconf()
         ctx = {'workername': name,
                'workersecret': password,
                'master_ip': self.master_ip_address,
                'master_hostname': self.master_hostname,
                'master_fqdn': self.master_fqdn,
                'extra_packages': [],
-               'extra_cmds': []}
+               'extra_cmds': [],
+               'warm_pool': ec2params.warm_pool is not None,
+               'image_build': False,
+               'storage': storage.template_context()}
         if userdata_dict:
             ctx.update(userdata_dict)
+        if ec2params.baked_ami:
+            ami = ec2params.baked_ami
+            userdata_template_file = fastboot_template_file
+        else:
+            ami = ec2params.ami
+        env = get_environment(userdata_template_dir)
+        if ec2params.spot_notice_url and ec2params.spot_instance:
+            agent = env.get_template('spot-agent.txt').render(notice_url=ec2params.spot_notice_url,
+                                                              sstate_push_cmd=ec2params.sstate_push_cmd,
+                                                              push_timeout=ec2params.sstate_push_timeout)
+            ctx['extra_cmds'] = list(ctx['extra_cmds']) + [
+                '[ sh, -c, "echo {} | base64 -d > /usr/local/sbin/spot-agent && chmod 0755 /usr/local/sbin/spot-agent'
+                ' && (setsid /usr/local/sbin/spot-agent > /var/log/spot-agent.log 2>&1 &)" ]'.format(
+                    base64.b64encode(bytes(agent, 'utf-8')).decode('ascii'))]
+        if storage.measure_mb:
+            report = env.get_template('disk-report.txt').render(notice_url=ec2params.spot_notice_url,
+                                                                measure_mb=storage.measure_mb,
+                                                                **storage.template_context())
+            ctx['extra_cmds'] = list(ctx['extra_cmds']) + [
+                '[ sh, -c, "echo {} | base64 -d > /usr/local/sbin/disk-report && chmod 0755 /usr/local/sbin/disk-report'
+                ' && (setsid /usr/local/sbin/disk-report > /var/log/disk-report.log 2>&1 &)" ]'.format(
+                    base64.b64encode(bytes(report, 'utf-8')).decode('ascii'))]
         if userdata_template_file:
-            if userdata_template_dir is None:
-                userdata_template_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "templates")
-            loader = jinja2.FileSystemLoader(userdata_template_dir)
-            env = jinja2.Environment(loader=loader, undefined=jinja2.StrictUndefined)
             userdata = env.get_template(userdata_template_file).render(ctx)
         else:
             userdata = '\n'.join(['WORKERNAME={}',
@@ -152,7 +210,7 @@ class AutobuilderEC2Worker(MyEC2LatentWorker):
                                   'MASTER={}']).format(name, password, self.master_ip_address)
         self.userdata_extra_context = userdata_dict
         super().__init__(name=name, password=password, max_builds=max_builds,
-                         instance_type=ec2params.instance_type, ami=ec2params.ami,
+                         instance_type=ec2params.instance_type, ami=ami,
                          keypair_name=ec2params.keypair, instance_profile_name=ec2params.instance_profile_name,
                          security_group_ids=ec2params.secgroup_ids, region=ec2params.region,
                          subnet_id=ec2params.subnet, subnet_ids=ec2params.subnets,
@@ -161,5 +219,13 @@ class AutobuilderEC2Worker(MyEC2LatentWorker):
                          spot_instance=ec2params.spot_instance, build_wait_timeout=ec2params.build_wait_timeout,
                          max_spot_price=ec2params.max_spot_price, price_multiplier=ec2params.price_multiplier,
                          instance_types=ec2params.instance_types,
+                         spot_parallel_requests=ec2params.spot_parallel_requests,
+                         fleet=ec2params.fleet,
+                         spot_price_estimator=ec2params.spot_price_estimator,
+                         warm_pool=ec2params.warm_pool,
+                         boot_path='baked' if ec2params.baked_ami else 'stock',
+                         type_selector=ec2params.type_selector,
+                         state_poll_interval=ec2params.state_poll_interval,
+                         regions=ec2params.regions,
                          properties={'worker_extraconf': conftext},
                          missing_timeout=ec2params.missing_timeout)
@@ -1,19 +1,48 @@
 import base64
 import datetime
+import hashlib
 import os
 import re
 import time
+from collections import deque, OrderedDict
 
-import boto3
 import botocore
 import botocore.exceptions
 import botocore.session
 from botocore.client import ClientError
 from buildbot.interfaces import LatentWorkerFailedToSubstantiate
+from buildbot.process.results import RETRY
 from buildbot.plugins import worker
 from buildbot.worker import AbstractLatentWorker
+from buildbot.worker.ec2 import SPOT_REQUEST_PENDING_STATES, FULFILLED, PENDING, RUNNING, TERMINATED
+from twisted.internet import defer, threads
 from twisted.python import log
 
+from autobuilder.workers.awscache import get_session, get_client, METADATA
+from autobuilder.workers.poolhealth import POOL_HEALTH
+from autobuilder.workers.regions import is_capacity_failure
+from autobuilder.workers.spotprices import get_spot_price_service, ESTIMATORS
+from autobuilder.workers.statepoller import acquire_state_poller, release_state_poller
+from autobuilder.workers.timeline import SubstantiationAttempt
+
+# Recent boot-to-connect times, in seconds, keyed by boot path ('stock' or 'baked')
+BOOT_TIMES = {}
+
+# Cache affinity scoring for nextEC2Worker: the bonus for a worker whose
+# current instance last ran a build with the same cache key halves every
+# AFFINITY_HALF_LIFE seconds, and stays below the bonus for running workers.
+AFFINITY_BONUS = 50.0
+AFFINITY_HALF_LIFE = 6 * 60 * 60
+AFFINITY_MAX_KEYS = 20
+
+# Shortest quarantine for a worker that failed to find capacity in any of its pools
+CAPACITY_QUARANTINE_MIN = 60
+
+# Worker attributes that depend on the region an instance is started in
+REGION_ATTRS = ('session', 'ec2', 'ec2_client', 'state_poller', 'ami', 'image', 'security_group_ids',
+                'instance_types', 'subnet_ids', 'subnet_id', 'placement', 'spot_zones', 'az_to_subnet',
+                'spot_prices')
+
 
 class MyEC2LatentWorker(worker.EC2LatentWorker):
     # Default quarantine timeout intervals are much too short for EC2.
@@ -33,6 +62,14 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
                  block_device_map=None, session=None,
                  instance_types=None,
                  subnet_ids=None,
+                 spot_parallel_requests=None,
+                 fleet=None,
+                 spot_price_estimator='mean',
+                 warm_pool=None,
+                 boot_path='stock',
+                 type_selector=None,
+                 state_poll_interval=None,
+                 regions=None,
                  **kwargs):
 
         if volumes is None:
@@ -60,11 +97,36 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
                     raise ValueError('only one of subnet_id or subnet_ids should be provided')
                 else:
                     self.subnet_ids = subnet_ids
+        elif fleet is not None:
+            if instance_type and instance_types:
+                raise ValueError('only one of instance_type or instance_types should be provided')
+            if subnet_id and subnet_ids:
+                raise ValueError('only one of subnet_id or subnet_ids should be provided')
+            self.instance_types = instance_types or [instance_type]
+            self.subnet_ids = subnet_ids or [subnet_id]
+            instance_type = None
+            subnet_id = None
         else:
             if instance_types:
                 raise ValueError('instance_types only valid for spot_instance workers')
             if subnet_ids is not None:
                 raise ValueError('subnet_ids only valid for spot instances')
+        if spot_parallel_requests and not spot_instance:
+            raise ValueError('spot_parallel_requests only valid for spot instances')
+        if warm_pool is not None and spot_instance:
+            raise ValueError('warm_pool only valid for on-demand instances')
+        if type_selector is not None and not spot_instance and fleet is None:
+            raise ValueError('type_selector only valid for spot instances or fleets')
+        if spot_parallel_requests is not None and spot_parallel_requests < 1:
+            raise ValueError('spot_parallel_requests must be at least 1')
+        if regions and elastic_ip is not None:
+            raise ValueError('elastic_ip not valid with spillover regions')
+        if regions and volumes:
+            raise ValueError('volumes not valid with spillover regions')
+        self.spot_parallel_requests = spot_parallel_requests or 1
+        if spot_price_estimator not in ESTIMATORS:
+            raise ValueError('spot_price_estimator must be one of: {}'.format(', '.join(ESTIMATORS)))
+        self.spot_price_estimator = spot_price_estimator
 
         # noinspection PyCallByClass
         AbstractLatentWorker.__init__(self, name, password, **kwargs)
@@ -118,6 +180,22 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
         self.volumes = volumes
         self.price_multiplier = price_multiplier
         self.product_description = product_description
+        self.fleet = fleet
+        self._fleet_templates = {}
+        self.warm_pool = warm_pool
+        self._userdata_hash = hashlib.sha256(bytes(user_data or '', 'utf-8')).hexdigest()[:16]
+        self._instance_created = None
+        self.boot_path = boot_path
+        self.type_selector = type_selector
+        self._build_name = None
+        self._attempt = None
+        self.substantiation_attempts = deque(maxlen=10)
+        self.last_build_started = None
+        self.cache_keys = OrderedDict()
+        self._capacity_failure = False
+        self._requeue_timer = None
+        self._paused_for_notice = False
+        self._instance_stopped = None
 
         if None not in [placement, region]:
             self.placement = '{}{}'.format(region, placement)
@@ -144,44 +222,24 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
             assert secret_identifier is not None, \
                 'supply both or neither of identifier, secret_identifier'
 
-        region_found = None
-
         # Make the EC2 connection.
         self.session = session
         if self.session is None:
-            if region is not None:
-                for r in boto3.Session(
-                        aws_access_key_id=identifier,
-                        aws_secret_access_key=secret_identifier).get_available_regions('ec2'):
-
-                    if r == region:
-                        region_found = r
-
-                if region_found is not None:
-                    self.session = boto3.Session(
-                        region_name=region,
-                        aws_access_key_id=identifier,
-                        aws_secret_access_key=secret_identifier)
-                else:
-                    raise ValueError(
-                        'The specified region does not exist: ' + region)
-
-            else:
+            if region is None:
                 # boto2 defaulted to us-east-1 when region was unset, we
                 # mimic this here in boto3
                 region = botocore.session.get_session().get_config_variable('region')
                 if region is None:
                     region = 'us-east-1'
-                self.session = boto3.Session(
-                    aws_access_key_id=identifier,
-                    aws_secret_access_key=secret_identifier,
-                    region_name=region
-                )
+            self.session = get_session(region, identifier, secret_identifier)
 
         self.ec2 = self.session.resource('ec2')
-        self.ec2_client = self.session.client('ec2')
+        self.ec2_client = get_client(self.session, 'ec2')
+        # State pollers are acquired when the worker starts (see startService)
+        self.state_poll_interval = state_poll_interval
+        self.state_poller = None
 
-        # Make a keypair
+        # Make sure the keypair exists
         #
         # We currently discard the keypair data because we don't need it.
         # If we do need it in the future, we will always recreate the keypairs
@@ -190,23 +248,7 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
         # generate it and store it on the filesystem, which is an unnecessary
         # usage requirement.
         if self.keypair_name:
-            try:
-                self.ec2.KeyPair(self.keypair_name).load()
-                # key_pair.delete() # would be used to recreate
-            except ClientError as e:
-                if 'InvalidKeyPair.NotFound' not in str(e):
-                    if 'AuthFailure' in str(e):
-                        log.msg('POSSIBLE CAUSES OF ERROR:\n'
-                                '  Did you supply your AWS credentials?\n'
-                                '  Did you sign up for EC2?\n'
-                                '  Did you put a credit card number in your AWS '
-                                'account?\n'
-                                'Please doublecheck before reporting a problem.\n')
-                        raise
-                    # make one; we would always do this, and stash the result, if we
-                    # needed the key (for instance, to SSH to the box).  We'd then
-                    # use paramiko to use the key to connect.
-                    self.ec2.create_key_pair(KeyName=keypair_name)
+            METADATA.ensure_keypair(self.ec2_client, self.keypair_name)
 
         # create security group
         if security_name:
@@ -228,6 +270,7 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
                     raise
 
         # get the image
+        self.image = None
         if self.ami is not None:
             self.image = self.ec2.Image(self.ami)
         else:
@@ -237,15 +280,10 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
 
         # get the specified elastic IP, if any
         if elastic_ip is not None:
-            # Using workers.vpc_addresses.filter(PublicIps=[elastic_ip]) throws a
-            # NotImplementedError("Filtering not supported in describe_address.") in moto
-            # https://github.com/spulec/moto/blob/100ec4e7c8aa3fde87ff6981e2139768816992e4/moto/ec2/responses/elastic_ip_addresses.py#L52
-            addresses = self.ec2.meta.client.describe_addresses(
-                PublicIps=[elastic_ip])['Addresses']
-            if not addresses:
+            allocation_id = METADATA.elastic_ip_allocation(self.ec2_client, elastic_ip)
+            if allocation_id is None:
                 raise ValueError(
                     'Could not find EIP for IP: ' + elastic_ip)
-            allocation_id = addresses[0]['AllocationId']
             elastic_ip = self.ec2.VpcAddress(allocation_id)
         self.elastic_ip = elastic_ip
 
@@ -256,9 +294,23 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
         self.tags = tags
         self.block_device_map = self.create_block_device_mapping(
             block_device_map) if block_device_map else None
-        if self.spot_instance:
+        self._configure_subnets(subnet_id)
+
+        # The worker's own region comes first, followed by the spillover regions
+        self.regions = [self._region_state()]
+        for spec in regions or []:
+            self.regions.append(self._spillover_region(spec, identifier, secret_identifier))
+        if len(self.regions) > 1:
+            self._use_region(self.regions[0])
+
+    def _configure_subnets(self, subnet_id):
+        self.spot_zones = None
+        self.az_to_subnet = None
+        self.spot_prices = None
+        if self.spot_instance or self.fleet is not None:
+            subnet_zones = METADATA.subnet_zones(self.ec2_client, self.subnet_ids)
             if self.placement is None and len(self.subnet_ids) == 1:
-                self.placement = self.ec2.Subnet(self.subnet_ids[0]).availability_zone
+                self.placement = subnet_zones[self.subnet_ids[0]]
                 self.az_to_subnet = {self.placement: self.subnet_ids[0]}
             if len(self.subnet_ids) == 0:
                 self.spot_zones = [self.placement]
@@ -266,15 +318,133 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
                 self.spot_zones = []
                 self.az_to_subnet = {}
                 for i in self.subnet_ids:
-                    az = self.ec2.Subnet(i).availability_zone
+                    az = subnet_zones[i]
                     self.spot_zones.append(az)
                     self.az_to_subnet[az] = i
+            if self.spot_instance and self.price_multiplier is not None:
+                self.spot_prices = get_spot_price_service(self.ec2_client, self.session.region_name)
+                self.spot_prices.register(self.product_description, self.spot_zones, self.instance_types)
+            self.subnet_id = None
         else:
             self.subnet_id = subnet_id
             if self.placement is None:
-                self.placement = self.ec2.Subnet(self.subnet_id).availability_zone
+                self.placement = METADATA.subnet_zones(self.ec2_client, [self.subnet_id])[self.subnet_id]
+
+    def _region_state(self):
+        return {attr: getattr(self, attr, None) for attr in REGION_ATTRS}
+
+    def _use_region(self, state):
+        for attr in REGION_ATTRS:
+            setattr(self, attr, state[attr])
+
+    @defer.inlineCallbacks
+    def startService(self):
+        if self.state_poll_interval:
+            for state in self.regions:
+                state['state_poller'] = acquire_state_poller(state['ec2_client'], state['session'].region_name,
+                                                             self.state_poll_interval)
+                if state['session'] is self.session:
+                    self.state_poller = state['state_poller']
+        yield super().startService()
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        yield super().stopService()
+        for state in self.regions:
+            if state['state_poller'] is not None:
+                release_state_poller(state['state_poller'])
+                state['state_poller'] = None
+        self.state_poller = None
+
+    def _spillover_region(self, spec, identifier, secret_identifier):
+        """
+        Sets up a spillover region from its RegionSpec, returning its state.
+        The worker's attributes are left set up for the region.
+        """
+        if self.spot_instance or self.fleet is not None:
+            self.subnet_ids = spec.subnets
+            self.instance_types = spec.instance_types or self.regions[0]['instance_types']
+        elif len(spec.subnets) != 1:
+            raise ValueError('Region {}: on-demand workers take a single subnet'.format(spec.region))
+        ami = spec.baked_ami if self.boot_path == 'baked' else spec.ami
+        if ami is None and self.regions[0]['ami'] is not None:
+            raise ValueError('Region {}: missing {}'.format(spec.region,
+                                                            'baked_ami' if self.boot_path == 'baked' else 'ami'))
+        self.session = get_session(spec.region, identifier, secret_identifier)
+        self.ec2 = self.session.resource('ec2')
+        self.ec2_client = get_client(self.session, 'ec2')
+        if self.keypair_name:
+            METADATA.ensure_keypair(self.ec2_client, self.keypair_name)
+        self.ami = ami
+        self.image = None
+        if self.ami is not None:
+            self.image = self.ec2.Image(self.ami)
+        else:
+            assert self.get_image()
+        self.security_group_ids = spec.security_group_ids
+        self.placement = None
+        self._configure_subnets(spec.subnets[0])
+        return self._region_state()
+
+    def _start_in_regions(self, start):
+        """
+        Called in a thread to start an instance with start(), trying each
+        region in order until one has capacity for the worker.
+        """
+        self._capacity_failure = False
+        for i, state in enumerate(self.regions):
+            if len(self.regions) > 1:
+                self._use_region(state)
+            try:
+                return start()
+            except Exception as e:
+                self._capacity_failure = self.instance is None and is_capacity_failure(e)
+                if not self._capacity_failure or i == len(self.regions) - 1:
+                    raise
+                log.msg('{} {} no capacity in {} ({}), spilling over to {}'.format(
+                    self.__class__.__name__, self.workername, state['session'].region_name, e,
+                    self.regions[i + 1]['session'].region_name))
+
+    def get_image(self):
+        if self.image is not None:
+            return self.image
+        image_id = METADATA.image_id(self.ec2_client, self.valid_ami_owners, self.valid_ami_location_regex,
+                                     lambda: super(MyEC2LatentWorker, self).get_image().id)
+        return self.ec2.Image(image_id)
 
     def _start_instance(self):
+        if self.warm_pool is not None:
+            instance = self.warm_pool.find(self.ec2, self.workername, self._userdata_hash)
+            if instance is not None:
+                return self._restart_instance(instance)
+        if self.fleet is not None:
+            result = self._request_fleet_instance(spot=False)
+        else:
+            result = self._launch_instance()
+        if self.warm_pool is not None and result is not None:
+            self._instance_created = time.time()
+            # Forget builds run on the stopped instance this one replaces
+            self.cache_keys = OrderedDict((k, t) for k, t in list(self.cache_keys.items())
+                                          if t >= (self._instance_stopped or 0))
+            self.instance.create_tags(Tags=self.warm_pool.tags(self.workername, self._userdata_hash,
+                                                               self._instance_created))
+        return result
+
+    def _restart_instance(self, instance):
+        log.msg('{} {} starting warm pool instance {}'.format(
+            self.__class__.__name__, self.workername, instance.id))
+        self._instance_created = self.warm_pool.created(instance)
+        self._mark('request_submitted')
+        instance.start()
+        self._mark('request_fulfilled')
+        instance.reload()
+        self.instance = instance
+        self.placement = instance.placement['AvailabilityZone']
+        self.subnet_id = instance.subnet_id
+        instance_id, start_time = self._wait_for_instance()
+        return instance_id, instance.image_id, start_time
+
+    def _launch_instance(self):
         image = self.get_image()
         launch_opts = dict(
             ImageId=image.id, KeyName=self.keypair_name,
@@ -295,7 +465,9 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
         )
 
         launch_opts = self._remove_none_opts(launch_opts)
+        self._mark('request_submitted')
         reservations = self.ec2.create_instances(**launch_opts)
+        self._mark('request_fulfilled')
 
         self.instance = reservations[0]
         instance_id, start_time = self._wait_for_instance()
@@ -305,68 +477,406 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
             self.failed_to_start(self.instance.id, self.instance.state['Name'])
         return None
 
+    def _mark(self, phase):
+        if self._attempt is not None:
+            self._attempt.mark(phase)
+
+    def _finish_attempt(self, outcome):
+        attempt = self._attempt
+        if attempt is None:
+            return
+        attempt.finish(outcome)
+
+    def substantiate(self, wfb, build):
+        waited = not self.substantiated
+        d = super().substantiate(wfb, build)
+        if build is not None:
+            d.addCallback(self._set_build_properties, build, waited)
+        return d
+
+    def _set_build_properties(self, ready, build, waited):
+        """
+        Records the instance the build runs on in its properties, and for
+        builds that waited for the worker to be substantiated, how the
+        substantiation went. Worker properties are copied into a build
+        before its latent worker is substantiated, so these are set on the
+        build itself once it is.
+        """
+        if ready is True and self._attempt is not None:
+            build.setProperty('instance_type', self._attempt.instance_type, 'EC2')
+            build.setProperty('ec2_region', self.session.region_name, 'EC2')
+            if waited:
+                build.setProperty('substantiation_timeline', self._attempt.as_dict(), 'EC2')
+                build.setProperty('substantiation_attempts',
+                                  [a.as_dict() for a in self.substantiation_attempts], 'EC2')
+                if 'worker_attached' in self._attempt.marks:
+                    build.setProperty('boot_to_connect', round(self._attempt.marks['worker_attached'], 1), 'EC2')
+        return ready
+
+    def start_instance(self, build):
+        if self.instance is not None:
+            raise ValueError('instance active')
+        self._attempt = SubstantiationAttempt(self.workername, self.boot_path)
+        self.substantiation_attempts.append(self._attempt)
+        self._build_name = build.builder.name if build is not None else None
+        start = self._request_spot_instance if self.spot_instance else self._start_instance
+        return threads.deferToThread(self._start_in_regions, start)
+
+    def instance_state(self):
+        """
+        Returns the state name of the worker's instance without making an
+        API call, using the state poller's snapshot or the instance data
+        loaded when it was started.
+        """
+        instance = self.instance
+        if instance is None:
+            return TERMINATED
+        if self.state_poller is not None:
+            statename = self.state_poller.state(instance.id)
+            if statename is not None:
+                return statename
+        if instance.meta.data:
+            return instance.meta.data['State']['Name']
+        return PENDING
+
+    def _wait_for_instance(self):
+        if self.state_poller is None:
+            result = super()._wait_for_instance()
+        else:
+            result = self._wait_for_polled_instance()
+        if self._attempt is not None and self.instance is not None:
+            if self.instance.state['Name'] == RUNNING:
+                self._mark('instance_running')
+            self._attempt.set_pool(self.instance.instance_type, self.instance.placement['AvailabilityZone'])
+        return result
+
+    def _wait_for_polled_instance(self):
+        log.msg('{} {} waiting for instance {} to start'.format(
+            self.__class__.__name__, self.workername, self.instance.id))
+        started = time.time()
+        while self.state_poller.wait_while(self.instance.id, PENDING, 60) == PENDING:
+            log.msg('{} {} has waited {} minutes for instance {}'.format(
+                self.__class__.__name__, self.workername, int(time.time() - started) // 60, self.instance.id))
+        self.instance.reload()
+        log.msg('{} {} instance {} left the pending state after {} seconds'.format(
+            self.__class__.__name__, self.workername, self.instance.id, int(time.time() - started)))
+        # The instance is no longer pending, so the upstream implementation
+        # goes straight to what it does once the instance is running
+        return super()._wait_for_instance()
+
+    def _fireSubstantiationNotifier(self, result):
+        # Finish the attempt before the builds waiting for the substantiation
+        # are notified, so that their properties include the whole timeline
+        if result is True and self._attempt is not None and self._attempt.outcome is None:
+            self._mark('worker_attached')
+            self._finish_attempt('attached')
+            elapsed = self._attempt.marks['worker_attached']
+            times = BOOT_TIMES.setdefault(self.boot_path, deque(maxlen=100))
+            times.append(elapsed)
+            log.msg('{} {} boot-to-connect {:.1f}s ({} boot); recent averages: {}'.format(
+                self.__class__.__name__, self.workername, elapsed, self.boot_path,
+                ', '.join('{} {:.1f}s over {}'.format(path, sum(t) / len(t), len(t))
+                          for path, t in sorted(BOOT_TIMES.items()))))
+        return super()._fireSubstantiationNotifier(result)
+
+    def buildStarted(self, wfb):
+        self.last_build_started = self.master.reactor.seconds()
+        return super().buildStarted(wfb)
+
+    def _substantiation_failed(self, failure):
+        if self._attempt is not None and self._attempt.outcome is None:
+            self._finish_attempt('failed')
+        return super()._substantiation_failed(failure)
+
+    def putInQuarantine(self):
+        if self._attempt is not None and self._attempt.outcome in (None, 'failed'):
+            self._finish_attempt('quarantined')
+        if self._capacity_failure and not self.quarantine_timer and (self.spot_instance or self.fleet is not None):
+            # Wait until one of the worker's pools is likely to have capacity again,
+            # rather than for the static quarantine timeout
+            wait = POOL_HEALTH.recovery_time(self._pools())
+            self.quarantine_timeout = int(min(max(wait, CAPACITY_QUARANTINE_MIN), self.quarantine_max_timeout))
+        return super().putInQuarantine()
+
+    def cache_affinity(self, key, now=None):
+        """
+        Returns the score bonus for running a build with the given cache key
+        on this worker, based on how recently its current instance (which
+        may be stopped in the warm pool) ran one.
+        """
+        last = self.cache_keys.get(key)
+        if last is None:
+            return 0.0
+        age = max((now or time.time()) - last, 0)
+        return AFFINITY_BONUS * 0.5 ** (age / AFFINITY_HALF_LIFE)
+
+    def record_cache_use(self, key):
+        self.cache_keys[key] = time.time()
+        self.cache_keys.move_to_end(key)
+        while len(self.cache_keys) > AFFINITY_MAX_KEYS:
+            self.cache_keys.popitem(last=False)
+
+    def spot_notice(self, kind, detail, grace=90):
+        """
+        Handles a notice reported by the spot notice agent on the worker's
+        instance. On a rebalance recommendation, the worker stops taking new
+        builds. On an interruption notice it also records the interruption
+        in its running builds' properties and, after grace seconds or once
+        the agent reports that sstate has been pushed, stops those builds
+        with RETRY so that they are requeued (on another spot pool, since
+        the interruption counts against the pool's health).
+        """
+        notice = {'kind': kind,
+                  'detail': detail,
+                  'received': time.time(),
+                  'instance': self.instance.id if self.instance is not None else None,
+                  'instance_type': self._attempt.instance_type if self._attempt is not None else None,
+                  'zone': self._attempt.zone if self._attempt is not None else None}
+        log.msg('{} {} spot {} notice for instance {}: {}'.format(
+            self.__class__.__name__, self.workername, kind, notice['instance'], detail))
+        if kind == 'sstate-pushed':
+            if self._requeue_timer is not None and self._requeue_timer.active():
+                self._requeue_timer.cancel()
+                self._requeue_builds()
+            return
+        if not self.isPaused():
+            self._paused_for_notice = True
+            self.pause('spot {} notice'.format(kind))
+        if kind == 'rebalance':
+            self.properties.setProperty('spot_rebalance', notice, 'Worker')
+            return
+        self.properties.setProperty('spot_interruption', notice, 'Worker')
+        if notice['zone'] is not None:
+            POOL_HEALTH.record_failure(notice['zone'], notice['instance_type'], 'interruption')
+        for build in self._running_builds():
+            build.setProperty('spot_interruption', notice, 'Spot notice')
+        if self._requeue_timer is None or not self._requeue_timer.active():
+            self._requeue_timer = self.master.reactor.callLater(grace, self._requeue_builds)
+
+    def storage_report(self, detail):
+        """
+        Records the scratch storage throughput measured on the worker's
+        instance at boot (see StorageProfile) as a worker property.
+        """
+        report = {'received': time.time(),
+                  'instance': self.instance.id if self.instance is not None else None,
+                  'instance_type': self._attempt.instance_type if self._attempt is not None else None}
+        if isinstance(detail, dict):
+            report.update(detail)
+        log.msg('{} {} scratch storage throughput for instance {}: {}'.format(
+            self.__class__.__name__, self.workername, report['instance'], detail))
+        self.properties.setProperty('scratch_throughput', report, 'Worker')
+
+    def _running_builds(self):
+        builds = []
+        for wfb in self.workerforbuilders.values():
+            if wfb.isBusy():
+                builds += [b for b in wfb.builder.building if b.workerforbuilder is wfb]
+        return builds
+
+    def _requeue_builds(self):
+        self._requeue_timer = None
+        for build in self._running_builds():
+            log.msg('{} {} stopping build {} for retry after spot interruption'.format(
+                self.__class__.__name__, self.workername, build.number))
+            build.stopBuild('spot instance interrupted', results=RETRY)
+
+    def _pools(self):
+        pools = []
+        for state in self.regions:
+            pools += [(zone, instance_type) for zone in state['spot_zones'] or []
+                      for instance_type in state['instance_types'] or []]
+        return pools
+
+    def stop_instance(self, fast=False):
+        if self._requeue_timer is not None and self._requeue_timer.active():
+            self._requeue_timer.cancel()
+        self._requeue_timer = None
+        if self._paused_for_notice:
+            self._paused_for_notice = False
+            self.unpause()
+        if self.warm_pool is None or self.instance is None or \
+                not self.warm_pool.admit(self.workername, self._instance_created):
+            # The instance's scratch storage goes away with it
+            self.cache_keys.clear()
+            return super().stop_instance(fast)
+        instance = self.instance
+        self.output = self.instance = None
+        self._instance_stopped = time.time()
+        return threads.deferToThread(self._stop_warm_instance, instance, fast)
+
+    def _stop_warm_instance(self, instance, fast):
+        if self.elastic_ip is not None:
+            self.elastic_ip.association.delete()
+        instance.stop()
+        log.msg('{} {} stopping instance {} for warm pool'.format(
+            self.__class__.__name__, self.workername, instance.id))
+        if not fast:
+            instance.wait_until_stopped()
+            log.msg('{} {} instance {} stopped'.format(self.__class__.__name__, self.workername, instance.id))
+
     def _bid_price_from_spot_price_history(self):
-        timestamp_yesterday = time.gmtime(int(time.time() - 86400))
-        spot_history_starttime = time.strftime(
-            '%Y-%m-%dT%H:%M:%SZ', timestamp_yesterday)
-        ret = self.ec2.meta.client.describe_spot_price_history(
-            Filters=[dict(Name='availability-zone', Values=self.spot_zones)],
-            StartTime=spot_history_starttime,
-            ProductDescriptions=[self.product_description],
-            InstanceTypes=self.instance_types)
-        if 'SpotPriceHistory' not in ret:
-            return {}
-        info = {}
-        for entry in ret['SpotPriceHistory']:
-            k = '{}:{}'.format(entry['AvailabilityZone'], entry['InstanceType'])
-            price = float(entry['SpotPrice'])
-            if k in info:
-                info[k].append(price)
-            else:
-                info[k] = [price]
+        stats = self.spot_prices.statistics(self.product_description, self.spot_zones, self.instance_types)
         bid_prices = {}
-        for k, pricelist in info.items():
-            bid = (sum(pricelist)/len(pricelist)) * self.price_multiplier
+        for (zone, instance_type), pool_stats in stats.items():
+            bid = getattr(pool_stats, self.spot_price_estimator) * self.price_multiplier
             if self.max_spot_price is not None and bid > self.max_spot_price:
                 bid = self.max_spot_price
-            bid_prices[k] = bid
+            bid_prices['{}:{}'.format(zone, instance_type)] = bid
 
         return bid_prices
 
-    def _request_spot_instance(self):
+    def _spot_launch_specification(self, instance_type, zone, subnet_id):
+        return self._remove_none_opts(
+            ImageId=self.ami,
+            KeyName=self.keypair_name,
+            SecurityGroups=self.classic_security_groups,
+            UserData=(base64.b64encode(bytes(self.user_data, 'utf-8')).decode('ascii')
+                      if self.user_data else None),
+            InstanceType=instance_type,
+            Placement=self._remove_none_opts(
+                AvailabilityZone=zone,
+            ),
+            NetworkInterfaces=[{'AssociatePublicIpAddress': True,
+                                'DeviceIndex': 0,
+                                'Groups': self.security_group_ids,
+                                'SubnetId': subnet_id}],
+            BlockDeviceMappings=self.block_device_map,
+            IamInstanceProfile=self._remove_none_opts(
+                Name=self.instance_profile_name,
+            )
+        )
+
+    def _submit_spot_request(self, zone, instance_type, bid_price):
+        subnet_id = self.az_to_subnet[zone]
+        log.msg('%s %s requesting spot instance %s in zone %s with price %0.4f' %
+                (self.__class__.__name__, self.workername, instance_type, zone, bid_price))
+        self._mark('request_submitted')
+        reservations = self.ec2.meta.client.request_spot_instances(
+            SpotPrice=str(bid_price),
+            LaunchSpecification=self._spot_launch_specification(instance_type, zone, subnet_id),
+            ValidUntil=datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=60)
+        )
+        return reservations['SpotInstanceRequests'][0]
+
+    def _spot_bids(self):
+        """
+        Returns a list of (zone, instance_type, bid_price) tuples, cheapest first.
+        """
         if self.price_multiplier is None:
-            bid_prices = {itype: self.max_spot_price for itype in self.instance_types}
+            bid_prices = {'{}:{}'.format(zone, itype): self.max_spot_price
+                          for zone in self.spot_zones for itype in self.instance_types}
         else:
             bid_prices = self._bid_price_from_spot_price_history()
+        bids = []
         for k, bid_price in sorted(bid_prices.items(), key=lambda x: x[1]):
             zone, instance_type = k.split(':')
-            subnet_id = self.az_to_subnet[zone]
-            log.msg('%s %s requesting spot instance %s in zone %s with price %0.4f' %
-                    (self.__class__.__name__, self.workername, instance_type, zone, bid_price))
-            reservations = self.ec2.meta.client.request_spot_instances(
-                SpotPrice=str(bid_price),
-                LaunchSpecification=self._remove_none_opts(
-                    ImageId=self.ami,
-                    KeyName=self.keypair_name,
-                    SecurityGroups=self.classic_security_groups,
-                    UserData=(base64.b64encode(bytes(self.user_data, 'utf-8')).decode('ascii')
-                              if self.user_data else None),
-                    InstanceType=instance_type,
-                    Placement=self._remove_none_opts(
-                        AvailabilityZone=zone,
-                    ),
-                    NetworkInterfaces=[{'AssociatePublicIpAddress': True,
-                                        'DeviceIndex': 0,
-                                        'Groups': self.security_group_ids,
-                                        'SubnetId': subnet_id}],
-                    BlockDeviceMappings=self.block_device_map,
-                    IamInstanceProfile=self._remove_none_opts(
-                        Name=self.instance_profile_name,
-                    )
-                ),
-                ValidUntil=datetime.datetime.now(tz=datetime.timezone.utc) + datetime.timedelta(seconds=60)
+            bids.append((zone, instance_type, bid_price))
+        if self.type_selector is not None:
+            bids = self.type_selector.rank(self._build_name, bids, self.ec2.meta.client)
+        bids = POOL_HEALTH.order(bids)
+        self._mark('bid_computed')
+        return bids
+
+    def _add_request(self, zone, instance_type, status, submitted):
+        if status == FULFILLED:
+            POOL_HEALTH.record_success(zone, instance_type)
+        else:
+            POOL_HEALTH.record_failure(zone, instance_type, status)
+        if self._attempt is not None:
+            self._attempt.add_request(zone, instance_type, status, submitted, time.time())
+
+    def _use_spot_instance(self, zone, instance_id):
+        self.placement = zone
+        self.subnet_id = self.az_to_subnet[zone]
+        self.instance = self.ec2.Instance(instance_id)
+        image = self.get_image()
+        instance_id, start_time = self._wait_for_instance()
+        return instance_id, image.id, start_time
+
+    def _fleet_launch_template(self):
+        """
+        Returns the worker's launch template for the current region, adding
+        a new version when the worker's image has changed since the last one.
+        """
+        region = self.session.region_name
+        image_id = self.get_image().id
+        cached = self._fleet_templates.get(region)
+        if cached is None or cached[0] != image_id:
+            template_data = self._remove_none_opts(
+                ImageId=image_id,
+                KeyName=self.keypair_name,
+                UserData=(base64.b64encode(bytes(self.user_data, 'utf-8')).decode('ascii')
+                          if self.user_data else None),
+                NetworkInterfaces=[self._remove_none_opts(AssociatePublicIpAddress=True,
+                                                          DeviceIndex=0,
+                                                          Groups=self.security_group_ids)],
+                BlockDeviceMappings=self.block_device_map,
+                IamInstanceProfile=self._remove_none_opts(
+                    Name=self.instance_profile_name,
+                )
             )
-            reservation = reservations['SpotInstanceRequests'][0]
+            if cached is not None:
+                log.msg('{} {} image changed from {} to {}, updating launch template'.format(
+                    self.__class__.__name__, self.workername, cached[0], image_id))
+            cached = (image_id, self.fleet.ensure_launch_template(self.ec2.meta.client,
+                                                                  'autobuilder-' + self.workername,
+                                                                  template_data))
+            self._fleet_templates[region] = cached
+        return cached[1]
+
+    def _request_fleet_instance(self, spot=True):
+        if spot:
+            overrides = [{'InstanceType': instance_type,
+                          'SubnetId': self.az_to_subnet[zone],
+                          'MaxPrice': str(bid_price)} for zone, instance_type, bid_price in self._spot_bids()]
+        else:
+            candidates = [(subnet_id, instance_type, None)
+                          for instance_type in self.instance_types for subnet_id in self.subnet_ids]
+            if self.type_selector is not None:
+                candidates = self.type_selector.rank(self._build_name, candidates, self.ec2.meta.client)
+            overrides = [{'InstanceType': instance_type, 'SubnetId': subnet_id}
+                         for subnet_id, instance_type, _ in candidates]
+        if self.type_selector is not None:
+            # Only used with the prioritized allocation strategies
+            for i, override in enumerate(overrides):
+                override['Priority'] = float(i)
+        log.msg('{} {} requesting {} fleet instance from {} candidates'.format(
+            self.__class__.__name__, self.workername, 'spot' if spot else 'on-demand', len(overrides)))
+        started = time.time()
+        self._mark('request_submitted')
+        failed = []
+        result = self.fleet.acquire(self.ec2.meta.client, self._fleet_launch_template(), overrides, spot=spot,
+                                    failed=failed)
+        subnet_zones = {s: z for z, s in self.az_to_subnet.items()}
+        for instance_type, subnet_id, code in failed:
+            if subnet_id in subnet_zones:
+                POOL_HEALTH.record_failure(subnet_zones[subnet_id], instance_type, code)
+        if result is None:
+            raise LatentWorkerFailedToSubstantiate(self.workername, "no fleet capacity")
+        self._mark('request_fulfilled')
+        instance_id, instance_type, subnet_id = result
+        if spot and subnet_id in subnet_zones:
+            POOL_HEALTH.record_success(subnet_zones[subnet_id], instance_type)
+        log.msg('{} {} fleet launched {} ({}) in subnet {} after {:.1f}s'.format(
+            self.__class__.__name__, self.workername, instance_id, instance_type, subnet_id,
+            time.time() - started))
+        self.subnet_id = subnet_id
+        self.placement = subnet_zones.get(subnet_id)
+        self.instance = self.ec2.Instance(instance_id)
+        image = self.get_image()
+        instance_id, start_time = self._wait_for_instance()
+        return instance_id, image.id, start_time
+
+    def _request_spot_instance(self):
+        if self.fleet is not None:
+            return self._request_fleet_instance(spot=True)
+        bids = self._spot_bids()
+        if self.spot_parallel_requests > 1:
+            return self._request_spot_instances_parallel(bids)
+        for zone, instance_type, bid_price in bids:
+            reservation = self._submit_spot_request(zone, instance_type, bid_price)
+            submitted = time.time()
             spotWaiter = self.ec2.meta.client.get_waiter('spot_instance_request_fulfilled')
             try:
                 spotWaiter.wait(SpotInstanceRequestIds=[reservation['SpotInstanceRequestId']],
@@ -378,27 +888,122 @@ class MyEC2LatentWorker(worker.EC2LatentWorker):
                 if not success:
                     log.msg('{} {} spot request not successful'.format(
                         self.__class__.__name__, self.workername))
+                    self._add_request(zone, instance_type, 'unsuccessful', submitted)
                     continue
             except LatentWorkerFailedToSubstantiate as e:
                 reqid, status = e.args
-                log.msg('{} {} spot request {} rejected: {}'.format(
-                    self.__class__.__name__, self.workername, reqid, status))
+                log.msg('{} {} spot request {} for {} in {} rejected after {:.1f}s: {}'.format(
+                    self.__class__.__name__, self.workername, reqid, instance_type, zone,
+                    time.time() - submitted, status))
+                self._add_request(zone, instance_type, status, submitted)
                 continue
+            self._mark('request_fulfilled')
+            self._add_request(zone, instance_type, FULFILLED, submitted)
+            log.msg('{} {} spot request {} for {} in {} fulfilled after {:.1f}s'.format(
+                self.__class__.__name__, self.workername, request['SpotInstanceRequestId'],
+                instance_type, zone, time.time() - submitted))
+            return self._use_spot_instance(zone, request['InstanceId'])
+        raise LatentWorkerFailedToSubstantiate(self.workername, "exhausted instance types")
 
-            instance_id = request['InstanceId']
-            self.placement = zone
-            self.subnet_id = subnet_id
-            self.instance = self.ec2.Instance(instance_id)
-            image = self.get_image()
-            instance_id, start_time = self._wait_for_instance()
-            return instance_id, image.id, start_time
+    def _request_spot_instances_parallel(self, bids):
+        """
+        Submits spot requests to the cheapest spot_parallel_requests pools at
+        once and takes the first one fulfilled, cancelling the other requests
+        and terminating any extra instances they may have launched. If none
+        of the requests in a batch is fulfilled, the next batch of pools is
+        tried.
+        """
+        started = time.time()
+        batchsize = self.spot_parallel_requests
+        for i in range(0, len(bids), batchsize):
+            pending = {}
+            for zone, instance_type, bid_price in bids[i:i + batchsize]:
+                try:
+                    reservation = self._submit_spot_request(zone, instance_type, bid_price)
+                except ClientError as e:
+                    log.msg('{} {} spot request for {} in {} failed: {}'.format(
+                        self.__class__.__name__, self.workername, instance_type, zone, e))
+                    self._add_request(zone, instance_type, e.response.get('Error', {}).get('Code'), time.time())
+                    continue
+                pending[reservation['SpotInstanceRequestId']] = (zone, instance_type, time.time())
+            winner = None
+            extra_instances = []
+            while pending:
+                time.sleep(self._poll_resolution)
+                try:
+                    requests = self.ec2.meta.client.describe_spot_instance_requests(
+                        SpotInstanceRequestIds=list(pending.keys()))['SpotInstanceRequests']
+                except ClientError as e:
+                    # Newly-created requests are sometimes not visible right away
+                    if 'InvalidSpotInstanceRequestID.NotFound' in str(e):
+                        continue
+                    raise
+                for request in requests:
+                    reqid = request['SpotInstanceRequestId']
+                    status = request['Status']['Code']
+                    if status in SPOT_REQUEST_PENDING_STATES or reqid not in pending:
+                        continue
+                    zone, instance_type, submitted = pending.pop(reqid)
+                    self._add_request(zone, instance_type, status, submitted)
+                    if status == FULFILLED and winner is None:
+                        self._mark('request_fulfilled')
+                        log.msg('{} {} spot request {} for {} in {} fulfilled after {:.1f}s'.format(
+                            self.__class__.__name__, self.workername, reqid, instance_type, zone,
+                            time.time() - submitted))
+                        winner = (zone, request['InstanceId'])
+                    elif status == FULFILLED:
+                        extra_instances.append(request['InstanceId'])
+                    else:
+                        log.msg('{} {} spot request {} for {} in {} rejected after {:.1f}s: {}'.format(
+                            self.__class__.__name__, self.workername, reqid, instance_type, zone,
+                            time.time() - submitted, status))
+                if winner is not None:
+                    break
+            if pending:
+                self._cancel_spot_requests(list(pending.keys()), extra_instances)
+                for zone, instance_type, submitted in pending.values():
+                    self._add_request(zone, instance_type, 'cancelled', submitted)
+            if extra_instances:
+                log.msg('{} {} terminating extra spot instances: {}'.format(
+                    self.__class__.__name__, self.workername, ', '.join(extra_instances)))
+                self.ec2.meta.client.terminate_instances(InstanceIds=extra_instances)
+            if winner is not None:
+                log.msg('{} {} spot instance acquired after {:.1f}s'.format(
+                    self.__class__.__name__, self.workername, time.time() - started))
+                return self._use_spot_instance(*winner)
+        log.msg('{} {} no spot capacity after {:.1f}s'.format(
+            self.__class__.__name__, self.workername, time.time() - started))
         raise LatentWorkerFailedToSubstantiate(self.workername, "exhausted instance types")
 
+    def _cancel_spot_requests(self, reqids, extra_instances):
+        """
+        Cancels outstanding spot requests, adding the IDs of any instances that
+        were launched for them before the cancellation to extra_instances.
+        """
+        log.msg('{} {} cancelling spot requests: {}'.format(
+            self.__class__.__name__, self.workername, ', '.join(reqids)))
+        self.ec2.meta.client.cancel_spot_instance_requests(SpotInstanceRequestIds=reqids)
+        requests = self.ec2.meta.client.describe_spot_instance_requests(
+            SpotInstanceRequestIds=reqids)['SpotInstanceRequests']
+        extra_instances += [r['InstanceId'] for r in requests if r.get('InstanceId')]
+
 
 def active_slots(w):
     return [wfb for wfb in w.workerforbuilders.values() if wfb.isBusy()]
 
 
+def cache_key(bldr, br):
+    """
+    Returns the (project, branch, buildername) key identifying the caches
+    (TMPDIR, sstate, downloads) a build request will use.
+    """
+    props = bldr.config.properties if bldr.config else {}
+    ss = next(iter(br.sources.values()), None) if br.sources else None
+    project = (ss.project if ss is not None else None) or props.get('project')
+    branch = (ss.branch if ss is not None else None) or props.get('branch')
+    return project, branch, bldr.name
+
+
 def nextEC2Worker(bldr, wfbs, br):
     """
     Called by BuildRequestDistributor to identify a worker to queue
@@ -407,26 +1012,30 @@ def nextEC2Worker(bldr, wfbs, br):
         - Prefer non-latent workers over latent workers
         - Prefer running latent workers with available slots over non-running (even pending) ones.
         - Prefer pending latent workers over those that are shut down or shutting down.
-        - Sort preferred latent workers based on number of available slots
+        - Sort preferred latent workers based on number of available slots, plus a
+          bonus for workers whose instance recently ran a build of the same project,
+          branch and builder and so has warm caches. Stopped warm pool instances get
+          half the bonus.
+    Instance states come from instance_state() (the state poller's snapshot, if
+    enabled), so no API calls are made here.
     :param bldr: Builder object
     :param wfbs: list of WorkerForBuilder objects
     :param br: BuildRequest object
     :return: WorkerForBuilder object
     """
-    from buildbot.worker.ec2 import TERMINATED, PENDING, RUNNING
     log.msg('nextEC2Worker: %d WorkerForBuilders: %s' % (len(wfbs),
                                                          ','.join([wfb.worker.name for wfb in wfbs])))
     candidates = [wfb for wfb in wfbs if wfb.isAvailable()]
     log.msg('nextEC2Worker: %d candidates: %s' % (len(candidates),
                                                   ','.join([wfb.worker.name for wfb in candidates])))
+    key = cache_key(bldr, br)
+    now = time.time()
     wdict = {}
     realworkers = []
     for wfb in candidates:
         if wfb.worker is not None and isinstance(wfb.worker, MyEC2LatentWorker):
-            if wfb.worker.instance:
-                statename = wfb.worker.instance.state['Name']
-            else:
-                statename = TERMINATED
+            statename = wfb.worker.instance_state()
+            affinity = wfb.worker.cache_affinity(key, now)
             if statename in [PENDING, RUNNING]:
                 if wfb.worker.max_builds:
                     slots = wfb.worker.max_builds - len(active_slots(wfb.worker))
@@ -434,16 +1043,22 @@ def nextEC2Worker(bldr, wfbs, br):
                     # its score so it gets chosen first.
                     if slots > 0 and statename == RUNNING:
                         slots += 100
-                    log.msg('nextEC2Worker:   worker %s score=%d' % (wfb.worker.name, slots))
-                    if slots in wdict.keys():
-                        wdict[slots].append(wfb)
+                    score = slots + affinity
+                    log.msg('nextEC2Worker:   worker %s score=%.1f' % (wfb.worker.name, score))
+                    if score in wdict.keys():
+                        wdict[score].append(wfb)
                     else:
-                        wdict[slots] = [wfb]
+                        wdict[score] = [wfb]
             else:
-                if 0 in wdict.keys():
-                    wdict[0].append(wfb)
+                score = 0.0
+                if wfb.worker.warm_pool is not None and wfb.worker.warm_pool.holds(wfb.worker.name):
+                    score += affinity / 2
+                if score:
+                    log.msg('nextEC2Worker:   worker %s score=%.1f (warm pool)' % (wfb.worker.name, score))
+                if score in wdict.keys():
+                    wdict[score].append(wfb)
                 else:
-                    wdict[0] = [wfb]
+                    wdict[score] = [wfb]
         else:
             log.msg('nextEC2Worker:   non-latent worker: %s' % wfb.worker.name)
             realworkers.append(wfb)
@@ -451,5 +1066,7 @@ def nextEC2Worker(bldr, wfbs, br):
         log.msg('nextEC2Worker: chose (non-latent): %s' % realworkers[0].worker.name)
         return realworkers[0]
     best = sorted(wdict.keys(), reverse=True)[0]
-    log.msg('nextEC2Worker: chose: %s (score=%d)' % (wdict[best][0].worker.name, best))
-    return wdict[best][0]
+    chosen = wdict[best][0]
+    log.msg('nextEC2Worker: chose: %s (score=%.1f)' % (chosen.worker.name, best))
+    chosen.worker.record_cache_use(key)
+    return chosen
@@ -0,0 +1,114 @@
+from botocore.client import ClientError
+from twisted.python import log
+
+# AWS limit on the number of versions deleted in one call
+DELETE_BATCH_SIZE = 200
+
+
+class EC2Fleet(object):
+    """
+    Instance acquisition through instant-mode EC2 Fleet requests.
+
+    A fleet request covers every (instance type, subnet) candidate at once
+    and lets EC2 choose among them using the configured allocation strategy,
+    rather than having the worker try candidates one at a time.
+
+    EC2 Fleet has no way of falling back from spot to on-demand capacity
+    within a single instant request, so when on_demand_fallback is set and
+    the spot request comes back empty, a second on-demand request is issued
+    against the same launch template and candidates.
+    """
+    SPOT_ALLOCATION_STRATEGIES = ('capacity-optimized', 'price-capacity-optimized',
+                                  'capacity-optimized-prioritized', 'lowest-price', 'diversified')
+    ON_DEMAND_ALLOCATION_STRATEGIES = ('lowest-price', 'prioritized')
+
+    def __init__(self, allocation_strategy='price-capacity-optimized', on_demand_fallback=False,
+                 on_demand_allocation_strategy='lowest-price'):
+        if allocation_strategy not in self.SPOT_ALLOCATION_STRATEGIES:
+            raise ValueError('Unknown spot allocation strategy: {}'.format(allocation_strategy))
+        if on_demand_allocation_strategy not in self.ON_DEMAND_ALLOCATION_STRATEGIES:
+            raise ValueError('Unknown on-demand allocation strategy: {}'.format(on_demand_allocation_strategy))
+        self.allocation_strategy = allocation_strategy
+        self.on_demand_fallback = on_demand_fallback
+        self.on_demand_allocation_strategy = on_demand_allocation_strategy
+
+    @staticmethod
+    def ensure_launch_template(client, name, template_data):
+        """
+        Creates the named launch template, or a new version of it if it
+        already exists, which is made the default version, deleting the
+        template's other versions. Returns the launch template specification
+        to use in fleet requests.
+        """
+        try:
+            result = client.create_launch_template(LaunchTemplateName=name,
+                                                   LaunchTemplateData=template_data)
+            template = result['LaunchTemplate']
+            return {'LaunchTemplateId': template['LaunchTemplateId'],
+                    'Version': str(template['LatestVersionNumber'])}
+        except ClientError as e:
+            if 'AlreadyExists' not in str(e):
+                raise
+        result = client.create_launch_template_version(LaunchTemplateName=name,
+                                                       LaunchTemplateData=template_data)
+        version = result['LaunchTemplateVersion']
+        client.modify_launch_template(LaunchTemplateName=name, DefaultVersion=str(version['VersionNumber']))
+        EC2Fleet._delete_old_versions(client, name, version['VersionNumber'])
+        return {'LaunchTemplateId': version['LaunchTemplateId'],
+                'Version': str(version['VersionNumber'])}
+
+    @staticmethod
+    def _delete_old_versions(client, name, current):
+        try:
+            old = []
+            paginator = client.get_paginator('describe_launch_template_versions')
+            for page in paginator.paginate(LaunchTemplateName=name):
+                old += [str(v['VersionNumber']) for v in page['LaunchTemplateVersions']
+                        if v['VersionNumber'] != current]
+            for i in range(0, len(old), DELETE_BATCH_SIZE):
+                client.delete_launch_template_versions(LaunchTemplateName=name,
+                                                       Versions=old[i:i + DELETE_BATCH_SIZE])
+        except ClientError as e:
+            log.msg('EC2Fleet: could not delete old versions of launch template {}: {}'.format(name, e))
+
+    def _request(self, client, template_spec, overrides, capacity_type, failed=None):
+        request = dict(
+            Type='instant',
+            LaunchTemplateConfigs=[{'LaunchTemplateSpecification': template_spec,
+                                    'Overrides': overrides}],
+            TargetCapacitySpecification={'TotalTargetCapacity': 1,
+                                         'DefaultTargetCapacityType': capacity_type}
+        )
+        if capacity_type == 'spot':
+            request['SpotOptions'] = {'AllocationStrategy': self.allocation_strategy}
+        else:
+            request['OnDemandOptions'] = {'AllocationStrategy': self.on_demand_allocation_strategy}
+        result = client.create_fleet(**request)
+        for error in result.get('Errors', []):
+            log.msg('EC2Fleet: {} request error {}: {}'.format(capacity_type, error.get('ErrorCode'),
+                                                              error.get('ErrorMessage')))
+            override = error.get('LaunchTemplateAndOverrides', {}).get('Overrides')
+            if failed is not None and override:
+                failed.append((override.get('InstanceType'), override.get('SubnetId'), error.get('ErrorCode')))
+        for instances in result.get('Instances', []):
+            if instances.get('InstanceIds'):
+                chosen = instances['LaunchTemplateAndOverrides']['Overrides']
+                return instances['InstanceIds'][0], chosen.get('InstanceType'), chosen.get('SubnetId')
+        return None
+
+    def acquire(self, client, template_spec, overrides, spot=True, failed=None):
+        """
+        Requests a single instance from the candidate overrides, each a dict
+        with InstanceType and SubnetId (and optionally MaxPrice) keys.
+        Returns an (instance_id, instance_type, subnet_id) tuple, or None if
+        no capacity could be acquired. If failed is a list, an
+        (instance_type, subnet_id, error_code) tuple is added to it for each
+        spot candidate the fleet reported an error for.
+        """
+        if spot:
+            result = self._request(client, template_spec, overrides, 'spot', failed)
+            if result is not None or not self.on_demand_fallback:
+                return result
+            log.msg('EC2Fleet: no spot capacity, falling back to on-demand')
+            overrides = [{k: v for k, v in o.items() if k != 'MaxPrice'} for o in overrides]
+        return self._request(client, template_spec, overrides, 'on-demand')
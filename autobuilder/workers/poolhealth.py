@@ -0,0 +1,95 @@
+import math
+import threading
+import time
+
+from twisted.python import log
+
+# Failure weights by spot request status (or other outcome); statuses not
+# listed count as DEFAULT_WEIGHT. The worker's own cancellations are not
+# failures of the pool.
+FAILURE_WEIGHTS = {
+    'capacity-not-available': 1.0,
+    'capacity-oversubscribed': 1.0,
+    'constraint-not-fulfillable': 1.0,
+    'schedule-expired': 1.0,
+    'InsufficientInstanceCapacity': 1.0,
+    'unsuccessful': 0.5,
+    'price-too-low': 0.5,
+    'interruption': 2.0,
+    'cancelled': 0.0,
+}
+DEFAULT_WEIGHT = 0.5
+
+
+class PoolHealth(object):
+    """
+    Failure history of spot capacity pools (availability zone and instance
+    type), shared by all workers in the master. Each failed request adds
+    its weight to the pool's score, which halves every half_life seconds;
+    a fulfilled request clears it.
+
+    When spot bids are ordered, pools with a score below healthy_score keep
+    their order, the others follow in order of increasing score, and pools
+    at or above skip_score are left out, unless that would leave no pools
+    at all.
+    """
+    def __init__(self, half_life=15 * 60, healthy_score=0.25, skip_score=2.0):
+        self.half_life = half_life
+        self.healthy_score = healthy_score
+        self.skip_score = skip_score
+        self._lock = threading.Lock()
+        self._scores = {}
+
+    def _decayed(self, entry, now):
+        score, updated = entry
+        return score * 0.5 ** (max(now - updated, 0) / self.half_life)
+
+    def record_failure(self, zone, instance_type, status, now=None):
+        weight = FAILURE_WEIGHTS.get(status, DEFAULT_WEIGHT)
+        if not weight:
+            return
+        now = now or time.time()
+        with self._lock:
+            entry = self._scores.get((zone, instance_type))
+            score = (self._decayed(entry, now) if entry else 0.0) + weight
+            self._scores[(zone, instance_type)] = (score, now)
+        log.msg('PoolHealth: {} {} {}, score now {:.2f}'.format(zone, instance_type, status, score))
+
+    def record_success(self, zone, instance_type):
+        with self._lock:
+            self._scores.pop((zone, instance_type), None)
+
+    def score(self, zone, instance_type, now=None):
+        with self._lock:
+            entry = self._scores.get((zone, instance_type))
+        return self._decayed(entry, now or time.time()) if entry else 0.0
+
+    def order(self, bids, now=None):
+        """
+        Orders a list of tuples starting with (zone, instance_type) as
+        described above, keeping the given order among healthy pools.
+        """
+        now = now or time.time()
+        scored = []
+        for bid in bids:
+            score = self.score(bid[0], bid[1], now)
+            scored.append((score if score >= self.healthy_score else 0.0, bid))
+        usable = [x for x in scored if x[0] < self.skip_score] or scored
+        if len(usable) < len(scored):
+            log.msg('PoolHealth: skipping {}'.format(', '.join(
+                '{}:{} ({:.2f})'.format(bid[0], bid[1], score) for score, bid in scored if score >= self.skip_score)))
+        return [bid for _, bid in sorted(usable, key=lambda x: x[0])]
+
+    def recovery_time(self, pools, now=None):
+        """
+        Returns the number of seconds until the healthiest of the given
+        (zone, instance_type) pools drops below skip_score.
+        """
+        now = now or time.time()
+        best = min((self.score(zone, instance_type, now) for zone, instance_type in pools), default=0.0)
+        if best < self.skip_score:
+            return 0
+        return self.half_life * math.log2(best / self.skip_score)
+
+
+POOL_HEALTH = PoolHealth()
@@ -0,0 +1,269 @@
+from collections import Counter, deque
+from types import SimpleNamespace
+
+from buildbot import config
+from buildbot.data import resultspec
+from buildbot.schedulers.basic import BaseBasicScheduler
+from buildbot.schedulers.timed import Timed
+from buildbot.util import service
+from buildbot.worker.latent import States
+from twisted.internet import defer, task
+from twisted.python import log
+
+from autobuilder.workers.ec2 import MyEC2LatentWorker, BOOT_TIMES, active_slots
+
+WARM_STATES = (States.SUBSTANTIATING, States.SUBSTANTIATING_STARTING, States.SUBSTANTIATED)
+IDLE_COST_WINDOW = 24 * 60 * 60
+
+
+class PrewarmController(service.BuildbotService):
+    """
+    Starts latent EC2 workers ahead of the builds that will need them.
+
+    Every interval seconds, the controller collects the builds it expects:
+    unclaimed build requests, builds that schedulers with a tree-stable
+    timer (such as SingleBranchSchedulers) will start treeStableTimer
+    seconds after the last change they accept, and the next actuation of
+    Nightly (weekly) schedulers. Changes are tracked from the time the
+    controller sees them added, so changes added before the master started
+    are not taken into account. Each expected build is matched, soonest
+    first, with a worker for its builder that is already running or
+    starting. When there is none, an idle latent worker is substantiated
+    once the build is within that worker's lead time (the recent average
+    boot-to-connect time for its boot path, or default_lead_time, plus
+    lead_margin). Unclaimed build requests are only used for the matching,
+    since the build request distributor already starts workers for them.
+
+    At most max_prewarmed workers started by the controller may be waiting
+    for a build at once. Idle time spent by those workers, priced using
+    hourly_costs (keyed by instance type) or default_hourly_cost, is
+    charged against max_idle_cost dollars per 24 hours; pre-warming stops
+    when the next start would exceed it. A pre-warmed worker that has not
+    started a build within idle_timeout seconds of connecting is shut down
+    again.
+
+    Add an instance to c['services'] in the master configuration.
+    """
+    name = 'autobuilder-prewarm'
+    _loop = None
+    _consumer = None
+
+    def checkConfig(self, interval=30, default_lead_time=600, lead_margin=60, max_prewarmed=2,
+                    max_idle_cost=None, hourly_costs=None, default_hourly_cost=1.0, idle_timeout=900):
+        if interval <= 0:
+            config.error('interval must be positive')
+        if max_prewarmed < 0:
+            config.error('max_prewarmed must not be negative')
+        if max_idle_cost is not None and max_idle_cost < 0:
+            config.error('max_idle_cost must not be negative')
+        if idle_timeout <= 0:
+            config.error('idle_timeout must be positive')
+
+    def reconfigService(self, interval=30, default_lead_time=600, lead_margin=60, max_prewarmed=2,
+                        max_idle_cost=None, hourly_costs=None, default_hourly_cost=1.0, idle_timeout=900):
+        self.interval = interval
+        self.default_lead_time = default_lead_time
+        self.lead_margin = lead_margin
+        self.max_prewarmed = max_prewarmed
+        self.max_idle_cost = max_idle_cost
+        self.hourly_costs = hourly_costs or {}
+        self.default_hourly_cost = default_hourly_cost
+        self.idle_timeout = idle_timeout
+        if self._loop is not None:
+            self._loop.interval = interval
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        self._prewarmed = {}
+        self._spent = deque()
+        self._polling = False
+        self._changes = {}
+        yield super().startService()
+        self._consumer = yield self.master.mq.startConsuming(self._change_added, ('changes', None, 'new'))
+        self._loop = task.LoopingCall(self._poll)
+        self._loop.clock = self.master.reactor
+        self._loop.start(self.interval, now=False)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+        if self._consumer is not None:
+            yield self._consumer.stopConsuming()
+            self._consumer = None
+        yield super().stopService()
+
+    def _change_added(self, key, change):
+        self._changes[change['changeid']] = (self.master.reactor.seconds(), change)
+
+    def _lead_time(self, w):
+        times = BOOT_TIMES.get(w.boot_path)
+        boot = sum(times) / len(times) if times else self.default_lead_time
+        return boot + self.lead_margin
+
+    def _hourly_cost(self, w):
+        instance_type = None
+        if w.substantiation_attempts:
+            instance_type = w.substantiation_attempts[-1].instance_type
+        if instance_type is None:
+            instance_type = w.instance_type or w.instance_types[0]
+        return self.hourly_costs.get(instance_type, self.default_hourly_cost)
+
+    def idle_cost(self, now):
+        """
+        Returns the idle cost charged during the last 24 hours.
+        """
+        while self._spent and self._spent[0][0] < now - IDLE_COST_WINDOW:
+            self._spent.popleft()
+        return sum(cost for _, cost in self._spent)
+
+    def _charge(self, name, entry, until):
+        if entry['attached'] is None:
+            return
+        idle = max(until - entry['attached'], 0)
+        cost = entry['hourly_cost'] * idle / 3600.0
+        self._spent.append((until, cost))
+        log.msg('PrewarmController: {} idle {:.0f}s before {} (${:.3f})'.format(
+            name, idle, 'build' if entry.get('used') else 'shutdown', cost))
+
+    def _reap(self, now):
+        workers = self.master.workers.workers
+        for name, entry in list(self._prewarmed.items()):
+            w = workers.get(name)
+            if w is None:
+                del self._prewarmed[name]
+                continue
+            if w.last_build_started is not None and w.last_build_started >= entry['started']:
+                entry['used'] = True
+                self._charge(name, entry, w.last_build_started)
+                del self._prewarmed[name]
+            elif w.state == States.SUBSTANTIATED:
+                if entry['attached'] is None:
+                    entry['attached'] = now
+                elif now - entry['attached'] >= self.idle_timeout:
+                    log.msg('PrewarmController: {} unused after {:.0f}s, shutting down ({})'.format(
+                        name, now - entry['attached'], entry['reason']))
+                    self._charge(name, entry, now)
+                    del self._prewarmed[name]
+                    d = w.insubstantiate()
+                    d.addErrback(log.err, 'while insubstantiating pre-warmed worker ' + name)
+            elif w.state not in WARM_STATES:
+                self._charge(name, entry, now)
+                del self._prewarmed[name]
+
+    @defer.inlineCallbacks
+    def _expected_builds(self, now):
+        """
+        Returns a list of (time, buildername, reason) tuples, soonest first.
+        """
+        expected = []
+        builders = yield self.master.data.get(('builders',))
+        names = {b['builderid']: b['name'] for b in builders}
+        pending = yield self.master.data.get(('buildrequests',),
+                                             filters=[resultspec.Filter('claimed', 'eq', [False]),
+                                                      resultspec.Filter('complete', 'eq', [False])])
+        for br in pending:
+            if br['builderid'] in names:
+                expected.append((now, names[br['builderid']], 'pending'))
+        schedulers = list(self.master.scheduler_manager.namedServices.values())
+        window = max([s.treeStableTimer or 0 for s in schedulers if isinstance(s, BaseBasicScheduler)] + [0])
+        for changeid, (added, _) in list(self._changes.items()):
+            if added < now - window:
+                del self._changes[changeid]
+        for sched in schedulers:
+            if isinstance(sched, BaseBasicScheduler):
+                if not sched.treeStableTimer:
+                    continue
+                accepted = [added for added, change in self._changes.values()
+                            if sched.change_filter is None or
+                            sched.change_filter.filter_change(SimpleNamespace(**change))]
+                when = [max(accepted) + sched.treeStableTimer] if accepted else []
+                when = [t for t in when if t > now]
+                reason = sched.name + ' tree-stable timer'
+            elif isinstance(sched, Timed) and sched.actuateAt is not None:
+                when = [sched.actuateAt]
+                reason = sched.name + ' scheduled build'
+            else:
+                continue
+            for t in when:
+                expected += [(t, bname, reason) for bname in sched.builderNames]
+        return sorted(expected, key=lambda x: x[0])
+
+    def _plan(self, now, expected):
+        """
+        Matches expected builds with workers, returning a list of
+        (worker, workerforbuilder, time, reason) tuples for idle latent
+        workers that should be started now.
+        """
+        claimed = Counter()
+        starts = []
+        for when, bname, reason in expected:
+            builder = self.master.botmaster.builders.get(bname)
+            if builder is None:
+                continue
+            warm = None
+            cold = None
+            for wfb in builder.workers:
+                w = wfb.worker
+                if w is None:
+                    continue
+                if (w.max_builds or 1) - len(active_slots(w)) - claimed[w.name] <= 0:
+                    continue
+                if not isinstance(w, MyEC2LatentWorker):
+                    if wfb.isAvailable():
+                        warm = w
+                        break
+                elif w.state in WARM_STATES:
+                    warm = w
+                    break
+                elif cold is None and w.state == States.NOT_SUBSTANTIATED and w.canStartBuild():
+                    cold = (w, wfb)
+            if warm is not None:
+                claimed[warm.name] += 1
+                continue
+            if cold is None:
+                continue
+            w, wfb = cold
+            claimed[w.name] += w.max_builds or 1
+            if reason != 'pending' and when - now <= self._lead_time(w):
+                starts.append((w, wfb, when, reason))
+        return starts
+
+    def _prewarm(self, now, w, wfb, when, reason):
+        if len(self._prewarmed) >= self.max_prewarmed:
+            log.msg('PrewarmController: not starting {} for {}: {} workers already pre-warmed'.format(
+                w.name, reason, len(self._prewarmed)))
+            return False
+        hourly_cost = self._hourly_cost(w)
+        boot = self._lead_time(w) - self.lead_margin
+        estimate = hourly_cost * (max(when - now - boot, 0) + self.lead_margin) / 3600.0
+        if self.max_idle_cost is not None and self.idle_cost(now) + estimate > self.max_idle_cost:
+            log.msg('PrewarmController: not starting {} for {}: idle cost budget exhausted'.format(w.name, reason))
+            return False
+        log.msg('PrewarmController: starting {} for {} in {:.0f}s'.format(w.name, reason, when - now))
+        self._prewarmed[w.name] = {'started': now, 'attached': None, 'hourly_cost': hourly_cost, 'reason': reason}
+        d = w.substantiate(wfb, None)
+
+        def failed(f):
+            log.msg('PrewarmController: pre-warming {} failed: {}'.format(w.name, f.getErrorMessage()))
+        d.addErrback(failed)
+        return True
+
+    @defer.inlineCallbacks
+    def _poll(self):
+        if self._polling:
+            return
+        self._polling = True
+        try:
+            now = self.master.reactor.seconds()
+            self._reap(now)
+            expected = yield self._expected_builds(now)
+            for w, wfb, when, reason in self._plan(now, expected):
+                if not self._prewarm(now, w, wfb, when, reason):
+                    break
+        except Exception:
+            log.err(None, 'PrewarmController: poll failed')
+        finally:
+            self._polling = False
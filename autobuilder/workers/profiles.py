@@ -0,0 +1,218 @@
+import json
+import os
+import statistics
+import threading
+from collections import deque
+
+from buildbot.process.results import SUCCESS, WARNINGS
+from buildbot.util import service
+from twisted.internet import defer
+from twisted.python import log
+
+from autobuilder.utils import timestamp
+
+POLICIES = ('cost', 'time')
+
+# vCPU counts by instance type, filled in from describe_instance_types as needed
+INSTANCE_VCPUS = {}
+_vcpus_lock = threading.Lock()
+
+
+def instance_vcpus(client, instance_types):
+    """
+    Returns a dict mapping each of the given instance types to its default
+    vCPU count.
+    """
+    with _vcpus_lock:
+        missing = sorted(t for t in set(instance_types) if t not in INSTANCE_VCPUS)
+    if missing:
+        paginator = client.get_paginator('describe_instance_types')
+        for page in paginator.paginate(InstanceTypes=missing):
+            with _vcpus_lock:
+                for itype in page.get('InstanceTypes', []):
+                    INSTANCE_VCPUS[itype['InstanceType']] = itype['VCpuInfo']['DefaultVCpus']
+    with _vcpus_lock:
+        return {t: INSTANCE_VCPUS[t] for t in instance_types if t in INSTANCE_VCPUS}
+
+
+def load_expected_durations(path):
+    """
+    Returns a dict mapping builder name to the median of the durations
+    saved by BuildProfiles in the file at path, on any instance type.
+    """
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r') as f:
+            saved = json.load(f)
+    except (OSError, ValueError) as e:
+        log.msg('BuildProfiles: could not load {}: {}'.format(path, e))
+        return {}
+    return {buildername: statistics.median(x for durations in bytype.values() for x in durations)
+            for buildername, bytype in saved.items() if any(bytype.values())}
+
+
+class BuildProfiles(service.BuildbotService):
+    """
+    Records how long each builder's successful builds take on each instance
+    type, from the instance_type worker property of finished builds. The
+    most recent max_samples durations per (builder, instance type) are kept,
+    and saved to the JSON file at path, if set, so they survive a master
+    restart.
+
+    Add an instance to c['services'] in the master configuration, and pass
+    it to an InstanceTypeSelector.
+    """
+    name = 'autobuilder-build-profiles'
+    _durations = None
+    _consumer = None
+
+    def checkConfig(self, path=None, max_samples=20):
+        if max_samples < 1:
+            raise ValueError('max_samples must be at least 1')
+
+    def reconfigService(self, path=None, max_samples=20):
+        self.path = path
+        self.max_samples = max_samples
+        if self._durations is not None:
+            return defer.succeed(None)
+        self._durations = {}
+        if self.path and os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    saved = json.load(f)
+                for buildername, bytype in saved.items():
+                    for instance_type, durations in bytype.items():
+                        self._durations[(buildername, instance_type)] = deque(durations, maxlen=max_samples)
+            except (OSError, ValueError) as e:
+                log.msg('BuildProfiles: could not load {}: {}'.format(self.path, e))
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self._consumer = yield self.master.mq.startConsuming(self._build_finished, ('builds', None, 'finished'))
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if self._consumer is not None:
+            yield self._consumer.stopConsuming()
+            self._consumer = None
+        yield super().stopService()
+
+    @defer.inlineCallbacks
+    def _build_finished(self, key, build):
+        try:
+            if build['results'] not in (SUCCESS, WARNINGS) or build['complete_at'] is None:
+                return
+            props = yield self.master.data.get(('builds', build['buildid'], 'properties'))
+            if 'instance_type' not in props:
+                return
+            builder = yield self.master.data.get(('builders', build['builderid']))
+            duration = timestamp(build['complete_at']) - timestamp(build['started_at'])
+            self.record(builder['name'], props['instance_type'][0], duration)
+        except Exception:
+            log.err(None, 'BuildProfiles: recording build {}'.format(build.get('buildid')))
+
+    def record(self, buildername, instance_type, duration):
+        self._durations.setdefault((buildername, instance_type),
+                                   deque(maxlen=self.max_samples)).append(round(duration, 1))
+        if self.path:
+            self._save()
+
+    def _save(self):
+        saved = {}
+        for (buildername, instance_type), durations in self._durations.items():
+            saved.setdefault(buildername, {})[instance_type] = list(durations)
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(saved, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.msg('BuildProfiles: could not save {}: {}'.format(self.path, e))
+
+    def durations(self, buildername):
+        """
+        Returns a dict mapping instance type to the median recorded duration
+        of the builder's builds on that type.
+        """
+        return {instance_type: statistics.median(d) for (bname, instance_type), d in list(self._durations.items())
+                if bname == buildername and d}
+
+    def expected_duration(self, buildername):
+        """
+        Returns the median recorded duration of the builder's builds on any
+        instance type, or None if there are none.
+        """
+        durations = [x for (bname, _), d in list(self._durations.items()) if bname == buildername for x in d]
+        return statistics.median(durations) if durations else None
+
+
+class InstanceTypeSelector(object):
+    """
+    Orders the candidate instance types of a spot or fleet worker for the
+    build it is being started for, using the build's recorded durations.
+
+    The expected duration on an instance type is the median recorded on
+    that type. For types with no history, it is estimated from the others
+    by assuming that duration scales as vCPUs ** -scaling (1.0 for a build
+    that parallelizes perfectly, 0 for one that does not benefit from more
+    vCPUs at all). With policy 'cost', candidates are ordered by expected
+    duration times hourly price (spot bid price, or vCPU count when there is
+    no price); with policy 'time', by expected duration, with price as the
+    tie-breaker. Builders with no history keep the worker's default order.
+    """
+    def __init__(self, profiles, policy='cost', scaling=0.8):
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of: {}'.format(', '.join(POLICIES)))
+        if not 0 <= scaling <= 1:
+            raise ValueError('scaling must be between 0 and 1')
+        self.profiles = profiles
+        self.policy = policy
+        self.scaling = scaling
+
+    def estimates(self, buildername, instance_types, vcpus):
+        """
+        Returns a dict mapping each instance type with enough information to
+        its expected build duration.
+        """
+        observed = {t: d for t, d in self.profiles.durations(buildername).items() if t in vcpus}
+        result = {}
+        for instance_type in instance_types:
+            if instance_type in observed:
+                result[instance_type] = observed[instance_type]
+            elif instance_type in vcpus and observed:
+                result[instance_type] = statistics.median(
+                    d * (vcpus[t] / vcpus[instance_type]) ** self.scaling for t, d in observed.items())
+        return result
+
+    def rank(self, buildername, candidates, client):
+        """
+        Sorts a list of (zone, instance_type, hourly_price) tuples, where
+        hourly_price may be None, into the order they should be tried.
+        """
+        if buildername is None or not candidates:
+            return candidates
+        instance_types = sorted(set(c[1] for c in candidates))
+        vcpus = instance_vcpus(client, set(instance_types) | set(self.profiles.durations(buildername)))
+        estimates = self.estimates(buildername, instance_types, vcpus)
+        if not estimates:
+            return candidates
+
+        def price(c):
+            return c[2] if c[2] is not None else vcpus.get(c[1], 1)
+
+        def score(c):
+            est = estimates.get(c[1])
+            if est is None:
+                return float('inf'), price(c)
+            if self.policy == 'cost':
+                return est * price(c), est
+            return est, price(c)
+
+        ranked = sorted(candidates, key=score)
+        log.msg('InstanceTypeSelector: {} ({} policy): {}'.format(
+            buildername, self.policy, ', '.join('{} {:.0f}s'.format(t, estimates[t])
+                                                for t in sorted(estimates, key=estimates.get))))
+        return ranked
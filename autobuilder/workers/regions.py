@@ -0,0 +1,46 @@
+from botocore.client import ClientError
+from buildbot.interfaces import LatentWorkerFailedToSubstantiate
+
+# Error codes from instance launches and spot/fleet requests that mean the
+# region cannot supply an instance right now, as opposed to a configuration
+# problem that another region would not fix.
+CAPACITY_ERRORS = ('InsufficientInstanceCapacity', 'InsufficientCapacity', 'InstanceLimitExceeded',
+                   'VcpuLimitExceeded', 'MaxSpotInstanceCountExceeded', 'SpotMaxPriceTooLow',
+                   'Unsupported')
+
+
+class RegionSpec(object):
+    """
+    An additional region an EC2 worker can spill over to when its own
+    region has no capacity for it. Subnets, security groups and AMIs are
+    region-specific, so each region needs its own: subnet (on-demand
+    workers) or subnets (spot and fleet workers), security_group_ids,
+    and ami, plus baked_ami for workers that boot from a baked AMI.
+    instance_types, if set, replaces the worker's instance types in this
+    region (for spot and fleet workers).
+    """
+    def __init__(self, region, security_group_ids, subnet=None, subnets=None, ami=None,
+                 baked_ami=None, instance_types=None):
+        if subnet and subnets:
+            raise ValueError('Specify only one of subnet, subnets for region {}'.format(region))
+        if not subnet and not subnets:
+            raise ValueError('Missing subnet or subnets for region {}'.format(region))
+        self.region = region
+        self.security_group_ids = security_group_ids
+        self.subnet = subnet
+        self.subnets = subnets or [subnet]
+        self.ami = ami
+        self.baked_ami = baked_ami
+        self.instance_types = instance_types
+
+
+def is_capacity_failure(failure):
+    """
+    Returns True if the exception raised while trying to start an instance
+    means the region is out of capacity for the worker.
+    """
+    if isinstance(failure, LatentWorkerFailedToSubstantiate):
+        return True
+    if isinstance(failure, ClientError):
+        return failure.response.get('Error', {}).get('Code') in CAPACITY_ERRORS
+    return False
@@ -0,0 +1,53 @@
+import hashlib
+import hmac
+import json
+
+from buildbot.www.hooks.base import BaseHookHandler
+from twisted.internet import defer
+from twisted.python import log
+
+from autobuilder.workers.ec2 import MyEC2LatentWorker
+
+NOTICE_KINDS = ('interruption', 'rebalance', 'sstate-pushed')
+# Reports accepted from any EC2 worker, not only spot workers
+REPORT_KINDS = ('disk-throughput',)
+
+
+class SpotNoticeHandler(BaseHookHandler):
+    """
+    Change hook dialect that receives the reports sent by the spot notice
+    agent installed on spot workers (see EC2Params spot_notice_url), and the
+    storage throughput reports sent by workers with a storage profile. Reports
+    are JSON bodies signed with an HMAC-SHA256 of the worker's password, and
+    are passed on to the worker; they never produce changes.
+
+    Configure with, for example:
+        c['www']['change_hook_dialects']['spot'] = {'custom_class': SpotNoticeHandler,
+                                                    'grace': 90}
+    where grace is the number of seconds running builds are given after an
+    interruption notice (for the sstate push) before they are stopped and
+    retried.
+    """
+    def getChanges(self, request):
+        body = request.content.read()
+        signature = request.getHeader(b'X-Autobuilder-Signature')
+        try:
+            payload = json.loads(body)
+            workername = payload['worker']
+            kind = payload['kind']
+        except (ValueError, KeyError, TypeError):
+            raise ValueError('malformed spot notice')
+        if kind not in NOTICE_KINDS + REPORT_KINDS:
+            raise ValueError('unknown spot notice kind: {}'.format(kind))
+        w = self.master.workers.workers.get(workername)
+        if not isinstance(w, MyEC2LatentWorker) or (kind in NOTICE_KINDS and not w.spot_instance):
+            raise ValueError('spot notice for unknown worker {}'.format(workername))
+        expected = 'sha256=' + hmac.new(bytes(w.password, 'utf-8'), body, hashlib.sha256).hexdigest()
+        if signature is None or not hmac.compare_digest(expected, signature.decode('ascii', 'replace')):
+            log.msg('SpotNoticeHandler: bad signature on {} notice for {}'.format(kind, workername))
+            raise ValueError('bad spot notice signature')
+        if kind == 'disk-throughput':
+            w.storage_report(payload.get('detail'))
+        else:
+            w.spot_notice(kind, payload.get('detail'), grace=(self.options or {}).get('grace', 90))
+        return defer.succeed(([], None))
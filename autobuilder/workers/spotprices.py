@@ -0,0 +1,174 @@
+import bisect
+import datetime
+import math
+import threading
+import time
+from collections import namedtuple
+
+from twisted.python import log
+
+PoolStats = namedtuple('PoolStats', ['mean', 'median', 'p90', 'volatility', 'latest', 'samples'])
+
+ESTIMATORS = ('mean', 'median', 'p90', 'latest')
+
+SPOT_PRICE_SERVICES = {}
+_services_lock = threading.Lock()
+
+
+def get_spot_price_service(client, region, ttl=300, history_seconds=86400):
+    """
+    Returns the spot price service shared by all workers in a region,
+    creating it (with the given client) on first use.
+    """
+    with _services_lock:
+        service = SPOT_PRICE_SERVICES.get(region)
+        if service is None:
+            service = SpotPriceService(client, region, ttl=ttl, history_seconds=history_seconds)
+            SPOT_PRICE_SERVICES[region] = service
+        return service
+
+
+def _weighted_percentile(pairs, total, fraction):
+    """
+    Percentile of (price, duration) pairs sorted by price.
+    """
+    target = total * fraction
+    acc = 0.0
+    for price, duration in pairs:
+        acc += duration
+        if acc >= target:
+            return price
+    return pairs[-1][0]
+
+
+def pool_statistics(history, start, end):
+    """
+    Computes time-weighted statistics for one pool's price history, a list
+    of (timestamp, price) tuples sorted by timestamp. Each price is in effect
+    from its timestamp until the next one, clipped to the [start, end) window,
+    so a price that held for hours counts for more than a brief spike.
+    """
+    if not history:
+        return None
+    # The first entry may predate the window; it is the price in effect at its start.
+    first = max(bisect.bisect_right([t for t, _ in history], start) - 1, 0)
+    history = history[first:]
+    pairs = []
+    for i, (timestamp, price) in enumerate(history):
+        t0 = max(timestamp, start)
+        t1 = history[i + 1][0] if i + 1 < len(history) else end
+        if t1 > t0:
+            pairs.append((price, t1 - t0))
+    if not pairs:
+        pairs = [(history[-1][1], 1.0)]
+    total = sum(d for _, d in pairs)
+    mean = sum(p * d for p, d in pairs) / total
+    variance = sum(d * (p - mean) ** 2 for p, d in pairs) / total
+    pairs.sort()
+    return PoolStats(mean=mean,
+                     median=_weighted_percentile(pairs, total, 0.5),
+                     p90=_weighted_percentile(pairs, total, 0.9),
+                     volatility=math.sqrt(variance) / mean if mean else 0.0,
+                     latest=history[-1][1],
+                     samples=len(history))
+
+
+class SpotPriceService(object):
+    """
+    Per-region cache of spot price history and per-pool statistics.
+
+    Workers register the zones and instance types they are interested in,
+    and the service fetches (with pagination) the history for the union of
+    all registered pools, so N workers substantiating at once share a single
+    set of describe_spot_price_history calls. Statistics are computed once per
+    fetch, so bid calculation is a dictionary lookup.
+
+    Cached data older than ttl seconds is returned as-is while a refresh
+    runs in a background thread; data older than max_stale seconds (or a
+    pool not yet covered) is refreshed synchronously.
+    """
+    def __init__(self, client, region, ttl=300, history_seconds=86400, max_stale=None):
+        self.client = client
+        self.region = region
+        self.ttl = ttl
+        self.history_seconds = history_seconds
+        self.max_stale = max_stale or 4 * ttl
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._interest = {}
+        self._stats = {}
+        self._fetched = {}
+        self._refreshing = set()
+
+    def register(self, product_description, zones, instance_types):
+        with self._lock:
+            zset, tset = self._interest.setdefault(product_description, (set(), set()))
+            zset.update(zones)
+            tset.update(instance_types)
+
+    def _is_current(self, product_description, zones, instance_types, max_age):
+        cached = self._stats.get(product_description)
+        return (cached is not None and cached[0].issuperset(zones) and cached[1].issuperset(instance_types) and
+                time.time() - self._fetched[product_description] <= max_age)
+
+    def _refresh(self, product_description, zones=(), instance_types=(), max_age=0):
+        with self._fetch_lock:
+            with self._lock:
+                # Another thread may have fetched what we need while we waited
+                if self._is_current(product_description, zones, instance_types, max_age):
+                    return
+                zones, instance_types = self._interest[product_description]
+                zones = sorted(zones)
+                instance_types = sorted(instance_types)
+            now = time.time()
+            start = now - self.history_seconds
+            paginator = self.client.get_paginator('describe_spot_price_history')
+            histories = {}
+            requests = 0
+            for page in paginator.paginate(
+                    Filters=[dict(Name='availability-zone', Values=zones)],
+                    StartTime=datetime.datetime.fromtimestamp(start, tz=datetime.timezone.utc),
+                    ProductDescriptions=[product_description],
+                    InstanceTypes=instance_types):
+                requests += 1
+                for entry in page.get('SpotPriceHistory', []):
+                    k = (entry['AvailabilityZone'], entry['InstanceType'])
+                    histories.setdefault(k, []).append((entry['Timestamp'].timestamp(),
+                                                        float(entry['SpotPrice'])))
+            stats = {}
+            for k, history in histories.items():
+                history.sort()
+                stats[k] = pool_statistics(history, start, now)
+            log.msg('SpotPriceService {}: refreshed {} pools for {} in {} requests ({:.1f}s)'.format(
+                self.region, len(stats), product_description, requests, time.time() - now))
+            with self._lock:
+                self._stats[product_description] = (frozenset(zones), frozenset(instance_types), stats)
+                self._fetched[product_description] = now
+                self._refreshing.discard(product_description)
+
+    def _background_refresh(self, product_description):
+        try:
+            self._refresh(product_description)
+        except Exception as e:
+            log.msg('SpotPriceService {}: background refresh failed: {}'.format(self.region, e))
+            with self._lock:
+                self._refreshing.discard(product_description)
+
+    def statistics(self, product_description, zones, instance_types):
+        """
+        Returns a dict mapping (zone, instance_type) to PoolStats for the
+        requested pools that have price history.
+        """
+        self.register(product_description, zones, instance_types)
+        with self._lock:
+            fresh = self._is_current(product_description, zones, instance_types, self.ttl)
+            usable = self._is_current(product_description, zones, instance_types, self.max_stale)
+            if usable and not fresh and product_description not in self._refreshing:
+                self._refreshing.add(product_description)
+                threading.Thread(target=self._background_refresh, args=(product_description,),
+                                 name='spotprices-' + self.region, daemon=True).start()
+        if not usable:
+            self._refresh(product_description, zones, instance_types, self.max_stale)
+        with self._lock:
+            stats = self._stats[product_description][2]
+        return {(z, t): stats[(z, t)] for z in zones for t in instance_types if (z, t) in stats}
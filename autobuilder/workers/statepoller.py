@@ -0,0 +1,183 @@
+import threading
+import time
+
+from twisted.internet import task, threads
+from twisted.python import log
+
+# Instances in these states are dropped from polling once seen
+FINAL_STATES = ('stopped', 'terminated')
+# AWS limit on the number of values in one describe_instances filter
+BATCH_SIZE = 200
+
+# Registered instances not seen by describe_instances after this many
+# seconds (e.g. launches that failed) are dropped from polling
+UNSEEN_TIMEOUT = 10 * 60
+
+STATE_POLLERS = {}
+_pollers_lock = threading.Lock()
+
+
+def acquire_state_poller(client, region, interval=15):
+    """
+    Returns the instance state poller shared by all workers using the
+    client (and so the same session and credentials) in the region,
+    creating and starting it with the given interval on first use. Called
+    from the reactor thread, when a worker starts; each call must be
+    matched by a call to release_state_poller() when the worker stops.
+    """
+    with _pollers_lock:
+        key = (id(client), region)
+        poller = STATE_POLLERS.get(key)
+        if poller is None:
+            poller = InstanceStatePoller(client, region, interval)
+            STATE_POLLERS[key] = poller
+            poller.start()
+        poller.users += 1
+        return poller
+
+
+def release_state_poller(poller):
+    """
+    Releases a poller returned by acquire_state_poller(), stopping it once
+    no worker uses it.
+    """
+    with _pollers_lock:
+        poller.users -= 1
+        if poller.users > 0:
+            return
+        key = (id(poller.client), poller.region)
+        if STATE_POLLERS.get(key) is poller:
+            del STATE_POLLERS[key]
+    poller.stop()
+
+
+class InstanceStatePoller(object):
+    """
+    Keeps an in-memory snapshot of the states of the instances of all
+    workers sharing a client in a region, refreshed every interval seconds
+    with batched describe_instances calls made in a thread, so that the
+    reactor thread can look up instance states without making blocking
+    API calls. While any instance is pending (or not yet seen), refreshes
+    happen every pending_interval seconds instead, so that boots are not
+    delayed. Instances not seen within unseen_timeout seconds of being
+    registered are dropped.
+
+    Worker threads waiting for an instance to leave a state wait for the
+    next refresh instead of polling on their own. If the snapshot for the
+    instance gets too old (the reactor is not running the refreshes), they
+    fall back to describing the instance themselves.
+    """
+    def __init__(self, client, region, interval=15, pending_interval=2, unseen_timeout=UNSEEN_TIMEOUT):
+        self.client = client
+        self.region = region
+        self.interval = interval
+        self.pending_interval = min(pending_interval, interval)
+        self.unseen_timeout = unseen_timeout
+        self.users = 0
+        self._last_refresh = 0
+        self._cond = threading.Condition()
+        self._instances = {}
+        self._states = {}
+        self._refreshing = False
+        self._loop = None
+
+    def start(self):
+        self._loop = task.LoopingCall(self._poll)
+        d = self._loop.start(self.pending_interval, now=False)
+        d.addErrback(log.err, 'InstanceStatePoller {} stopped'.format(self.region))
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        self._loop = None
+
+    def register(self, instance_id):
+        with self._cond:
+            self._instances.setdefault(instance_id, time.time())
+
+    def state(self, instance_id):
+        """
+        Returns the last-seen state name of the instance, or None if it has
+        not been seen.
+        """
+        with self._cond:
+            entry = self._states.get(instance_id)
+        return entry[0] if entry else None
+
+    def _update(self, instances, fetched):
+        with self._cond:
+            for instance in instances:
+                instance_id = instance['InstanceId']
+                statename = instance['State']['Name']
+                self._states[instance_id] = (statename, fetched)
+                if statename in FINAL_STATES:
+                    self._instances.pop(instance_id, None)
+            for instance_id, registered in list(self._instances.items()):
+                if instance_id not in self._states and fetched - registered > self.unseen_timeout:
+                    log.msg('InstanceStatePoller {}: instance {} not seen in {}s, dropped'.format(
+                        self.region, instance_id, self.unseen_timeout))
+                    del self._instances[instance_id]
+            self._cond.notify_all()
+
+    def _describe(self, instance_ids):
+        paginator = self.client.get_paginator('describe_instances')
+        instances = []
+        for i in range(0, len(instance_ids), BATCH_SIZE):
+            # Filtering by ID, unlike InstanceIds=, does not fail for instances not visible yet
+            for page in paginator.paginate(Filters=[{'Name': 'instance-id',
+                                                     'Values': instance_ids[i:i + BATCH_SIZE]}]):
+                for reservation in page['Reservations']:
+                    instances += reservation['Instances']
+        return instances
+
+    def _refresh(self):
+        with self._cond:
+            instance_ids = sorted(self._instances)
+        if not instance_ids:
+            return
+        fetched = time.time()
+        self._update(self._describe(instance_ids), fetched)
+
+    def _poll(self):
+        if self._refreshing:
+            return
+        with self._cond:
+            booting = any(self._states.get(i, ('pending',))[0] == 'pending' for i in self._instances)
+        if not booting and time.time() - self._last_refresh < self.interval:
+            return
+        self._last_refresh = time.time()
+        self._refreshing = True
+        d = threads.deferToThread(self._refresh)
+
+        def done(result):
+            self._refreshing = False
+            return result
+
+        def failed(f):
+            log.msg('InstanceStatePoller {}: refresh failed: {}'.format(self.region, f.getErrorMessage()))
+        d.addBoth(done)
+        d.addErrback(failed)
+        return d
+
+    def wait_while(self, instance_id, statename, timeout):
+        """
+        Called from a worker thread. Waits up to timeout seconds for the
+        instance to leave the given state, returning its latest state name.
+        """
+        self.register(instance_id)
+        started = time.time()
+        deadline = started + timeout
+        while True:
+            with self._cond:
+                entry = self._states.get(instance_id)
+                if entry is not None and entry[0] != statename:
+                    return entry[0]
+                now = time.time()
+                if now >= deadline:
+                    return entry[0] if entry else statename
+                if (entry[1] if entry else started) > now - 3 * self.interval:
+                    self._cond.wait(min(deadline - now, self.interval))
+                    continue
+            # The snapshot is not being refreshed; look the instance up directly
+            self._update(self._describe([instance_id]), time.time())
+            started = time.time()
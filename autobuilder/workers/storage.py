@@ -0,0 +1,141 @@
+LAYOUTS = ('auto', 'nvme', 'ebs', 'ebs+nvme')
+EBS_VOLUME_TYPES = ('standard', 'gp2', 'gp3', 'io1', 'io2', 'st1', 'sc1')
+
+# Mount point for fast TMPDIR storage (tmpfs, or instance storage in the
+# ebs+nvme layout). It is mounted directly by the boot commands, outside
+# /scratch, so that it does not depend on the order of the fstab mounts.
+FAST_TMPDIR = '/scratchtmp'
+
+
+class StorageProfile(object):
+    """
+    Describes the scratch storage of an EC2 worker: which devices make up
+    /scratch, the EBS volume (if any) to attach for it, and whether bitbake's
+    TMPDIR goes on faster storage. Layouts:
+
+      auto      instance storage (RAID0 if more than one device) when the
+                instance type has it, plus the legacy scratchvol EBS volume
+                if one is configured
+      nvme      instance storage only, no EBS volume
+      ebs       an EBS volume only; instance storage is left unused
+      ebs+nvme  an EBS volume for /scratch, with instance storage, when the
+                instance type has it, used for TMPDIR
+
+    With tmpfs_min_memory (GiB) set, instances with at least that much
+    memory put TMPDIR on a tmpfs of tmpfs_size instead. The disk setup is
+    done by the boot commands in the cloud-init templates (disk-setup.txt);
+    when measure_mb is not zero, write and read throughput of the scratch
+    and TMPDIR storage is measured once the worker has booted, and reported
+    (see EC2Params spot_notice_url) as the scratch_throughput worker property.
+    """
+    def __init__(self, layout='auto', ebs_size=200, ebs_type='gp3', iops=None, throughput=None,
+                 encrypted=None, device='/dev/xvdf', tmpfs_min_memory=None, tmpfs_size='75%',
+                 measure_mb=1024):
+        if layout not in LAYOUTS:
+            raise ValueError('layout must be one of: {}'.format(', '.join(LAYOUTS)))
+        if ebs_type not in EBS_VOLUME_TYPES:
+            raise ValueError('ebs_type must be one of: {}'.format(', '.join(EBS_VOLUME_TYPES)))
+        if throughput is not None:
+            if ebs_type != 'gp3':
+                raise ValueError('throughput only valid for gp3 volumes')
+            if not 125 <= throughput <= 1000:
+                raise ValueError('gp3 throughput must be between 125 and 1000 MiB/s')
+        if iops is not None:
+            if ebs_type not in ('gp3', 'io1', 'io2'):
+                raise ValueError('iops only valid for gp3, io1, and io2 volumes')
+            if ebs_type == 'gp3' and not 3000 <= iops <= 16000:
+                raise ValueError('gp3 iops must be between 3000 and 16000')
+        if tmpfs_min_memory is not None and tmpfs_min_memory <= 0:
+            raise ValueError('tmpfs_min_memory must be positive')
+        if measure_mb < 0:
+            raise ValueError('measure_mb must not be negative')
+        self.layout = layout
+        self.ebs_size = ebs_size
+        self.ebs_type = ebs_type
+        self.iops = iops
+        self.throughput = throughput
+        self.encrypted = encrypted
+        self.device = device
+        self.tmpfs_min_memory = tmpfs_min_memory
+        self.tmpfs_size = tmpfs_size
+        self.measure_mb = measure_mb
+
+    @classmethod
+    def from_scratchvol(cls, svp):
+        """
+        Returns the profile equivalent to the older scratchvol_params
+        dictionary (or None, for no scratch volume), which keeps the
+        auto layout.
+        """
+        if not svp:
+            return cls('auto', ebs_size=None, measure_mb=0)
+        iops = None
+        if svp['type'] == 'io1':
+            iops = svp.get('iops') or 1000
+        return cls('auto', ebs_size=svp['size'], ebs_type=svp['type'], iops=iops,
+                   encrypted=svp.get('encrypted'), device=svp['name'], measure_mb=0)
+
+    @property
+    def uses_ebs(self):
+        return self.layout in ('ebs', 'ebs+nvme') or (self.layout == 'auto' and self.ebs_size is not None)
+
+    @property
+    def fast_tmpdir(self):
+        return self.layout == 'ebs+nvme' or self.tmpfs_min_memory is not None
+
+    def block_device_map(self):
+        if not self.uses_ebs:
+            return None
+        ebs = {'VolumeType': self.ebs_type,
+               'VolumeSize': self.ebs_size,
+               'DeleteOnTermination': True}
+        if self.encrypted is not None:
+            ebs['Encrypted'] = self.encrypted
+        if self.iops is not None:
+            ebs['Iops'] = self.iops
+        if self.throughput is not None:
+            ebs['Throughput'] = self.throughput
+        return [{'DeviceName': self.device, 'Ebs': ebs}]
+
+    def template_context(self):
+        """
+        Returns the storage variables for the cloud-init templates.
+        """
+        return {'layout': self.layout,
+                'device': self.device,
+                'tmpfs_min_memory': self.tmpfs_min_memory,
+                'tmpfs_size': self.tmpfs_size,
+                'fast_tmpdir': FAST_TMPDIR}
+
+    def extraconf(self):
+        """
+        Returns the local configuration lines that point TMPDIR at the
+        fast storage, when the instance the build runs on has it mounted.
+        """
+        if not self.fast_tmpdir:
+            return []
+        return ['TMPDIR = "${{@\'{0}\' + d.getVar(\'TOPDIR\') if os.path.ismount(\'{0}\') '
+                'else d.getVar(\'TOPDIR\') + \'/tmp\'}}"'.format(FAST_TMPDIR)]
+
+
+STORAGE_PROFILES = {
+    'nvme': StorageProfile('nvme'),
+    'nvme-tmpfs': StorageProfile('nvme', tmpfs_min_memory=128),
+    'gp3': StorageProfile('ebs', ebs_size=300),
+    'gp3-fast': StorageProfile('ebs', ebs_size=300, iops=6000, throughput=500),
+    'ebs+nvme': StorageProfile('ebs+nvme', ebs_size=300, iops=4000, throughput=250),
+    'ebs+nvme-tmpfs': StorageProfile('ebs+nvme', ebs_size=300, iops=4000, throughput=250, tmpfs_min_memory=128),
+}
+
+
+def get_storage_profile(profile):
+    """
+    Returns the StorageProfile for a profile name or instance.
+    """
+    if isinstance(profile, StorageProfile):
+        return profile
+    try:
+        return STORAGE_PROFILES[profile]
+    except KeyError:
+        raise ValueError('unknown storage profile {}; known profiles: {}'.format(
+            profile, ', '.join(sorted(STORAGE_PROFILES))))
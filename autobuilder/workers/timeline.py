@@ -0,0 +1,165 @@
+import threading
+import time
+
+from buildbot import config
+from buildbot.util import service
+from twisted.internet import defer, task
+from twisted.python import log
+
+PHASES = ('bid_computed', 'request_submitted', 'request_fulfilled', 'instance_running', 'worker_attached')
+
+# Upper bounds, in seconds, of the histogram buckets; the last bucket is unbounded.
+BUCKETS = (5, 10, 20, 30, 60, 120, 180, 300, 600, 900, 1800)
+
+TIMELINE_HISTOGRAMS = {}
+_histograms_lock = threading.Lock()
+
+
+def _bucket(seconds):
+    for limit in BUCKETS:
+        if seconds <= limit:
+            return limit
+    return None
+
+
+def record(instance_type, zone, phase, seconds):
+    """
+    Adds one sample, the time from substantiation start to the given phase,
+    to the histogram for the instance type and zone.
+    """
+    with _histograms_lock:
+        hist = TIMELINE_HISTOGRAMS.setdefault((instance_type, zone, phase),
+                                              {'count': 0, 'total': 0.0, 'buckets': {}})
+        hist['count'] += 1
+        hist['total'] += seconds
+        b = _bucket(seconds)
+        hist['buckets'][b] = hist['buckets'].get(b, 0) + 1
+
+
+def summary():
+    """
+    Returns a list of (instance_type, zone, phase, count, mean, buckets)
+    tuples, one per histogram, where buckets is a list of (upper bound,
+    count) pairs with None as the upper bound of the overflow bucket.
+    """
+    with _histograms_lock:
+        items = sorted(TIMELINE_HISTOGRAMS.items(), key=lambda x: (str(x[0][0]), str(x[0][1]),
+                                                                    PHASES.index(x[0][2])))
+        return [(itype, zone, phase, h['count'], h['total'] / h['count'],
+                 [(b, h['buckets'][b]) for b in BUCKETS + (None,) if b in h['buckets']])
+                for (itype, zone, phase), h in items]
+
+
+def _format_buckets(buckets):
+    return ' '.join('<={}:{}'.format(b, n) if b is not None else '>{}:{}'.format(BUCKETS[-1], n)
+                    for b, n in buckets)
+
+
+def log_summary():
+    """
+    Logs one line per histogram returned by summary().
+    """
+    for itype, zone, phase, count, mean, buckets in summary():
+        log.msg('Substantiation timeline: {} {} {}: {} samples, mean {:.1f}s ({})'.format(
+            itype, zone, phase, count, mean, _format_buckets(buckets)))
+
+
+class TimelineReporter(service.BuildbotService):
+    """
+    Logs the substantiation phase histograms every interval seconds, and
+    once more when the master stops.
+
+    Add an instance to c['services'] in the master configuration.
+    """
+    name = 'autobuilder-timeline-reporter'
+    _loop = None
+
+    def checkConfig(self, interval=3600):
+        if interval <= 0:
+            config.error('interval must be positive')
+
+    def reconfigService(self, interval=3600):
+        self.interval = interval
+        if self._loop is not None:
+            self._loop.interval = interval
+        return defer.succeed(None)
+
+    @defer.inlineCallbacks
+    def startService(self):
+        yield super().startService()
+        self._loop = task.LoopingCall(log_summary)
+        self._loop.clock = self.master.reactor
+        self._loop.start(self.interval, now=False)
+
+    @defer.inlineCallbacks
+    def stopService(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+            log_summary()
+        self._loop = None
+        yield super().stopService()
+
+
+class SubstantiationAttempt(object):
+    """
+    Timestamps for the phases of one attempt to substantiate a latent
+    worker: bid computation, spot (or fleet) request submission and
+    fulfillment, the instance reaching the running state, and the worker
+    attaching. Phases that do not apply to the attempt (no bids for an
+    on-demand instance, for example) are simply never marked. Each spot
+    request made during the attempt is also recorded, with its pool and
+    outcome.
+    """
+    def __init__(self, workername, boot_path=None):
+        self.workername = workername
+        self.boot_path = boot_path
+        self.started = time.time()
+        self.marks = {}
+        self.requests = []
+        self.instance_type = None
+        self.zone = None
+        self.outcome = None
+        self._lock = threading.Lock()
+
+    def mark(self, phase, when=None):
+        assert phase in PHASES
+        with self._lock:
+            if phase not in self.marks:
+                self.marks[phase] = (when or time.time()) - self.started
+
+    def add_request(self, zone, instance_type, status, submitted, resolved=None):
+        with self._lock:
+            self.requests.append({'zone': zone, 'instance_type': instance_type, 'status': status,
+                                  'submitted': round(submitted - self.started, 1),
+                                  'resolved': None if resolved is None else round(resolved - self.started, 1)})
+
+    def set_pool(self, instance_type, zone):
+        self.instance_type = instance_type
+        self.zone = zone
+
+    def finish(self, outcome):
+        """
+        Records the outcome ('attached', 'failed', or 'quarantined') and,
+        the first time the attempt finishes, adds its phase times to the
+        histograms.
+        """
+        with self._lock:
+            first = self.outcome is None
+            self.outcome = outcome
+            marks = dict(self.marks)
+        if first:
+            for phase, seconds in marks.items():
+                record(self.instance_type, self.zone, phase, seconds)
+            log.msg('SubstantiationAttempt {}: {} after {:.1f}s ({})'.format(
+                self.workername, outcome, time.time() - self.started,
+                ', '.join('{} {:.1f}s'.format(p, marks[p]) for p in PHASES if p in marks) or 'no phases'))
+
+    def as_dict(self):
+        with self._lock:
+            return {'started': self.started,
+                    'boot_path': self.boot_path,
+                    'instance_type': self.instance_type,
+                    'zone': self.zone,
+                    'outcome': self.outcome,
+                    'phases': {p: round(self.marks[p], 1) for p in PHASES if p in self.marks},
+                    'requests': list(self.requests)}
@@ -0,0 +1,93 @@
+import threading
+import time
+
+from twisted.python import log
+
+WARM_POOL_TAG = 'autobuilder:warm-pool'
+USERDATA_TAG = 'autobuilder:userdata-hash'
+CREATED_TAG = 'autobuilder:created'
+
+
+class WarmPool(object):
+    """
+    Pool of stopped on-demand worker instances.
+
+    When a worker using the pool insubstantiates, its instance is stopped
+    rather than terminated, as long as the pool has room for it and the
+    instance is younger than max_age seconds. The next substantiation of
+    that worker starts the stopped instance again, skipping the first-boot
+    cloud-init work and keeping the contents of its EBS volumes.
+
+    A WarmPool object may be shared by several workers, in which case size
+    limits the total number of stopped instances they keep. Pool membership
+    is tracked with instance tags, so stopped instances are found again
+    after a master restart. Instances that are too old, or that were
+    launched with different user data (e.g., a changed worker password),
+    are terminated when the worker next looks for one.
+    """
+    def __init__(self, size=4, max_age=7 * 24 * 60 * 60):
+        self.size = size
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._members = set()
+
+    @staticmethod
+    def tags(workername, userdata_hash, created):
+        return [{'Key': WARM_POOL_TAG, 'Value': workername},
+                {'Key': USERDATA_TAG, 'Value': userdata_hash},
+                {'Key': CREATED_TAG, 'Value': str(int(created))}]
+
+    @staticmethod
+    def created(instance):
+        tags = {t['Key']: t['Value'] for t in instance.tags or []}
+        try:
+            return int(tags[CREATED_TAG])
+        except (KeyError, ValueError):
+            return None
+
+    def find(self, ec2, workername, userdata_hash):
+        """
+        Returns a stopped instance for the worker that can be started again,
+        or None. Any other pool instances for the worker are terminated.
+        """
+        with self._lock:
+            self._members.discard(workername)
+        chosen = None
+        instances = ec2.instances.filter(Filters=[{'Name': 'tag:' + WARM_POOL_TAG, 'Values': [workername]},
+                                                  {'Name': 'instance-state-name', 'Values': ['stopping', 'stopped']}])
+        for instance in instances:
+            tags = {t['Key']: t['Value'] for t in instance.tags or []}
+            created = self.created(instance)
+            age = None if created is None else time.time() - created
+            if chosen is None and tags.get(USERDATA_TAG) == userdata_hash and age is not None and age < self.max_age:
+                chosen = instance
+                continue
+            log.msg('WarmPool: terminating stale instance {} for {} (age {})'.format(
+                instance.id, workername, 'unknown' if age is None else '%ds' % age))
+            instance.terminate()
+        if chosen is not None and chosen.state['Name'] == 'stopping':
+            log.msg('WarmPool: waiting for instance {} to finish stopping'.format(chosen.id))
+            chosen.wait_until_stopped()
+        return chosen
+
+    def holds(self, workername):
+        """
+        Returns True if the worker's last instance was stopped and kept in
+        the pool.
+        """
+        with self._lock:
+            return workername in self._members
+
+    def admit(self, workername, created):
+        """
+        Returns True if the worker's instance, first launched at the given
+        time, should be stopped and kept in the pool, False if it should be
+        terminated.
+        """
+        if created is None or time.time() - created >= self.max_age:
+            return False
+        with self._lock:
+            if workername in self._members or len(self._members) < self.size:
+                self._members.add(workername)
+                return True
+        return False
@@ -0,0 +1,132 @@
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from buildbot.util import service
+from twisted.internet import defer, reactor
+from twisted.trial import unittest
+
+from autobuilder.aws_secretsprovider.aws_secrets import AWSSecretsManagerProvider
+
+
+class FakeSecretsManager(BaseHTTPRequestHandler):
+    """
+    Minimal Secrets Manager endpoint. Every secret holds {"user": "<name>-user"},
+    or {"user": "<name>-batch"} when retrieved with BatchGetSecretValue.
+    """
+    calls = []
+    delay = 0
+    version_id = 'a' * 32
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        target = self.headers['X-Amz-Target'].split('.')[-1]
+        self.calls.append((target, body.get('SecretId') or body.get('SecretIdList')))
+        time.sleep(self.delay)
+        if target == 'DescribeSecret':
+            out = {'ARN': 'arn:' + body['SecretId'], 'Name': body['SecretId'],
+                   'VersionIdsToStages': {self.version_id: ['AWSCURRENT']}}
+        elif target == 'GetSecretValue':
+            out = {'ARN': 'arn:' + body['SecretId'], 'Name': body['SecretId'], 'VersionId': self.version_id,
+                   'SecretString': json.dumps({'user': body['SecretId'] + '-user'}),
+                   'VersionStages': ['AWSCURRENT']}
+        elif target == 'BatchGetSecretValue':
+            out = {'SecretValues': [{'ARN': 'arn:' + name, 'Name': name,
+                                     'SecretString': json.dumps({'user': name + '-batch'})}
+                                    for name in body['SecretIdList']],
+                   'Errors': []}
+        else:
+            self.send_error(400)
+            return
+        data = json.dumps(out).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class AWSSecretsManagerProviderTest(unittest.TestCase):
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        FakeSecretsManager.calls = []
+        FakeSecretsManager.delay = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSecretsManager)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint_url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.master = service.MasterService()
+        self.master.reactor = reactor
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        if getattr(self, 'provider', None) is not None:
+            yield self.provider.stopService()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @defer.inlineCallbacks
+    def make_provider(self, **kwargs):
+        kwargs.setdefault('region', 'us-east-1')
+        kwargs.setdefault('endpoint_url', self.endpoint_url)
+        self.provider = AWSSecretsManagerProvider(**kwargs)
+        yield self.provider.setServiceParent(self.master)
+        yield self.provider.reconfigService(**kwargs)
+        return self.provider
+
+    def fetches(self, target='GetSecretValue'):
+        return [secret for t, secret in FakeSecretsManager.calls if t == target]
+
+    @defer.inlineCallbacks
+    def test_prefetch(self):
+        provider = yield self.make_provider(prefetch=['a', 'b'])
+        self.assertEqual(self.fetches('BatchGetSecretValue'), [['a', 'b']])
+        value = yield provider.get('b/user')
+        self.assertEqual(value, 'b-batch')
+        self.assertEqual((provider.hits, provider.misses), (1, 0))
+        self.assertEqual(self.fetches(), [])
+
+    @defer.inlineCallbacks
+    def test_concurrent_lookups_share_fetch(self):
+        provider = yield self.make_provider()
+        values = yield defer.gatherResults([provider.get('c/user') for _ in range(3)])
+        self.assertEqual(values, ['c-user'] * 3)
+        self.assertEqual(self.fetches(), ['c'])
+        value = yield provider.get('c/user')
+        self.assertEqual(value, 'c-user')
+        self.assertEqual(self.fetches(), ['c'])
+
+    @defer.inlineCallbacks
+    def test_missing_key(self):
+        provider = yield self.make_provider()
+        with self.assertRaises(KeyError):
+            yield provider.get('c/password')
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        provider = yield self.make_provider(timeout=0.2)
+        FakeSecretsManager.delay = 1
+        with self.assertRaises(defer.TimeoutError):
+            yield provider.get('slow/user')
+        self.assertEqual(provider.timeouts, 1)
+
+    @defer.inlineCallbacks
+    def test_stale_value_served_while_refreshing(self):
+        provider = yield self.make_provider(max_stale=60)
+        expired = time.time() - provider.cache_config.secret_refresh_interval - 10
+        provider._parsed['a'] = (expired, {'user': 'old'})
+        FakeSecretsManager.delay = 0.2
+        value = yield provider.get('a/user')
+        self.assertEqual(value, 'old')
+        self.assertEqual(provider.stale_hits, 1)
+        # Waiting for a refresh joins the one already in progress
+        refreshed = yield provider._refresh('a')
+        self.assertEqual(refreshed, {'user': 'a-user'})
+        self.assertEqual(self.fetches(), ['a'])
+        value = yield provider.get('a/user')
+        self.assertEqual(value, 'a-user')
@@ -0,0 +1,106 @@
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+import boto3
+from buildbot.process.properties import Properties
+from buildbot.worker import AbstractLatentWorker
+from buildbot.worker.latent import States
+from moto import mock_aws
+from twisted.internet import defer
+from twisted.trial import unittest
+
+from autobuilder.workers.awscache import METADATA
+from autobuilder.workers.ec2 import MyEC2LatentWorker
+
+REGION = 'us-east-1'
+
+
+class FakeBuild(object):
+    def __init__(self, buildername):
+        self.builder = SimpleNamespace(name=buildername)
+        self.properties = Properties()
+
+    def setProperty(self, name, value, source):
+        self.properties.setProperty(name, value, source)
+
+
+def fake_substantiate(self, wfb, build):
+    # Stands in for the latent worker's substantiation: starts the instance,
+    # then notifies the waiting builds as the worker attaching would
+    if self.substantiated:
+        return defer.succeed(True)
+    d = self._substantiation_notifier.wait()
+    self.start_instance(build).addCallback(lambda _: self._fireSubstantiationNotifier(True))
+    return d
+
+
+class BuildPropertiesTest(unittest.TestCase):
+    def setUp(self):
+        os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+        os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        METADATA.invalidate()
+        client = boto3.client('ec2', region_name=REGION)
+        vpc = client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']
+        subnet_id = client.create_subnet(VpcId=vpc['VpcId'], CidrBlock='10.0.0.0/24',
+                                         AvailabilityZone=REGION + 'a')['Subnet']['SubnetId']
+        group_id = client.create_security_group(GroupName='workers', Description='workers',
+                                                VpcId=vpc['VpcId'])['GroupId']
+        image_id = client.describe_images(Owners=['amazon'])['Images'][0]['ImageId']
+        self.worker = MyEC2LatentWorker('ec2-worker', 'password', instance_type='t3.micro', ami=image_id,
+                                        region=REGION, identifier='testing', secret_identifier='testing',
+                                        subnet_id=subnet_id, security_group_ids=[group_id])
+        patcher = mock.patch.object(AbstractLatentWorker, 'substantiate', fake_substantiate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @defer.inlineCallbacks
+    def test_first_build_on_instance_has_its_type(self):
+        first = FakeBuild('builder')
+        ready = yield self.worker.substantiate(None, first)
+        self.assertTrue(ready)
+        self.assertEqual(first.properties.getProperty('instance_type'), 't3.micro')
+        self.assertEqual(first.properties.getProperty('ec2_region'), REGION)
+
+        # The next build starts on a fresh instance of a different type
+        self.worker.instance = None
+        self.worker.instance_type = 'm5.large'
+        second = FakeBuild('builder')
+        yield self.worker.substantiate(None, second)
+        self.assertEqual(second.properties.getProperty('instance_type'), 'm5.large')
+        self.assertEqual(first.properties.getProperty('instance_type'), 't3.micro')
+
+    @defer.inlineCallbacks
+    def test_timeline_only_on_waiting_builds(self):
+        first = FakeBuild('builder')
+        yield self.worker.substantiate(None, first)
+        timeline = first.properties.getProperty('substantiation_timeline')
+        self.assertEqual(timeline['outcome'], 'attached')
+        self.assertIn('worker_attached', timeline['phases'])
+        self.assertEqual(len(first.properties.getProperty('substantiation_attempts')), 1)
+        self.assertEqual(first.properties.getProperty('boot_to_connect'), timeline['phases']['worker_attached'])
+
+        # A build that reuses the substantiated worker did not wait for it
+        self.worker.state = States.SUBSTANTIATED
+        self.worker.conn = mock.Mock()
+        second = FakeBuild('builder')
+        yield self.worker.substantiate(None, second)
+        self.assertEqual(second.properties.getProperty('instance_type'), 't3.micro')
+        self.assertFalse(second.properties.hasProperty('substantiation_timeline'))
+        self.assertFalse(second.properties.hasProperty('boot_to_connect'))
+
+    @defer.inlineCallbacks
+    def test_polled_wait_finishes_start(self):
+        self.worker.state_poller = mock.Mock()
+        self.worker.state_poller.wait_while.return_value = 'running'
+        self.worker.tags = {'purpose': 'test'}
+        build = FakeBuild('builder')
+        yield self.worker.substantiate(None, build)
+        instance = self.worker.instance
+        self.worker.state_poller.wait_while.assert_called_once_with(instance.id, 'pending', 60)
+        self.assertEqual(self.worker.properties.getProperty('instance'), instance.id)
+        instance.reload()
+        self.assertIn({'Key': 'purpose', 'Value': 'test'}, instance.tags)
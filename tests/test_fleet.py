@@ -0,0 +1,67 @@
+import os
+import unittest
+from unittest import mock
+
+import boto3
+from moto import mock_aws
+
+from autobuilder.workers.awscache import METADATA
+from autobuilder.workers.ec2 import MyEC2LatentWorker
+from autobuilder.workers.fleet import EC2Fleet
+
+REGION = 'us-east-1'
+
+
+@mock_aws
+class EC2FleetTest(unittest.TestCase):
+    def setUp(self):
+        os.environ.setdefault('AWS_DEFAULT_REGION', REGION)
+        METADATA.invalidate()
+        self.client = boto3.client('ec2', region_name=REGION)
+        vpc = self.client.create_vpc(CidrBlock='10.0.0.0/16')['Vpc']
+        self.subnet_id = self.client.create_subnet(VpcId=vpc['VpcId'], CidrBlock='10.0.0.0/24',
+                                                   AvailabilityZone=REGION + 'a')['Subnet']['SubnetId']
+        images = self.client.describe_images(Owners=['amazon'])['Images']
+        self.image_ids = [image['ImageId'] for image in images[:2]]
+
+    def test_acquire(self):
+        fleet = EC2Fleet(on_demand_fallback=True)
+        spec = fleet.ensure_launch_template(self.client, 'autobuilder-test', {'ImageId': self.image_ids[0]})
+        result = fleet.acquire(self.client, spec, [{'InstanceType': 't3.micro', 'SubnetId': self.subnet_id}],
+                               spot=False)
+        self.assertIsNotNone(result)
+        instance_id, instance_type, subnet_id = result
+        self.assertEqual((instance_type, subnet_id), ('t3.micro', self.subnet_id))
+        reservations = self.client.describe_instances(InstanceIds=[instance_id])['Reservations']
+        self.assertEqual(reservations[0]['Instances'][0]['ImageId'], self.image_ids[0])
+
+    def test_new_template_version_replaces_old(self):
+        fleet = EC2Fleet()
+        first = fleet.ensure_launch_template(self.client, 'autobuilder-test', {'ImageId': self.image_ids[0]})
+        self.assertEqual(first['Version'], '1')
+        # moto does not implement deleting launch template versions
+        with mock.patch.object(self.client, 'delete_launch_template_versions') as delete:
+            second = fleet.ensure_launch_template(self.client, 'autobuilder-test', {'ImageId': self.image_ids[1]})
+        self.assertEqual(second, {'LaunchTemplateId': first['LaunchTemplateId'], 'Version': '2'})
+        template = self.client.describe_launch_templates(LaunchTemplateNames=['autobuilder-test'])
+        self.assertEqual(template['LaunchTemplates'][0]['DefaultVersionNumber'], 2)
+        delete.assert_called_once_with(LaunchTemplateName='autobuilder-test', Versions=['1'])
+
+    def test_worker_template_follows_image(self):
+        worker = MyEC2LatentWorker('fleet-worker', 'password', instance_type='t3.micro', ami=self.image_ids[0],
+                                   region=REGION, identifier='testing', secret_identifier='testing',
+                                   subnet_id=self.subnet_id, fleet=EC2Fleet())
+        spec = worker._fleet_launch_template()
+        self.assertIs(worker._fleet_launch_template(), spec)
+        worker.image = worker.ec2.Image(self.image_ids[1])
+        client = worker.ec2.meta.client
+        with mock.patch.object(client, 'delete_launch_template_versions'):
+            updated = worker._fleet_launch_template()
+        self.assertEqual(updated['Version'], '2')
+        version = client.describe_launch_template_versions(LaunchTemplateName='autobuilder-fleet-worker',
+                                                           Versions=['2'])['LaunchTemplateVersions'][0]
+        self.assertEqual(version['LaunchTemplateData']['ImageId'], self.image_ids[1])
+
+
+if __name__ == '__main__':
+    unittest.main()